@@ -0,0 +1,78 @@
+"""
+Answer the clock probes of the host over a virtio serial port.
+
+Each probe is a sequence number (8 bytes, network order), the reply is the
+sequence number followed by the wall clock time when the probe is received
+and the one when the reply is sent (2 doubles, network order).
+
+Usage: clock_responder.py <port device>
+  Linux: /dev/virtio-ports/<name>
+  Windows: \\\\.\\Global\\<name>
+"""
+
+import os
+import struct
+import sys
+import time
+
+PROBE = struct.Struct("!Q")
+REPLY = struct.Struct("!Qdd")
+
+
+class LinuxPort(object):
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR)
+
+    def read(self, size):
+        return os.read(self.fd, size)
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+
+class WindowsPort(object):
+    def __init__(self, path):
+        self.fd = open(path, "r+b", buffering=0)
+
+    def read(self, size):
+        return self.fd.read(size)
+
+    def write(self, data):
+        self.fd.write(data)
+        self.fd.flush()
+
+
+def respond(port):
+    buf = b""
+    while True:
+        data = port.read(PROBE.size - len(buf))
+        if not data:
+            # the host side is not connected, e.g. during migration
+            buf = b""
+            time.sleep(0.05)
+            continue
+        received = time.time()
+        buf += data
+        if len(buf) < PROBE.size:
+            continue
+        seq = PROBE.unpack(buf)[0]
+        buf = b""
+        try:
+            port.write(REPLY.pack(seq, received, time.time()))
+        except (IOError, OSError):
+            time.sleep(0.05)
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s <port device>%s" % (sys.argv[0], os.linesep))
+        return 1
+    if sys.platform.startswith("win"):
+        port = WindowsPort(sys.argv[1])
+    else:
+        port = LinuxPort(sys.argv[1])
+    respond(port)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,11 +4,11 @@ import select
 import struct
 import sys
 import threading
+import time
 
 TYPE_SYNC = "SYNC"
 TYPE_INFO = "INFO"
 TYPE_READY = "READY"
-TYPE_EVENT = "EVENT"
 TYPE_ERROR = "ERROR"
 EMPTY_CONTENT = {}
 
@@ -32,16 +32,31 @@ def ready_notify():
     send_message(TYPE_READY, EMPTY_CONTENT)
 
 
-def event_notify(dev, event):
-    send_message(TYPE_EVENT, {"device": dev, "event": event})
-
-
 def error_notify(error, dev=None):
     send_message(TYPE_ERROR, {"device": dev, "message": error})
 
 
 EV_PACK_FMT = "llHHI"
 EV_PACK_SIZE = struct.calcsize(EV_PACK_FMT)
+# Events read per syscall at most
+EV_READ_COUNT = 64
+
+# Compact framing of the events, one line per frame, i.e. the events of a
+# device up to the EV_SYN/SYN_REPORT boundary:
+#   F <device> <seq> <timestamp> <type>,<code>,<value>;...
+# The code of EV_KEY events is the key name, the others are numbers.
+# A frame broken by the kernel (EV_SYN/SYN_DROPPED) is reported as:
+#   D <device> <seq>
+# The sequence number increases per device for both lines.
+FRAME_PREFIX = "F"
+DROPPED_PREFIX = "D"
+
+# Clock probes of the host are read from stdin:
+#   T <token>
+# and answered with the clock of the event timestamps (CLOCK_REALTIME):
+#   C <token> <timestamp>
+CLOCK_PROBE_PREFIX = "T"
+CLOCK_PREFIX = "C"
 
 EV_TYPES = {
     0x00: "EV_SYN",
@@ -806,33 +821,95 @@ if GRAPHICAL:
 
 
 def format_event(raw_event):
-    tv_sec, tv_usec, ev_type, ev_code, ev_value = raw_event
-    event = {
-        "typeNum": ev_type,
-        "typeName": EV_TYPES.get(ev_type, "UNKNOWN"),
-        "codeNum": ev_code,
-        "codeName": EV_CODE_MAP.get(ev_type, {}).get(ev_code, "UNKNOWN"),
-        "value": ev_value,
-        "timestamp": (tv_sec * (10**6) + tv_usec),
-    }
-    return event
+    ev_type, ev_code, ev_value = raw_event[2:]
+    if ev_type == 0x01:
+        ev_code = EV_KEY_CODES.get(ev_code, "UNKNOWN")
+    return "%d,%s,%d" % (ev_type, ev_code, ev_value)
+
+
+class FrameBuffer(object):
+    """Coalesce the events of a device up to each EV_SYN boundary."""
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.seq = 0
+        self.events = []
+
+    def feed(self, raw_event):
+        """Return the line of the frame if it's completed by the event."""
+        tv_sec, tv_usec, ev_type, ev_code = raw_event[:4]
+        if ev_type != 0x00:
+            self.events.append(format_event(raw_event))
+            return None
+        if ev_code == 0x03:  # SYN_DROPPED
+            self.events = []
+            self.seq += 1
+            return "%s %s %d" % (DROPPED_PREFIX, self.dev, self.seq)
+        if ev_code != 0x00 or not self.events:  # not SYN_REPORT
+            return None
+        self.seq += 1
+        line = "%s %s %d %d %s" % (
+            FRAME_PREFIX,
+            self.dev,
+            self.seq,
+            tv_sec * (10**6) + tv_usec,
+            ";".join(self.events),
+        )
+        self.events = []
+        return line
+
+
+def read_events(fd):
+    """Read many events by one syscall."""
+    data = os.read(fd, EV_PACK_SIZE * EV_READ_COUNT)
+    return [
+        struct.unpack_from(EV_PACK_FMT, data, offset)
+        for offset in range(0, len(data) - EV_PACK_SIZE + 1, EV_PACK_SIZE)
+    ]
+
+
+def answer_probes(data):
+    """Answer the clock probes read from stdin."""
+    now = int(time.time() * (10**6))
+    lines = []
+    for line in data.decode("utf-8", "ignore").splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == CLOCK_PROBE_PREFIX:
+            lines.append("%s %s %d" % (CLOCK_PREFIX, fields[1], now))
+    return lines
 
 
 def listen(devs):
     watch = list(devs.keys())
+    buffers = dict((fd, FrameBuffer(devs[fd][0])) for fd in watch)
+    probes = [sys.stdin.fileno()]
     while True:
-        fds = select.select(watch, (), ())[0]
+        fds = select.select(watch + probes, (), ())[0]
+        lines = []
         for fd in fds:
+            if fd in probes:
+                data = os.read(fd, 4096)
+                if data:
+                    lines.extend(answer_probes(data))
+                else:
+                    probes = []
+                continue
             dev = devs[fd][0]
             try:
-                data = os.read(fd, EV_PACK_SIZE)
-                raw_event = struct.unpack(EV_PACK_FMT, data)
+                raw_events = read_events(fd)
             except Exception as details:
                 msg = "failed to get event: %s" % str(details)
                 error_notify(msg, dev)
                 watch.remove(fd)
-            event = format_event(raw_event)
-            event_notify(dev, event)
+                continue
+            for raw_event in raw_events:
+                line = buffers[fd].feed(raw_event)
+                if line:
+                    lines.append(line)
+        if lines:
+            lines.append("")
+            sys.stdout.write(os.linesep.join(lines))
+            sys.stdout.flush()
         if not watch:
             break
 
@@ -7,7 +7,7 @@ import time
 from avocado.utils import process
 from virttest import error_context, remote, utils_misc, utils_net, utils_test, virt_vm
 
-from provider import netperf_base, win_driver_utils
+from provider import netperf_base, perf_result_store, win_driver_utils
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -463,7 +463,23 @@ def start_test(
         params = {}
 
     fd = open("%s/netperf-result.%s.RHS" % (resultsdir, time.time()), "w")
-    netperf_base.record_env_version(test, params, host, server_ctl, fd, test_duration)
+    env_version = netperf_base.record_env_version(
+        test, params, host, server_ctl, fd, test_duration
+    )
+    store = perf_result_store.PerfResultStore.from_params(params, resultsdir)
+    perf_run = store.new_run(
+        params.get("shortname", "netperf"),
+        params,
+        env_version,
+        hash_keys=(
+            "protocols",
+            "sessions",
+            "sizes",
+            "sessions_rr",
+            "sizes_rr",
+            "queues",
+        ),
+    )
 
     record_list = [
         "size",
@@ -480,13 +496,20 @@ def start_test(
         "exits",
         "tpkt_per_exit",
     ]
+    # the metrics which are better when they drop, e.g. the VM exits and
+    # the interrupts, the others are better when they rise
+    lower_is_better = ["CPU", "re_pkts", "exits"]
 
     for i in range(int(params.get("queues", 0))):
         record_list.append("rx_intr_%s" % i)
+        lower_is_better.append("rx_intr_%s" % i)
     record_list.append("rx_intr_sum")
+    lower_is_better.append("rx_intr_sum")
     for i in range(int(params.get("queues", 0))):
         record_list.append("tx_intr_%s" % i)
+        lower_is_better.append("tx_intr_%s" % i)
     record_list.append("tx_intr_sum")
+    lower_is_better.append("tx_intr_sum")
     base = params.get("format_base", "12")
     fbase = params.get("format_fbase", "2")
 
@@ -566,12 +589,35 @@ def start_test(
                     prefix = "%s--%s--%s" % (protocol, i, j)
                     for key in key_list:
                         test.write_test_keyval({"%s--%s" % (prefix, key): ret[key]})
+                        if key in ("size", "sessions"):
+                            continue
+                        samples = None
+                        if key in ("throughput", "trans.rate"):
+                            samples = [value for _, value in ret["thu_series"]]
+                        perf_run.add(
+                            key,
+                            ret[key],
+                            samples,
+                            protocol=protocol,
+                            size=int(i),
+                            sessions=int(j),
+                        )
 
                     test.log.info(row)
                     fd.write(row + "\n")
 
                     fd.flush()
 
+                    series_file = "%s/netperf-series.%s.%s.%s.csv" % (
+                        resultsdir,
+                        protocol,
+                        i,
+                        j,
+                    )
+                    with open(series_file, "w") as series_fd:
+                        for second, value in ret["thu_series"]:
+                            series_fd.write("%s,%s\n" % (second, value))
+
                     test.log.debug("Remove temporary files")
                     process.system_output(
                         "rm -f /tmp/netperf.%s.nf" % ret["pid"],
@@ -588,6 +634,10 @@ def start_test(
                     )
                     continue
     fd.close()
+    perf_run.commit()
+    perf_result_store.check_regressions(
+        test, params, store, perf_run, lower_is_better=lower_is_better
+    )
 
 
 @error_context.context_aware
@@ -660,96 +710,9 @@ def launch_client(
         else:
             test.log.info("Netserver start cmd is '%s'", server_path)
             netperf_base.ssh_cmd(server_ctl, "pidof netserver || %s" % server_path)
-            ncpu = netperf_base.ssh_cmd(
-                server_ctl, "cat /proc/cpuinfo |grep processor |wc -l"
-            )
-            ncpu = re.findall(r"\d+", ncpu)[-1]
 
         test.log.info("Netserver start successfully")
 
-    def count_interrupt(name):
-        """
-        Get a list of interrut number for each queue
-
-        @param name: the name of interrupt, such as "virtio0-input"
-        """
-        sum = 0
-        intr = []
-        stat = netperf_base.ssh_cmd(server_ctl, "grep %s /proc/interrupts" % name)
-        for i in stat.strip().split("\n"):
-            for cpu in range(int(ncpu)):
-                sum += int(i.split()[cpu + 1])
-            intr.append(sum)
-            sum = 0
-        return intr
-
-    def get_state():
-        ifname = None
-        for i in netperf_base.ssh_cmd(server_ctl, "ifconfig").split("\n\n"):
-            if server in i:
-                ifname = re.findall(r"(\w+\d+)[:\s]", i)[0]
-        if ifname is None:
-            raise RuntimeError(f"no available iface associated with {server}")
-
-        path = "find /sys/devices|grep net/%s/statistics" % ifname
-        cmd = (
-            "%s/rx_packets|xargs cat;%s/tx_packets|xargs cat;"
-            "%s/rx_bytes|xargs cat;%s/tx_bytes|xargs cat" % (path, path, path, path)
-        )
-        output = netperf_base.ssh_cmd(server_ctl, cmd).split()[-4:]
-
-        nrx = int(output[0])
-        ntx = int(output[1])
-        nrxb = int(output[2])
-        ntxb = int(output[3])
-
-        nre = int(
-            netperf_base.ssh_cmd(server_ctl, "grep Tcp /proc/net/snmp|tail -1").split()[
-                12
-            ]
-        )
-        state_list = [
-            "rx_pkts",
-            nrx,
-            "tx_pkts",
-            ntx,
-            "rx_byts",
-            nrxb,
-            "tx_byts",
-            ntxb,
-            "re_pkts",
-            nre,
-        ]
-        try:
-            nrx_intr = count_interrupt("virtio.-input")
-            ntx_intr = count_interrupt("virtio.-output")
-            sum = 0
-            for i in range(len(nrx_intr)):
-                state_list.append("rx_intr_%s" % i)
-                state_list.append(nrx_intr[i])
-                sum += nrx_intr[i]
-            state_list.append("rx_intr_sum")
-            state_list.append(sum)
-
-            sum = 0
-            for i in range(len(ntx_intr)):
-                state_list.append("tx_intr_%s" % i)
-                state_list.append(ntx_intr[i])
-                sum += ntx_intr[i]
-            state_list.append("tx_intr_sum")
-            state_list.append(sum)
-
-        except IndexError:
-            ninit = count_interrupt("virtio.")
-            state_list.append("intr")
-            state_list.append(ninit)
-
-        exits = int(netperf_base.ssh_cmd(host, "cat /sys/kernel/debug/kvm/exits"))
-        state_list.append("exits")
-        state_list.append(exits)
-
-        return state_list
-
     def thread_cmd(params, i, numa_enable, client_s, timeout):
         fname = "/tmp/netperf.%s.nf" % pid
         option = "`command -v python python3 | head -1 ` "
@@ -763,16 +726,6 @@ def launch_client(
         option += " >> %s" % fname
         netperf_base.netperf_thread(params, numa_enable, client_s, option, fname)
 
-    def all_clients_up():
-        try:
-            content = netperf_base.ssh_cmd(clients[-1], "cat %s" % fname)
-        except:
-            content = ""
-            return False
-        if int(sessions) == len(re.findall("MIGRATE", content)):
-            return True
-        return False
-
     def stop_netperf_clients():
         if params.get("os_type_client") == "linux":
             netperf_base.ssh_cmd(
@@ -783,43 +736,33 @@ def launch_client(
                 clients[-1], params.get("client_kill_windows"), ignore_status=True
             )
 
-    def parse_demo_result(fname, sessions):
+    def parse_demo_result(collector, sessions):
         """
-        Process the demo result, remove the noise from head,
+        Process the demo result collected from the netperf agent,
         and compute the final throughout.
 
-        :param fname: result file name
+        :param collector: NetperfResultCollector object
         :param sessions: sessions' number
         """
-        fd = open(fname)
-        lines = fd.readlines()
-        fd.close()
-
-        for i in range(1, len(lines) + 1):
-            if "AF_INET" in lines[-i]:
-                break
-        nresult = i - 1
+        result, niteration, nresult = collector.get_result()
         if nresult < int(sessions):
             test.error(
                 "We couldn't expect this parallism, expect %s get %s"
                 % (sessions, nresult)
             )
-
-        niteration = nresult // sessions
-        result = 0.0
-        for this in lines[-sessions * niteration :]:
-            if "Interim" in this:
-                result += float(re.findall(r"Interim result: *(\S+)", this)[0])
-        result = result / niteration
         test.log.debug("niteration: %s", niteration)
         return result
 
+    if get_status_flag:
+        sampler = netperf_base.NetStateSampler(server_ctl, host, server)
     tries = int(params.get("tries", 1))
     while tries > 0:
         error_context.context("Start netperf client threads", test.log.info)
         pid = str(os.getpid())
         fname = "/tmp/netperf.%s.nf" % pid
         netperf_base.ssh_cmd(clients[-1], "rm -f %s" % fname)
+        collector = netperf_base.NetperfResultCollector(sessions)
+        collector.start(clients[-1], fname)
         numa_enable = params.get("netperf_with_numa", "yes") == "yes"
         timeout_netperf_start = int(l) * 0.5
         client_thread = threading.Thread(
@@ -837,50 +780,36 @@ def launch_client(
         ret = {}
         ret["pid"] = pid
 
-        if utils_misc.wait_for(
-            all_clients_up,
-            timeout_netperf_start,
-            0.0,
-            0.2,
-            "Wait until all netperf clients start to work",
-        ):
+        test.log.debug("Wait until all netperf clients start to work")
+        if collector.wait_ready(timeout_netperf_start):
             test.log.debug("All netperf clients start to work.")
 
             # real & effective test starts
             if get_status_flag:
-                start_state = get_state()
+                start_state = sampler.sample()
             ret["mpstat"] = netperf_base.ssh_cmd(
                 host, "mpstat 1 %d |tail -n 1" % (l - 1)
             )
-            finished_result = netperf_base.ssh_cmd(clients[-1], "cat %s" % fname)
-
             # stop netperf clients
+            collector.stop()
             stop_netperf_clients()
+            ret["thu"] = parse_demo_result(collector, int(sessions))
+            ret["thu_series"] = collector.get_series()
 
             # real & effective test ends
             if get_status_flag:
-                end_state = get_state()
-                if len(start_state) != len(end_state):
-                    msg = "Initial state not match end state:\n"
-                    msg += "  start state: %s\n" % start_state
-                    msg += "  end state: %s\n" % end_state
-                    test.log.warning(msg)
-                else:
-                    for i in range(len(end_state) // 2):
-                        ret[end_state[i * 2]] = (
-                            end_state[i * 2 + 1] - start_state[i * 2 + 1]
-                        )
+                end_state = sampler.sample()
+                try:
+                    ret.update((end_state - start_state).items())
+                except ValueError as err:
+                    test.log.warning("Initial state not match end state: %s", err)
 
             client_thread.join()
 
             error_context.context("Testing Results Treatment and Report", test.log.info)
-            f = open(fname, "w")
-            f.write(finished_result)
-            f.close()
-            ret["thu"] = parse_demo_result(fname, int(sessions))
             return ret
-            break
         else:
+            collector.stop()
             stop_netperf_clients()
             tries = tries - 1
             test.log.debug("left %s times", tries)
@@ -1,8 +1,59 @@
 import math
+import os
+import statistics
+import time
+from multiprocessing.pool import ThreadPool
 
 from avocado.utils import process
 from virttest import env_process, error_context
 
+from provider import perf_result_store
+
+KSM_DIR = "/sys/kernel/mm/ksm"
+
+
+def _run_parallel(func, args_list, workers):
+    """
+    Run func with each argument tuple by at most 'workers' threads
+
+    :return: list of the results in the order of args_list
+    """
+    pool = ThreadPool(max(min(workers, len(args_list)), 1))
+    try:
+        results = [pool.apply_async(func, args) for args in args_list]
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return [result.get() for result in results]
+
+
+def _host_mem_state():
+    """
+    Get the host memory (MB) and the KSM state
+
+    :return: dict with mem_available, mem_free, anon_pages and ksm_<file>
+             of the run/pages_shared/pages_sharing files of KSM
+    """
+    fields = {
+        "MemAvailable": "mem_available",
+        "MemFree": "mem_free",
+        "AnonPages": "anon_pages",
+    }
+    state = {}
+    with open("/proc/meminfo") as fd:
+        for line in fd:
+            key, value = line.split(":", 1)
+            if key in fields:
+                state[fields[key]] = int(value.split()[0]) // 1024
+    for name in ("run", "pages_shared", "pages_sharing"):
+        try:
+            with open(os.path.join(KSM_DIR, name)) as fd:
+                state["ksm_%s" % name] = int(fd.read())
+        except (IOError, OSError, ValueError):
+            pass
+    return state
+
 
 @error_context.context_aware
 def run(test, params, env):
@@ -10,21 +61,27 @@ def run(test, params, env):
     Boots VMs until one of them becomes unresponsive, and records the maximum
     number of VMs successfully started:
     1) boot the first vm
-    2) boot the second vm cloned from the first vm, check whether it boots up
-       and all booted vms respond to shell commands
+    2) boot the next wave of vms cloned from the first vm concurrently, check
+       whether they boot up and all booted vms respond to shell commands
     3) go on until cannot create VM anymore or cannot allocate memory for VM
 
+    The time to login of each guest, the host memory and the KSM state after
+    each wave are recorded, the first wave whose median time to login exceeds
+    'boot_degrade_ratio' times of the one of the first guest is reported as
+    the point where the boot latency degrades.
+
     :param test:   kvm test object
     :param params: Dictionary with the test parameters
     :param env:    Dictionary with test environment.
     """
     error_context.base_context("waiting for the first guest to be up", test.log.info)
 
+    max_vms = int(params.get("max_vms"))
     host_cpu_cnt_cmd = params.get("host_cpu_cnt_cmd")
     host_cpu_num = int(process.getoutput(host_cpu_cnt_cmd).strip())
-    if host_cpu_num <= int(params.get("max_vms")):
+    if host_cpu_num <= max_vms:
         test.cancel("No enough physical cpus to pin all guests")
-    vm_cpu_num = host_cpu_num // int(params.get("max_vms"))
+    vm_cpu_num = host_cpu_num // max_vms
     if vm_cpu_num == 1:
         params["vcpu_sockets"] = 1
         params["vcpu_threads"] = 1
@@ -34,48 +91,123 @@ def run(test, params, env):
 
     host_mem_size_cmd = params.get("host_mem_size_cmd")
     host_mem_size = int(process.getoutput(host_mem_size_cmd).strip())
-    vm_mem_size = host_mem_size // int(params.get("max_vms"))
+    vm_mem_size = host_mem_size // max_vms
 
     params["vcpu_maxcpus"] = vm_cpu_num
     params["mem"] = vm_mem_size
 
+    wave_size = max(int(params.get("boot_wave_size", 1)), 1)
+    alive_workers = int(params.get("alive_check_workers", 8))
+    degrade_ratio = float(params.get("boot_degrade_ratio", 1.5))
+    login_timeout = float(params.get("login_timeout", 420))
+    alive_test_cmd = params.get("alive_test_cmd")
+
+    store = perf_result_store.PerfResultStore.from_params(params, test.resultsdir)
+    perf_run = store.new_run(
+        params.get("shortname", "stress_boot"),
+        params,
+        hash_keys=("max_vms", "boot_wave_size"),
+    )
+
     params["start_vm"] = "yes"
     vm_name = params["main_vm"]
+    start_time = time.time()
     env_process.preprocess_vm(test, params, env, vm_name)
 
     vm = env.get_vm(vm_name)
     vm.verify_alive()
-    login_timeout = float(params.get("login_timeout", 420))
     session = vm.wait_for_login(timeout=login_timeout)
+    base_time = time.time() - start_time
+    test.log.info("Guest #1 booted up in %.1fs", base_time)
+
+    def boot_guest(curr_vm, start_time):
+        try:
+            session = curr_vm.wait_for_login(timeout=login_timeout)
+        except Exception as emsg:
+            return None, "%s: %s" % (curr_vm.name, emsg)
+        return session, time.time() - start_time
+
+    def check_alive(index):
+        try:
+            sessions[index].cmd(alive_test_cmd)
+        except Exception as emsg:
+            return "guest #%d: %s" % (index + 1, emsg)
 
     num = 2
     sessions = [session]
+    waves = [{"vms": 1, "boot_times": [base_time], "boot_median": base_time}]
+    waves[0].update(_host_mem_state())
+    degraded_at = None
 
     # Boot the VMs
     try:
         try:
-            while num <= int(params.get("max_vms")):
-                # Clone vm according to the first one
-                error_context.base_context("booting guest #%d" % num, test.log.info)
-                vm_name = "vm%d" % num
-                vm_params = vm.params.copy()
-                curr_vm = vm.clone(vm_name, vm_params)
-                env.register_vm(vm_name, curr_vm)
-                env_process.preprocess_vm(test, vm_params, env, vm_name)
-                params["vms"] += " " + vm_name
-
-                session = curr_vm.wait_for_login(timeout=login_timeout)
-                sessions.append(session)
-                test.log.info("Guest #%d booted up successfully", num)
-
-                # Check whether all previous shell sessions are responsive
-                for i, se in enumerate(sessions):
-                    error_context.context(
-                        "checking responsiveness of guest" " #%d" % (i + 1),
-                        test.log.debug,
+            while num <= max_vms:
+                last = min(num + wave_size - 1, max_vms)
+                error_context.base_context(
+                    "booting guest #%d - #%d" % (num, last), test.log.info
+                )
+                # Clone vms according to the first one, the guests of a wave
+                # boot concurrently once their qemu processes are started
+                guests = []
+                for index in range(num, last + 1):
+                    vm_name = "vm%d" % index
+                    vm_params = vm.params.copy()
+                    curr_vm = vm.clone(vm_name, vm_params)
+                    env.register_vm(vm_name, curr_vm)
+                    start_time = time.time()
+                    env_process.preprocess_vm(test, vm_params, env, vm_name)
+                    params["vms"] += " " + vm_name
+                    guests.append((curr_vm, start_time))
+
+                booted = _run_parallel(boot_guest, guests, len(guests))
+                sessions.extend(session for session, _ in booted if session)
+                errors = [error for session, error in booted if not session]
+                if errors:
+                    raise RuntimeError("Failed to login %s" % "; ".join(errors))
+                boot_times = [boot_time for _, boot_time in booted]
+                for index, boot_time in enumerate(boot_times, num):
+                    test.log.info(
+                        "Guest #%d booted up successfully in %.1fs", index, boot_time
                     )
-                    se.cmd(params.get("alive_test_cmd"))
-                num += 1
+
+                # Check whether all shell sessions are responsive
+                error_context.context(
+                    "checking responsiveness of %d guests" % len(sessions),
+                    test.log.debug,
+                )
+                errors = _run_parallel(
+                    check_alive, [(i,) for i in range(len(sessions))], alive_workers
+                )
+                errors = [error for error in errors if error]
+                if errors:
+                    raise RuntimeError("Unresponsive %s" % "; ".join(errors))
+
+                wave = {"vms": last, "boot_times": boot_times}
+                wave["boot_median"] = statistics.median(boot_times)
+                wave.update(_host_mem_state())
+                waves.append(wave)
+                test.log.info(
+                    "%d guests are up, median time to login %.1fs, host: %s",
+                    last,
+                    wave["boot_median"],
+                    ", ".join(
+                        "%s %s" % item
+                        for item in sorted(wave.items())
+                        if item[0] not in ("vms", "boot_times", "boot_median")
+                    ),
+                )
+                if degraded_at is None and wave["boot_median"] > (
+                    degrade_ratio * base_time
+                ):
+                    degraded_at = last
+                    test.log.warning(
+                        "Boot latency degrades at %d guests: %.1fs vs %.1fs",
+                        last,
+                        wave["boot_median"],
+                        base_time,
+                    )
+                num = last + 1
         except Exception as emsg:
             test.fail(
                 "Expect to boot up %s guests."
@@ -86,3 +218,14 @@ def run(test, params, env):
         for se in sessions:
             se.close()
         test.log.info("Total number booted: %d", (num - 1))
+        for wave in waves:
+            perf_run.add(
+                "boot_time", wave["boot_median"], wave["boot_times"], vms=wave["vms"]
+            )
+            for key in ("mem_available", "ksm_pages_sharing"):
+                if key in wave:
+                    perf_run.add(key, wave[key], vms=wave["vms"])
+        perf_run.add("booted_vms", num - 1)
+        if degraded_at is not None:
+            perf_run.add("degraded_vms", degraded_at)
+        perf_run.commit()
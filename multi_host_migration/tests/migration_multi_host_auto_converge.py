@@ -1,10 +1,11 @@
 import logging
-import time
 
 from autotest.client.shared import error, utils
 from virttest import utils_misc, utils_test, virt_vm
 from virttest.utils_test.qemu import migration
 
+from provider.migration_telemetry import AutoConvergeAnalyzer
+
 
 @error.context_aware
 def run(test, params, env):
@@ -34,6 +35,9 @@ def run(test, params, env):
           the output for (1) default auto-converge setting (off) and (2)
           auto-converge on, the guest performance should not be effected
           obviously with auto-converge on.
+    4) During migration, sample the host CPU, the vCPU threads and the
+       migration progress on one timeline, and report how auto-converge
+       throttles the guest.
 
     :param test: kvm test object.
     :param params: Dictionary with test parameters.
@@ -65,6 +69,7 @@ def run(test, params, env):
             self.need_stress = params.get("need_stress") == "yes"
             self.need_cleanup = self.need_stress
             self.session = None
+            self.analyzer = None
             self.sub_type = params.get("sub_type")
             self.sub_test = params.objects("sub_test")
             for i in range(1, len(self.sub_test)):
@@ -133,104 +138,59 @@ def run(test, params, env):
             error.context("load host before migration.", logging.info)
             utils.run(self.load_host_cmd)
 
-        @error.context_aware
-        def analysis_sar_output(self, output):
-            """
-            analyse output of command sar after migration, get "cpu_average",
-            "memory_average".
-
-            :param output: the output of command sar during migration
-            """
-
-            output = output.splitlines()
-            for index, line in enumerate(output):
-                if sar_cpu_str in line:
-                    cpu_average = output[index + 1].split()[2:]
-                    cpu_average = list(map(float, cpu_average))
-                if sar_memory_str in line:
-                    memory_average_raw = output[index + 1].split()
-                    memory_average = []
-                    for j in range(len(memory_average_raw)):
-                        if j in [3, 7]:
-                            memory_average.append(memory_average_raw[j])
-                    memory_average = list(map(float, memory_average))
-                    break
-            all_items = set(vars())
-            interested_items = set(["cpu_average", "memory_average"])
-            if not interested_items.issubset(all_items):
-                raise error.TestFail(
-                    "Failed to get '%s' '%s' in "
-                    "sar output: '%s'" % (sar_cpu_str, sar_memory_str, output)
-                )
-            logging.info("cpu average list: %s", cpu_average)
-            logging.info("memory average list: %s", memory_average)
-            sar_output.append(cpu_average)
-            sar_output.append(memory_average)
-
-        @error.context_aware
-        def get_sar_output(self):
+        def start_analyzer(self, vm):
             """
-            get output of command sar during migration
+            start sampling the host CPU, the vCPU threads and the migration
+            progress during migration
 
             :param vm: vm object
             """
 
-            error.context("Get output of command sar during migration", logging.info)
-            vm = self.env.get_vm(self.params["main_vm"])
-            session = vm.wait_for_login(timeout=self.login_timeout)
-            while vm.is_alive():
-                s, o = session.cmd_status_output(get_sar_output_cmd)  # pylint: disable=E0606
-                if s != 0:
-                    raise error.TestFail(
-                        "Failed to get sar output in guest." "The detail is: %s" % o
-                    )
-            session.close()
-            self.analysis_sar_output(o)
+            self.analyzer = AutoConvergeAnalyzer(vm, analyzer_interval)
+            self.analyzer.start()
 
-        @error.context_aware
-        def check_sar_output(self):
+        def stop_analyzer(self):
             """
-            Compare the output for (1) default auto-converge setting (off)
-            and (2) auto-converge on, the guest performance should not be
-            effected obviously with auto-converge on. (30% is acceptance)
+            stop sampling and record the analysis of auto-converge
             """
 
-            logging.info("The sar output list: %s", sar_output)
-            cpu_average = zip(sar_output[0], sar_output[2])
-            memory_average = zip(sar_output[1], sar_output[3])
-            for i in cpu_average:
-                if abs(i[0] - i[1]) > 30:
-                    raise error.TestFail(
-                        "The guest performance should "
-                        "not be effected obviously with "
-                        "auto-converge on."
-                    )
-            for i in memory_average:
-                if abs(i[0] - i[1]) > 30:
-                    raise error.TestFail(
-                        "The guest performance should "
-                        "not be effected obviously with "
-                        "auto-converge on."
-                    )
+            if not self.analyzer.join(analyzer_interval * 2):
+                self.analyzer.stop()
+            report = self.analyzer.log_report()
+            reports.append(report)
+            return report
 
         @error.context_aware
-        def get_mig_cpu_throttling_percentage(self, vm):
+        def check_guest_performance(self):
             """
-            get cpu throttling percentage during migration
+            Compare the vCPU threads utilization for (1) default auto-converge
+            setting (off) and (2) auto-converge on, the guest performance
+            should not be effected obviously with auto-converge on.
+            (30% is acceptance)
 
-            :param vm: vm object
+            Only the samples before throttling are compared, auto-converge
+            slows down the vCPU threads on purpose once it throttles.
             """
 
-            error.context(
-                "Get cpu throttling percentage during migration", logging.info
-            )
-            cpu_throttling_percentage = vm.monitor.info("migrate").get(
-                "cpu-throttle-percentage"
-            )
+            logging.info("The auto-converge reports: %s", reports)
+            util_off, util_on = [r["vcpu_util_before"] for r in reports]
+            if None in (util_off, util_on):
+                logging.warning(
+                    "No vCPU threads utilization before throttling to compare"
+                )
+                return
             logging.info(
-                "The cpu throttling percentage is %s%%", cpu_throttling_percentage
+                "vCPU threads utilization before throttling: %.1f%% (off), "
+                "%.1f%% (on)",
+                util_off,
+                util_on,
             )
-            return cpu_throttling_percentage
+            if abs(util_off - util_on) > 30:
+                raise error.TestFail(
+                    "The guest performance should "
+                    "not be effected obviously with "
+                    "auto-converge on."
+                )
 
         @error.context_aware
         def check_mig_cpu_throttling_percentage(self):
@@ -241,6 +201,10 @@ def run(test, params, env):
             error.context(
                 "check cpu throttling percentage during migration", logging.info
             )
+            self.parameters_value = list(map(int, self.parameters_value))
+            cpu_throttling_percentage_list = [
+                int(v) for _, v in self.analyzer.throttle_series()
+            ]
             logging.info(
                 "The cpu throttling percentage list is %s",
                 cpu_throttling_percentage_list,
@@ -266,28 +230,6 @@ def run(test, params, env):
                     % (99, max(cpu_throttling_percentage_list))
                 )
 
-        def thread_check_mig_cpu_throttling_percentage(self):
-            """
-            function, called by utils.InterruptedThread()
-            """
-
-            self.parameters_value = list(map(int, self.parameters_value))
-            vm = self.env.get_vm(self.params["main_vm"])
-            while self.migration_timeout:
-                list_item = self.get_mig_cpu_throttling_percentage(vm)
-                if list_item is not None:
-                    cpu_throttling_percentage_list.append(int(list_item))
-                if not cpu_throttling_percentage_list:
-                    time.sleep(1)
-                    self.migration_timeout -= 1
-                    continue
-                if max(cpu_throttling_percentage_list) >= sum(self.parameters_value):
-                    break
-                else:
-                    time.sleep(1)
-                    self.migration_timeout -= 1
-            self.check_mig_cpu_throttling_percentage()
-
         def before_migration_capability(self, mig_data):
             """
             get migration capability (auto-converge: on/off)
@@ -350,11 +292,7 @@ def run(test, params, env):
             :param mig_data: Data for migration
             """
 
-            if set_auto_converge == "yes":
-                mig_thread = utils.InterruptedThread(
-                    self.thread_check_mig_cpu_throttling_percentage
-                )
-                mig_thread.start()
+            self.start_analyzer(vm)
             try:
                 vm.wait_for_migration(self.migration_timeout)
                 logging.info("Migration completed with auto-converge on")
@@ -376,9 +314,12 @@ def run(test, params, env):
                             "auto-converge off"
                         )
             finally:
+                self.stop_analyzer()
                 if self.session:
                     self.session.close()
                 vm.destroy(gracefully=False)
+            if set_auto_converge == "yes":
+                self.check_mig_cpu_throttling_percentage()
 
         @error.context_aware
         def post_migration_capability_load_host(
@@ -408,8 +349,7 @@ def run(test, params, env):
             :param mig_data: Data for migration
             """
 
-            mig_thread = utils.InterruptedThread(self.get_sar_output)
-            mig_thread.start()
+            self.start_analyzer(vm)
             try:
                 vm.wait_for_migration(self.migration_timeout)
                 logging.info("Migration completed with auto-converge on")
@@ -431,10 +371,10 @@ def run(test, params, env):
                             "auto-converge off"
                         )
             finally:
+                self.stop_analyzer()
                 if self.session:
                     self.session.close()
                 vm.destroy(gracefully=False)
-                mig_thread.join()
 
         @error.context_aware
         def post_migration_capability_load_host_io(
@@ -464,8 +404,7 @@ def run(test, params, env):
             :param mig_data: Data for migration
             """
 
-            mig_thread = utils.InterruptedThread(self.get_sar_output)
-            mig_thread.start()
+            self.start_analyzer(vm)
             try:
                 vm.wait_for_migration(self.migration_timeout)
                 logging.info(
@@ -477,10 +416,10 @@ def run(test, params, env):
                     "Migration failed with set auto-converge" ": %s" % set_auto_converge
                 )
             finally:
+                self.stop_analyzer()
                 if self.session:
                     self.session.close()
                 vm.destroy(gracefully=False)
-                mig_thread.join()
 
         @error.context_aware
         def migration_scenario(self):
@@ -496,7 +435,7 @@ def run(test, params, env):
                 """
 
                 if self.need_stress:
-                    self.start_stress(sar_cmd_in_guest)
+                    self.start_stress()
                 else:
                     logging.info("No need to start stress test")
 
@@ -523,21 +462,10 @@ def run(test, params, env):
             )
 
     set_auto_converge_list = params.objects("need_set_auto_converge")
-    sar_log_name = params.get("sar_log_name", "")
-    sar_cmd_in_guest = params.get("sar_cmd_in_guest", "")
-    sar_cpu_str = params.get("sar_cpu_str", "")
-    sar_memory_str = params.get("sar_memory_str", "")
-    sar_output = []
-    cpu_throttling_percentage_list = []
+    analyzer_interval = float(params.get("auto_converge_sample_interval", 1))
+    reports = []
     for set_auto_converge in set_auto_converge_list:
-        if sar_log_name:
-            sar_log_index = str(set_auto_converge_list.index(set_auto_converge))
-            tmp_sar_log_name = sar_log_name
-            sar_log_name += sar_log_index
-            sar_cmd_in_guest = sar_cmd_in_guest.replace(tmp_sar_log_name, sar_log_name)
-            get_sar_output_cmd = params.get("get_sar_output_cmd", "tail -n 200 %s")
-            get_sar_output_cmd %= sar_log_name
         mig = TestMultihostMigration(test, params, env)
         mig.run()
-    if len(sar_output) == 4:
-        mig.check_sar_output()
+    if len(reports) == 2 and mig.sub_type != "before_migrate_capability":
+        mig.check_guest_performance()
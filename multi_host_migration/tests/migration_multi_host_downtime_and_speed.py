@@ -4,6 +4,8 @@ from autotest.client.shared import error, utils
 from virttest import qemu_migration, utils_misc, utils_test, virt_vm
 from virttest.utils_test.qemu import migration
 
+from provider.migration_telemetry import MigrationSampler
+
 
 @error.context_aware
 def run(test, params, env):
@@ -48,6 +50,8 @@ def run(test, params, env):
             self.max_speed = self.params.get("max_migration_speed", "1000")
             self.ch_speed = int(self.params.get("change_speed_interval", 1))
             speed_count = float(self.params.get("count_of_change", 5))
+            self.sample_interval = float(self.params.get("mig_sample_interval", 1))
+            self.sampler = None
 
             self.min_speed = utils.convert_data_size(self.min_speed, "M")
             self.max_speed = utils.convert_data_size(self.max_speed, "M")
@@ -73,10 +77,25 @@ def run(test, params, env):
             session.sendline(kill_bg_stress_cmd)
             session.close()
 
+        def start_sampler(self, vm):
+            self.sampler = MigrationSampler(vm, self.sample_interval)
+            self.sampler.start()
+
+        def stop_sampler(self):
+            """Wait for the final sample of migration and log the summary"""
+            if self.sampler.join(self.sample_interval * 2):
+                self.sampler.log_summary()
+            else:
+                self.sampler.stop()
+
         @error.context_aware
         def check_mig_downtime(self, vm):
             logging.info("Check downtime after migration.")
-            actual_downtime = int(vm.monitor.info("migrate").get("downtime"))
+            downtime = self.sampler.series("downtime", active_only=False)
+            if downtime:
+                actual_downtime = int(downtime[-1][1])
+            else:
+                actual_downtime = int(vm.monitor.info("migrate").get("downtime"))
             if actual_downtime > self.mig_downtime * 1000:
                 error = "Migration failed for setting downtime, "
                 error += "Expected: '%d', Actual: '%d'" % (
@@ -104,6 +123,7 @@ def run(test, params, env):
             fd,
             mig_data,
         ):
+            self.start_sampler(vm)
             try:
                 vm.wait_for_migration(self.mig_timeout)
             except virt_vm.VMMigrateTimeoutError:
@@ -111,6 +131,7 @@ def run(test, params, env):
                     "Migration failed with setting "
                     " downtime to %ds." % self.mig_downtime
                 )
+            self.stop_sampler()
 
             logging.info(
                 "Migration completed with downtime " "is %s seconds.", self.mig_downtime
@@ -131,6 +152,7 @@ def run(test, params, env):
             fd,
             mig_data,
         ):
+            self.start_sampler(vm)
             logging.info("Set downtime after migration.")
             downtime = 0
             for downtime in range(1, self.max_downtime):
@@ -147,6 +169,7 @@ def run(test, params, env):
                 raise error.TestFail(
                     "Migration failed with setting " " downtime to %ds." % downtime
                 )
+            self.stop_sampler()
 
             self.mig_downtime = downtime - 1
             logging.info(
@@ -167,6 +190,7 @@ def run(test, params, env):
             fd,
             mig_data,
         ):
+            self.start_sampler(vm)
             mig_speed = None
 
             for mig_speed in range(self.min_speed, self.max_speed, self.speed_step):
@@ -184,6 +208,7 @@ def run(test, params, env):
                 raise error.TestFail(
                     "Migration failed with setting " " mig_speed to %sB." % mig_speed
                 )
+            self.stop_sampler()
 
             logging.debug("Migration passed with mig_speed %sB", mig_speed)
             vm.destroy(gracefully=False)
@@ -199,6 +224,7 @@ def run(test, params, env):
             fd,
             mig_data,
         ):
+            self.start_sampler(vm)
             wait_before_mig = int(vm.params.get("wait_before_stop", "5"))
 
             try:
@@ -210,6 +236,7 @@ def run(test, params, env):
                 vm.wait_for_migration(self.mig_timeout)
             except virt_vm.VMMigrateTimeoutError:
                 raise error.TestFail("Migration failed when vm is paused.")
+            self.stop_sampler()
 
         def migration_scenario(self, worker=None):
             @error.context_aware
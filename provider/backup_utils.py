@@ -1,7 +1,13 @@
 import json
+import logging
 import math
 import random
 import re
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 
 from avocado import fail_on
 from avocado.utils import process
@@ -19,8 +25,13 @@ from provider import block_dirty_bitmap as block_bitmap
 from provider import job_utils
 from provider.virt_storage.storage_admin import sp_admin
 
+LOG_JOB = logging.getLogger("avocado.test")
+
 BACKING_MASK_PROTOCOL_VERSION_SCOPE = "[9.0.0, )"
 
+_SESSION_POOLS = weakref.WeakKeyDictionary()
+_SESSION_POOLS_LOCK = threading.Lock()
+
 
 def set_default_block_job_options(obj, arguments):
     """
@@ -95,10 +106,129 @@ def copy_out_dict_if_exists(params_in, keys):
     return params_out
 
 
+class GuestSessionPool(object):
+    """
+    Pool of the guest shell sessions of a VM
+
+    Sessions are health checked when handed out and reused by the data
+    operations instead of logging in to the guest for each of them.
+    """
+
+    def __init__(self, vm, max_idle=4):
+        """
+        :param vm: VM object
+        :param max_idle: max number of the idle sessions kept in the pool
+        """
+        self._vm = vm
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_healthy(session):
+        try:
+            return session.is_alive() and session.is_responsive()
+        except Exception:
+            return False
+
+    def acquire(self, timeout=360):
+        """
+        Get a healthy session from the pool, log in if there is no one
+
+        :param timeout: login timeout
+        :return: ShellSession object
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session = self._idle.pop()
+            if self._is_healthy(session):
+                return session
+            session.close()
+        return self._vm.wait_for_login(timeout=timeout)
+
+    def release(self, session):
+        """Return a session to the pool"""
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(session)
+                return
+        session.close()
+
+    @contextmanager
+    def session(self, timeout=360):
+        """
+        Context manager of a pooled session, the session is closed instead
+        of returned to the pool if any error raised with it
+        """
+        session = self.acquire(timeout)
+        try:
+            yield session
+        except Exception:
+            session.close()
+            raise
+        self.release(session)
+
+    def close(self):
+        """Close all the idle sessions"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
+def get_session_pool(vm):
+    """
+    Get the guest session pool of a VM, create one if not exists
+
+    The caller which creates the pool owns it and must close it by
+    close_session_pool before the VM is destroyed, e.g. BlockdevBaseTest
+    does it in destroy_vms, otherwise the idle sessions are left open.
+
+    :param vm: VM object
+    :return: GuestSessionPool object
+    """
+    with _SESSION_POOLS_LOCK:
+        if vm not in _SESSION_POOLS:
+            _SESSION_POOLS[vm] = GuestSessionPool(vm)
+        return _SESSION_POOLS[vm]
+
+
+def close_session_pool(vm):
+    """Close the idle sessions in the pool of a VM and drop the pool"""
+    with _SESSION_POOLS_LOCK:
+        pool = _SESSION_POOLS.pop(vm, None)
+    if pool is not None:
+        pool.close()
+
+
+@contextmanager
+def guest_session(vm, timeout=360):
+    """
+    Context manager of a guest session, the session is from the pool of the
+    VM if the pool is created by its owner, otherwise it is a new login and
+    closed on exit, so no idle session is left by the callers without a pool
+
+    :param vm: VM object
+    :param timeout: login timeout
+    """
+    with _SESSION_POOLS_LOCK:
+        pool = _SESSION_POOLS.get(vm)
+    if pool is not None:
+        with pool.session(timeout) as session:
+            yield session
+        return
+    session = vm.wait_for_login(timeout=timeout)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
 @fail_on
 def generate_tempfile(vm, root_dir, filename, size="10M", timeout=720):
     """Generate temp data file in VM"""
-    session = vm.wait_for_login()
     if vm.params["os_type"] == "windows":
         file_path = "%s\\%s" % (root_dir, filename)
         mk_file_cmd = "fsutil file createnew %s %s" % (file_path, size)
@@ -113,11 +243,9 @@ def generate_tempfile(vm, root_dir, filename, size="10M", timeout=720):
         )
         mk_file_cmd = dd_cmd % (file_path, count)
         md5_cmd = "md5sum %s > %s.md5 && sync" % (file_path, file_path)
-    try:
+    with guest_session(vm) as session:
         session.cmd(mk_file_cmd, timeout=timeout)
         session.cmd(md5_cmd, timeout=timeout)
-    finally:
-        session.close()
 
 
 @fail_on
@@ -131,8 +259,7 @@ def verify_file_md5(vm, root_dir, filename, timeout=720):
         md5_cmd = "md5sum %s" % file_path
         cat_cmd = "cat %s.md5" % file_path
 
-    session = vm.wait_for_login()
-    try:
+    with guest_session(vm) as session:
         status1, output1 = session.cmd_status_output(md5_cmd, timeout=timeout)
         now = output1.strip()
         assert status1 == 0, "Get file ('%s') MD5 with error: %s" % (filename, output1)
@@ -147,8 +274,36 @@ def verify_file_md5(vm, root_dir, filename, timeout=720):
             now,
             saved,
         )
-    finally:
-        session.close()
+
+
+@fail_on
+def verify_files_md5(vm, files, timeout=720):
+    """
+    Verify MD5 of files generated by generate_tempfile
+
+    On Linux guests the files are hashed in parallel by one guest command,
+    at most 'verify_md5_workers' (4 by default) md5sum run at the same time,
+    on Windows guests they are verified one by one.
+
+    :param vm: VM object
+    :param files: list of (root_dir, filename)
+    :param timeout: timeout of the verification
+    """
+    if vm.params["os_type"] == "windows":
+        for root_dir, filename in files:
+            verify_file_md5(vm, root_dir, filename, timeout)
+        return
+    if not files:
+        return
+
+    md5_files = " ".join("%s/%s.md5" % f for f in files)
+    md5_cmd = "printf '%%s\\n' %s | xargs -P %d -n 1 md5sum -c" % (
+        md5_files,
+        min(int(vm.params.get("verify_md5_workers", 4)), len(files)),
+    )
+    with guest_session(vm) as session:
+        status, output = session.cmd_status_output(md5_cmd, timeout=timeout)
+    assert status == 0, "File's MD5 is mismatch or not readable: %s" % output
 
 
 def blockdev_snapshot_qmp_cmd(source, target, **extra_options):
@@ -489,28 +644,68 @@ def format_storage_volume(img, filesystem, partition="mbr"):
         process.system("setenforce %s" % selinux_mode, shell=True)
 
 
+def _coalesce_extents(extents, state, chunk_len):
+    """
+    Merge the adjacent extents reported by 'qemu-img map' with the expected
+    data state and split the merged ones into chunks
+
+    :param extents: extent list from 'qemu-img map --output=json'
+    :param state: the expected value of 'data' of extents
+    :param chunk_len: max length of a chunk
+    :return: generator of (start, length)
+    """
+    merged = []
+    for item in extents:
+        if item["data"] is not state or item["length"] <= 0:
+            continue
+        if merged and sum(merged[-1]) == item["start"]:
+            merged[-1][1] += item["length"]
+        else:
+            merged.append([item["start"], item["length"]])
+
+    for start, length in merged:
+        while length > 0:
+            yield start, min(length, chunk_len)
+            start, length = start + chunk_len, length - chunk_len
+
+
+@fail_on
 def copyif(params, nbd_image, target_image, bitmap=None):
     """
     Python implementation of copyif3.sh
+
+    All extents are copied by copy-on-read with one qemu-io process, which
+    opens the target image (backed by the nbd image) only once and keeps
+    up to 'copyif_io_depth' aio_read requests in flight.
+
     :params params: utils_params.Params object
     :params nbd_image: nbd image tag
     :params target_image: target image tag
     :params bitmap: bitmap name
+    :return: copied bytes per second
     """
-
-    def _qemu_io_read(qemu_io, s, l, img):
-        cmd = '{io} -C -c "r {s} {l}" -f {fmt} {f}'.format(
-            io=qemu_io, s=s, l=l, fmt=img.image_format, f=img.image_filename
-        )
-        process.system(cmd, ignore_status=False, shell=True)
-
     qemu_io = utils_misc.get_qemu_io_binary(params)
     qemu_img = utils_misc.get_qemu_img_binary(params)
     img_obj = qemu_storage.QemuImg(
         params.object_params(target_image), data_dir.get_data_dir(), target_image
     )
     nbd_img_obj = qemu_storage.QemuImg(params.object_params(nbd_image), None, nbd_image)
+    # qemu-io can only handle length less than 2147483136,
+    # so here we need to split 'large length' into several parts
     max_len = int(params.get("qemu_io_max_len", 2147483136))
+    chunk_len = min(
+        max_len,
+        int(
+            float(
+                utils_numeric.normalize_data_size(
+                    params.get("copyif_chunk_size", "16M"),
+                    order_magnitude="B",
+                    factor=1024,
+                )
+            )
+        ),
+    )
+    io_depth = int(params.get("copyif_io_depth", 16))
 
     if bitmap is None:
         args = "-f %s %s" % (nbd_img_obj.image_format, nbd_img_obj.image_filename)
@@ -529,24 +724,47 @@ def copyif(params, nbd_image, target_image, bitmap=None):
 
     map_cmd = "{qemu_img} map --output=json {args}".format(qemu_img=qemu_img, args=args)
     result = process.run(map_cmd, ignore_status=False, shell=True)
-
-    for item in json.loads(result.stdout.decode().strip()):
-        if item["data"] is not state:
-            continue
-
-        # qemu-io can only handle length less than 2147483136,
-        # so here we need to split 'large length' into several parts
-        start, length = item["start"], item["length"]
-        while length > max_len:
-            _qemu_io_read(qemu_io, start, max_len, img_obj)
-            start, length = start + max_len, length - max_len
-        else:
-            if length > 0:
-                _qemu_io_read(qemu_io, start, length, img_obj)
+    extents = json.loads(result.stdout.decode().strip())
+
+    copied = 0
+    with tempfile.NamedTemporaryFile(
+        "w", prefix="copyif_", dir=data_dir.get_tmp_dir()
+    ) as cmd_file:
+        for i, (start, length) in enumerate(
+            _coalesce_extents(extents, state, chunk_len), 1
+        ):
+            cmd_file.write("aio_read -q %s %s\n" % (start, length))
+            copied += length
+            if i % io_depth == 0:
+                cmd_file.write("aio_flush\n")
+        cmd_file.write("aio_flush\nquit\n")
+        cmd_file.flush()
+
+        io_cmd = "{io} -C -f {fmt} {f} < {cmds}".format(
+            io=qemu_io,
+            fmt=img_obj.image_format,
+            f=img_obj.image_filename,
+            cmds=cmd_file.name,
+        )
+        start_time = time.time()
+        result = process.run(io_cmd, ignore_status=False, shell=True)
+        elapsed = time.time() - start_time
+    output = result.stdout_text + result.stderr_text
+    assert "failed" not in output, "Failed to copy data by qemu-io: %s" % output
 
     img_obj.base_tag = "null"
     img_obj.rebase(img_obj.params)
 
+    rate = copied / elapsed if elapsed else 0
+    LOG_JOB.info(
+        "copyif copied %s bytes from %s in %.2fs (%.0f bytes/s)",
+        copied,
+        nbd_image,
+        elapsed,
+        rate,
+    )
+    return rate
+
 
 def get_disk_info_by_param(tag, params, session):
     """
@@ -10,18 +10,19 @@ Available methods:
 - unplug_devs_serial: Unplug the block devices by serial.
 - hotplug_devs_threaded: Hot plug the block devices by threaded.
 - unplug_devs_threaded: Unplug the block devices by threaded.
+- hotplug_devs_grouped: Hot plug the groups of block devices by threaded.
 
 """
 
 import logging
-import multiprocessing
+import queue
 import sys
 import threading
 import time
+import weakref
 
 from avocado import TestError
 from six import reraise
-from six.moves import xrange
 from virttest import utils_misc
 from virttest.qemu_capabilities import Flags
 from virttest.qemu_devices import qdevices
@@ -32,6 +33,8 @@ from virttest.qemu_devices.utils import (
 )
 from virttest.qemu_monitor import MonitorLockError
 
+from provider.backup_utils import guest_session
+
 LOG_JOB = logging.getLogger("avocado.test")
 
 HOTPLUG, UNPLUG = ("hotplug", "unplug")
@@ -40,8 +43,91 @@ DELETED_EVENT = "DEVICE_DELETED"
 DISK = {"name": "images", "media": "disk"}
 CDROM = {"name": "cdroms", "media": "cdrom"}
 
+# Guard the devices representation of VM and the QMP outputs
 _LOCK = threading.Lock()
 _QMP_OUTPUT = {}
+_SUBSCRIPTIONS = weakref.WeakKeyDictionary()
+_SUBSCRIPTIONS_LOCK = threading.Lock()
+
+# Count the block devices except the virtual and cdrom ones in linux guest
+_LINUX_DISKS_COUNT = "ls /sys/block | grep -cvE '^(loop|ram|zram|dm-|md|sr)'"
+_LINUX_WAIT_DISKS = (
+    "for i in $(seq %d); do [ $(%s) -eq %d ] && exit 0; "
+    "inotifywait -qq -t 1 -e create,delete /dev 2>/dev/null || sleep 1; "
+    "done; exit 1"
+)
+# Seconds to wait for the number of disks in linux guest, the disks are
+# checked by listing them if it does not match in time
+_LINUX_WAIT_DISKS_TIMEOUT = 30
+
+
+class _DeletedEventSubscription(object):
+    """
+    Subscription of the DEVICE_DELETED events of a VM, the events are
+    consumed from the monitor once and shared by all the plug threads.
+    """
+
+    def __init__(self, vm, step=0.1):
+        self._vm = vm
+        self._step = step
+        self._deleted = set()
+        self._cond = threading.Condition()
+
+    def _collect(self):
+        """Record the DEVICE_DELETED events and remove them from the monitor"""
+        monitor = self._vm.monitor
+        if not monitor._acquire_lock():
+            raise MonitorLockError(
+                "Could not acquire exclusive lock to read QMP events"
+            )
+        try:
+            events = [
+                e for e in monitor.get_events() if e.get("event") == DELETED_EVENT
+            ]
+            consumed = set(id(e) for e in events)
+            monitor._events[:] = [e for e in monitor._events if id(e) not in consumed]
+        finally:
+            monitor._lock.release()
+        for event in events:
+            device = event.get("data", {}).get("device")
+            if device:
+                self._deleted.add(device)
+
+    def subscribe(self, devices):
+        """
+        Subscribe the events of devices before unplugging them, the stale
+        events of the devices are dropped.
+
+        :param devices: list of the device IDs
+        """
+        with self._cond:
+            self._collect()
+            self._deleted.difference_update(devices)
+
+    def wait(self, devices, timeout):
+        """
+        Wait the events of devices.
+
+        :param devices: list of the device IDs
+        :param timeout: timeout in seconds
+        :return: set of the devices without event
+        """
+        end = time.time() + timeout
+        with self._cond:
+            while True:
+                self._collect()
+                pending = set(devices) - self._deleted
+                if not pending or time.time() >= end:
+                    return pending
+                self._cond.wait(self._step)
+
+
+def _get_deleted_subscription(vm):
+    """Get the DEVICE_DELETED events subscription of a VM."""
+    with _SUBSCRIPTIONS_LOCK:
+        if vm not in _SUBSCRIPTIONS:
+            _SUBSCRIPTIONS[vm] = _DeletedEventSubscription(vm)
+        return _SUBSCRIPTIONS[vm]
 
 
 def _verify_plugged_num(action):
@@ -51,16 +137,30 @@ def _verify_plugged_num(action):
 
     def decorator(func):
         def wrapper(self, *args, **kwargs):
-            orig_disks = self._list_all_disks()
+            # One guest session is used by all the checks of the batch
+            with guest_session(self.vm) as session:
+                return _verify(self, session, *args, **kwargs)
+
+        def _verify(self, session, *args, **kwargs):
+            orig_disks = self._list_all_disks(session)
+            orig_count = self._disks_count
             LOG_JOB.debug("The index of disks before %s:\n %s", action, orig_disks)
             result = func(self, *args, **kwargs)
             if self._dev_type != CDROM:
                 for dev in HOTPLUGGED_HBAS.values():
                     if dev.get_param("hotplug") == "off":
                         return result
+                timeout = self._timeout
+                if orig_count is not None:
+                    changed = len(self._imgs) if action == HOTPLUG else -len(self._imgs)
+                    start = time.time()
+                    if not self._wait_guest_disks(orig_count + changed, session):
+                        # fall back to polling the list of disks
+                        timeout = max(self._timeout - (time.time() - start), 0)
                 if not utils_misc.wait_for(
-                    lambda: len(self._imgs) == len(self._list_all_disks() ^ orig_disks),
-                    self._timeout,
+                    lambda: len(self._imgs)
+                    == len(self._list_all_disks(session) ^ orig_disks),
+                    timeout,
                     step=1.5,
                 ):
                     disks_info_win = (
@@ -68,12 +168,10 @@ def _verify_plugged_num(action):
                         "& wmic diskdrive list brief /format:list"
                     )
                     disks_info_linux = "lsblk -a"
-                    _session = self.vm.wait_for_login(timeout=360)
-                    disks_info = _session.cmd(
+                    disks_info = session.cmd(
                         disks_info_win if self._iswindows else disks_info_linux
                     )
                     LOG_JOB.debug("The details of disks:\n %s", disks_info)
-                    _session.close()
                     raise TestError(
                         "%s--> Actual: %s disks. Expected: %s disks."
                         % (action, len(self._all_disks ^ orig_disks), len(self._imgs))
@@ -90,34 +188,41 @@ def _verify_plugged_num(action):
 
 class _PlugThread(threading.Thread):
     """
-    Plug Thread that define a plug thread.
+    Plug Thread that takes the plug items from the shared queue, an item is
+    a tuple of images which are plugged in order and their bus.
     """
 
-    def __init__(self, vm, action, images, monitor, exit_event, bus=None, interval=0):
+    def __init__(self, vm, action, items, monitor, exit_event, interval=0):
         threading.Thread.__init__(self)
         self._action = action
-        self._images = images
+        self._items = items
         self._monitor = monitor
-        self._bus = bus
         self._interval = interval
         self._plug_manager = BlockDevicesPlug(vm)
         self.exit_event = exit_event
         self.exc_info = None
 
     def run(self):
-        try:
-            args = (self._images, self._monitor, self._interval)
-            if self._action == HOTPLUG:
-                bus = self._bus if self._bus else None
-                args = (self._images, self._monitor, bus, self._interval)
-            method = "_hotplug_devs" if self._action == HOTPLUG else "_unplug_devs"
-            getattr(self._plug_manager, method)(*args)
-        except Exception as e:
-            LOG_JOB.error(
-                "%s %s failed: %s", self._action.capitalize(), self._images, str(e)
-            )
-            self.exc_info = sys.exc_info()
-            self.exit_event.set()
+        while not self.exit_event.is_set():
+            try:
+                images, bus = self._items.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if self._action == HOTPLUG:
+                    self._plug_manager._hotplug_devs(
+                        images, self._monitor, bus, self._interval
+                    )
+                else:
+                    self._plug_manager._unplug_devs(
+                        images, self._monitor, self._interval
+                    )
+            except Exception as e:
+                LOG_JOB.error(
+                    "%s %s failed: %s", self._action.capitalize(), images, str(e)
+                )
+                self.exc_info = sys.exc_info()
+                self.exit_event.set()
 
 
 class _ThreadManager(object):
@@ -129,21 +234,19 @@ class _ThreadManager(object):
         self._vm = vm
         self._threads = []
         self.exit_event = threading.Event()
-
-    def _initial_threads(self, action, imgs, bus=None, interval=0):
-        """Initial the threads."""
-        max_threads = min(len(imgs), 2 * multiprocessing.cpu_count())
-        for i in xrange(max_threads):
-            mon = self._vm.monitors[i % len(self._vm.monitors)]
-            args = (
-                self._vm,
-                action,
-                imgs[i::max_threads],
-                mon,
-                self.exit_event,
-                bus,
-                interval,
-            )
+        # The max number of the in-flight plug items of each monitor
+        self._window = int(vm.params.get("plug_inflight_window", 4))
+
+    def _initial_threads(self, action, items, interval=0):
+        """Initial the threads, each monitor has a window of threads."""
+        plug_items = queue.Queue()
+        for item in items:
+            plug_items.put(item)
+        monitors = self._vm.monitors
+        max_threads = min(len(items), self._window * len(monitors))
+        for i in range(max_threads):
+            mon = monitors[i % len(monitors)]
+            args = (self._vm, action, plug_items, mon, self.exit_event, interval)
             self._threads.append(_PlugThread(*args))
 
     def _start_threads(self):
@@ -156,9 +259,9 @@ class _ThreadManager(object):
         for thread in self._threads:
             thread.join(timeout)
 
-    def run_threads(self, action, imgs, bus, timeout, interval=0):
+    def run_threads(self, action, items, timeout, interval=0):
         """Run the threads."""
-        self._initial_threads(action, imgs, bus, interval)
+        self._initial_threads(action, items, interval)
         self._start_threads()
         self._join_threads(timeout)
 
@@ -202,6 +305,7 @@ class BlockDevicesPlug(object):
         self._timeout = 300
         self._interval = 0
         self._qemu_version = self.vm.devices.qemu_version
+        self._disks_count = None
 
     def __getitem__(self, index):
         """Get the hot plugged disk index."""
@@ -216,16 +320,35 @@ class BlockDevicesPlug(object):
         for disk in self._plugged_disks:
             yield disk
 
-    def _list_all_disks(self):
-        """List all the disks."""
-        session = self.vm.wait_for_login(timeout=360)
+    def _list_all_disks(self, session):
+        """
+        List all the disks.
+
+        :param session: guest session
+        """
         if self._islinux:
             self._all_disks = utils_misc.list_linux_guest_disks(session)
+            self._disks_count = int(session.cmd_output(_LINUX_DISKS_COUNT))
         else:
             self._all_disks = set(session.cmd("wmic diskdrive get index").split()[1:])
-        session.close()
         return self._all_disks
 
+    def _wait_guest_disks(self, count, session):
+        """
+        Wait in linux guest until the number of disks is count, the guest
+        checks it when devices are created or deleted.
+
+        :param count: the expected number of disks
+        :param session: guest session
+        :return: True if the number of disks is count in time
+        """
+        timeout = min(self._timeout, _LINUX_WAIT_DISKS_TIMEOUT)
+        cmd = _LINUX_WAIT_DISKS % (timeout, _LINUX_DISKS_COUNT, count)
+        status = session.cmd_status(cmd, timeout=timeout + 30)
+        if status:
+            LOG_JOB.warning("The number of disks in guest is not %s", count)
+        return not status
+
     def _check_qmp_outputs(self, action):
         """Check the output of qmp commands."""
         for dev_id in list(_QMP_OUTPUT.keys()):
@@ -238,22 +361,13 @@ class BlockDevicesPlug(object):
                     err += output[0]
                 raise TestError(err)
 
-    def _get_events_deleted(self):
-        """Get the device deleted events."""
-        self.event_devs = [img for img in self._unplugged_devs.keys()]
-        for event in self.vm.monitor.get_events():
-            if DELETED_EVENT in event.get("event") and "device" in event.get("data"):
-                name = event.get("data")["device"]
-                if name in self.event_devs:
-                    self.event_devs.remove(name)
-        self.vm.monitor.clear_event(DELETED_EVENT)
-        return not self.event_devs
-
     def _wait_events_deleted(self, timeout=300):
         """
         Wait the events "DEVICE DELETED" to be generated after unplug device.
         """
-        if not utils_misc.wait_for(self._get_events_deleted, timeout):
+        subscription = _get_deleted_subscription(self.vm)
+        self.event_devs = sorted(subscription.wait(self._imgs, timeout))
+        if self.event_devs:
             raise TestError(
                 'No "DEVICE DELETED" event generated after unplug "%s".'
                 % (";".join(self.event_devs))
@@ -266,9 +380,10 @@ class BlockDevicesPlug(object):
             bus_name = None
             self._hotplugged_devs[img] = []
             img_params = self.vm.params.object_params(img)
-            devices_created = getattr(
-                self.vm.devices, "%s_define_by_params" % self._dev_type["name"]
-            )(img, img_params, self._dev_type["media"], pci_bus=pci_bus)
+            with _LOCK:
+                devices_created = getattr(
+                    self.vm.devices, "%s_define_by_params" % self._dev_type["name"]
+                )(img, img_params, self._dev_type["media"], pci_bus=pci_bus)
 
             for dev in reversed(devices_created):
                 qid = dev.get_qid()
@@ -308,6 +423,34 @@ class BlockDevicesPlug(object):
 
     def _hotplug_atomic(self, device, monitor, bus=None):
         """Function hot plug device to devices representation."""
+        with _LOCK:
+            qdev_out = self._prepare_hotplug(device, bus)
+
+        out = self._plug(device.hotplug, monitor, HOTPLUG)
+        ver_out = device.verify_hotplug(out, monitor)
+        with _LOCK:
+            if ver_out is False:
+                self.vm.devices.set_clean()
+                return out, ver_out
+
+            try:
+                if device not in self.vm.devices:
+                    qdev_out = self.vm.devices.insert(device)
+                if not isinstance(qdev_out, list) or len(qdev_out) != 1:
+                    raise NotImplementedError(
+                        "This device %s require to hotplug multiple devices %s, "
+                        "which is not supported." % (device, out)
+                    )
+                if ver_out is True:
+                    self.vm.devices.set_clean()
+            except DeviceError as exc:
+                raise DeviceHotplugError(
+                    device, "According to qemu_device: %s" % exc, self, ver_out
+                )
+        return out, ver_out
+
+    def _prepare_hotplug(self, device, bus=None):
+        """Insert the device into the bus of devices representation."""
         self.vm.devices.set_dirty()
 
         qdev_out = ""
@@ -334,45 +477,36 @@ class BlockDevicesPlug(object):
             if bus is not None:
                 bus.prepare_hotplug(device)
                 qdev_out = self.vm.devices.insert(device)
-
-        out = self._plug(device.hotplug, monitor, HOTPLUG)
-        ver_out = device.verify_hotplug(out, monitor)
-        if ver_out is False:
-            self.vm.devices.set_clean()
-            return out, ver_out
-
-        try:
-            if device not in self.vm.devices:
-                qdev_out = self.vm.devices.insert(device)
-            if not isinstance(qdev_out, list) or len(qdev_out) != 1:
-                raise NotImplementedError(
-                    "This device %s require to hotplug multiple devices %s, "
-                    "which is not supported." % (device, out)
-                )
-            if ver_out is True:
-                self.vm.devices.set_clean()
-        except DeviceError as exc:
-            raise DeviceHotplugError(
-                device, "According to qemu_device: %s" % exc, self, ver_out
-            )
-        return out, ver_out
+        return qdev_out
 
     def _unplug_atomic(self, device, monitor):
         """Function unplug device to devices representation."""
-        device = self.vm.devices[device]
-        self.vm.devices.set_dirty()
+        with _LOCK:
+            device = self.vm.devices[device]
+            self.vm.devices.set_dirty()
 
+        end = time.time() + self.VERIFY_UNPLUG_TIMEOUT
         out = self._plug(device.unplug, monitor, UNPLUG)
+        if isinstance(device, qdevices.QDevice):
+            _get_deleted_subscription(self.vm).wait(
+                [device.get_qid()], self.VERIFY_UNPLUG_TIMEOUT
+            )
         if not utils_misc.wait_for(
             lambda: device.verify_unplug(out, monitor) is True,
-            first=1,
-            step=5,
-            timeout=self.VERIFY_UNPLUG_TIMEOUT,
+            step=1,
+            timeout=max(end - time.time(), 1),
         ):
-            self.vm.devices.set_clean()
+            with _LOCK:
+                self.vm.devices.set_clean()
             return out, device.verify_unplug(out, monitor)
         ver_out = device.verify_unplug(out, monitor)
 
+        with _LOCK:
+            self._remove_unplugged(device, monitor, out, ver_out)
+        return out, ver_out
+
+    def _remove_unplugged(self, device, monitor, out, ver_out):
+        """Remove the unplugged device and its nodes from representation."""
         try:
             device.unplug_hook()
             drive = device.get_param("drive")
@@ -416,7 +550,6 @@ class BlockDevicesPlug(object):
         except (DeviceError, KeyError) as exc:
             device.unplug_unhook()
             raise DeviceUnplugError(device, exc, self)
-        return out, ver_out
 
     def _plug_devs(self, action, devices_dict, monitor, bus=None, interval=0):
         """Plug devices."""
@@ -429,11 +562,11 @@ class BlockDevicesPlug(object):
                     and self.vm.devices.is_pci_device(device["driver"])
                 ):
                     args += (bus,)
+                output = getattr(self, "_%s_atomic" % action)(*args)
                 with _LOCK:
-                    _QMP_OUTPUT[device.get_qid()] = getattr(
-                        self, "_%s_atomic" % action
-                    )(*args)
-                time.sleep(interval)
+                    _QMP_OUTPUT[device.get_qid()] = output
+                if interval:
+                    time.sleep(interval)
 
     def _hotplug_devs(self, images, monitor, bus=None, interval=0):
         """
@@ -453,11 +586,12 @@ class BlockDevicesPlug(object):
         Unplug the block devices which are defined by images.
         """
         self._unplugged_devs.clear()
-        devs = [
-            dev
-            for dev in self.vm.devices
-            if isinstance(dev, (qdevices.QDevice, qdevices.QObject))
-        ]
+        with _LOCK:
+            devs = [
+                dev
+                for dev in self.vm.devices
+                if isinstance(dev, (qdevices.QDevice, qdevices.QObject))
+            ]
         for img in images:
             self._unplugged_devs[img] = []
             for dev in devs:
@@ -489,20 +623,27 @@ class BlockDevicesPlug(object):
             " ".join(images),
             monitor.name,
         )
+        _get_deleted_subscription(self.vm).subscribe(
+            [dev.get_qid() for devs in self._unplugged_devs.values() for dev in devs]
+        )
         self._plug_devs(UNPLUG, self._unplugged_devs, monitor, interval=interval)
 
-    def _plug_devs_threads(self, action, images, bus, timeout, interval=0):
-        """Threads that plug blocks devices."""
-        self._orig_disks = self._list_all_disks()
-        if images:
-            self._imgs = images.split()
+    def _plug_items_threads(self, action, items, timeout, interval=0):
+        """Threads that plug the items of block devices."""
         th_mgr = _ThreadManager(self.vm)
-        th_mgr.run_threads(action, self._imgs, bus, timeout, interval=interval)
+        th_mgr.run_threads(action, items, timeout, interval=interval)
         if th_mgr.exit_event.is_set():
             th_mgr.raise_threads()
         th_mgr.clean_threads()
         LOG_JOB.info("All %s threads finished.", action)
 
+    def _plug_devs_threads(self, action, images, bus, timeout, interval=0):
+        """Threads that plug blocks devices."""
+        if images:
+            self._imgs = images.split()
+        items = [([img], bus) for img in self._imgs]
+        self._plug_items_threads(action, items, timeout, interval)
+
     @_verify_plugged_num(action=HOTPLUG)
     def hotplug_devs_serial(
         self, images=None, monitor=None, bus=None, timeout=300, interval=0
@@ -556,7 +697,7 @@ class BlockDevicesPlug(object):
         self._check_qmp_outputs(UNPLUG)
         self._wait_events_deleted(timeout)
 
-    @_verify_plugged_num(action=UNPLUG)
+    @_verify_plugged_num(action=HOTPLUG)
     def hotplug_devs_threaded(self, images=None, timeout=300, bus=None, interval=0):
         """
         Hot plug the block devices by threaded.
@@ -590,3 +731,23 @@ class BlockDevicesPlug(object):
         self._plug_devs_threads(UNPLUG, images, None, timeout, interval)
         self._check_qmp_outputs(UNPLUG)
         self._wait_events_deleted(timeout)
+
+    @_verify_plugged_num(action=HOTPLUG)
+    def hotplug_devs_grouped(self, groups, timeout=300, interval=0):
+        """
+        Hot plug the groups of block devices by threaded, the images of a
+        group are plugged in order, e.g. the functions of a multifunction
+        slot, and the groups are plugged concurrently.
+
+        :param groups: List of tuples of the image tags and the bus, e.g,
+                       [(["stg71", "stg72"], bus1), (["stg101"], bus2)].
+        :type groups: list
+        :param timeout: Timeout for hot plugging.
+        :type timeout: float
+        :param interval: Interval time for hot plugging.
+        :type interval: int
+        """
+        self._timeout = timeout
+        self._imgs = [img for images, _ in groups for img in images]
+        self._plug_items_threads(HOTPLUG, groups, timeout, interval)
+        self._check_qmp_outputs(HOTPLUG)
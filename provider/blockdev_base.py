@@ -1,4 +1,6 @@
 import logging
+import re
+from multiprocessing.pool import ThreadPool
 
 from avocado.core import exceptions
 from avocado.utils import memory
@@ -75,6 +77,8 @@ class BlockdevBaseTest(object):
         main_vm.create()
         main_vm.verify_alive()
         self.main_vm = main_vm
+        # the pool is closed in destroy_vms
+        backup_utils.get_session_pool(main_vm)
 
     def generate_data_file(self, tag, filename=None):
         """
@@ -108,33 +112,83 @@ class BlockdevBaseTest(object):
             self.format_data_disk(tag)
         self.generate_data_file(tag)
 
+    def _run_concurrently(self, func, args_list):
+        """
+        Run func with each item of args_list in a thread pool bounded by
+        'prepare_workers', the first error raised by func is re-raised
+
+        :param func: callable
+        :param args_list: list of argument tuples of func
+        """
+        workers = min(self.params.get_numeric("prepare_workers", 1), len(args_list))
+        if workers <= 1:
+            for args in args_list:
+                func(*args)
+            return
+
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(func, args) for args in args_list]
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        for result in results:
+            result.get()
+
+    def _check_disks_identifiable(self, tags):
+        """
+        Check the data disks can be found in guest concurrently, each one
+        needs a serial/wwn in 'blk_extra_params' or a unique size, since
+        the disks without serial/wwn are found in guest by their sizes
+
+        :param tags: list of image tags
+        """
+        sizes, by_size = {}, set()
+        for tag in tags:
+            if tag == "image1":
+                continue
+            params = self.params.object_params(tag)
+            sizes.setdefault(params["image_size"], []).append(tag)
+            if not re.search(r"(serial|wwn)=\w+", params.get("blk_extra_params", "")):
+                by_size.add(tag)
+        same_size = [
+            group for group in sizes.values() if len(group) > 1 and by_size & set(group)
+        ]
+        if same_size:
+            raise exceptions.TestError(
+                "Data disks %s have the same size without serial/wwn, they "
+                "can't be prepared concurrently with prepare_workers > 1" % same_size
+            )
+
     def prepare_data_disks(self):
         """
-        prepare all data disks
+        prepare all data disks, they are formatted and filled concurrently
+        if 'prepare_workers' > 1, which requires the data disks to have
+        serials/wwns or different sizes to be found in guest
         """
-        for tag in self.params.objects("source_images"):
-            self.prepare_data_disk(tag)
+        tags = self.params.objects("source_images")
+        if self.params.get_numeric("prepare_workers", 1) > 1:
+            self._check_disks_identifiable(tags)
+        self._run_concurrently(self.prepare_data_disk, [(tag,) for tag in tags])
 
     def verify_data_files(self):
         """
         Verify temp file's md5sum in all data disks
         """
-        session = self.clone_vm.wait_for_login()
-        try:
+        files = []
+        with backup_utils.guest_session(self.clone_vm) as session:
             backup_utils.refresh_mounts(self.disks_info, self.params, session)
             for tag, info in self.disks_info.items():
                 if tag != "image1":
                     LOG_JOB.debug("mount target disk in VM!")
                     utils_disk.mount(info[0], info[1], session=session)
-                for data_file in self.files_info[tag]:
-                    backup_utils.verify_file_md5(self.clone_vm, info[1], data_file)
-        finally:
-            session.close()
+                files.extend((info[1], f) for f in self.files_info[tag])
+        backup_utils.verify_files_md5(self.clone_vm, files)
 
     @error_context.context_aware
     def format_data_disk(self, tag):
-        session = self.main_vm.wait_for_login()
-        try:
+        with backup_utils.guest_session(self.main_vm) as session:
             info = backup_utils.get_disk_info_by_param(tag, self.params, session)
             if info is None:
                 raise exceptions.TestFail("disk not found in guest ...")
@@ -143,8 +197,6 @@ class BlockdevBaseTest(object):
                 session, info["kname"], info["size"]
             )[0]
             self.disks_info[tag] = [disk_path, mount_point]
-        finally:
-            session.close()
 
     @error_context.context_aware
     def add_target_data_disks(self):
@@ -174,6 +226,7 @@ class BlockdevBaseTest(object):
         Stop all VMs
         """
         for vm in self.env.get_all_vms():
+            backup_utils.close_session_pool(vm)
             if vm.is_alive():
                 vm.destroy()
 
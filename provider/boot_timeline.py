@@ -0,0 +1,215 @@
+"""
+Module for collecting the boot timeline of a VM.
+
+The markers of a boot are timestamped by the host monotonic clock from one
+continuous stream of the QMP monitor and the serial console, relative to the
+start of the QEMU process, so the boot time can be split into phases, e.g.
+QEMU startup, firmware, bootloader, kernel, userspace and login.
+
+Available classes:
+- BootTimeline: Collect the markers of one boot of a VM.
+
+Available methods:
+- parse_systemd_startup: Parse the systemd "Startup finished" line.
+- summarize_phases: Get the statistics of the phases of several boots.
+
+"""
+
+import re
+import threading
+
+from virttest import utils_misc
+
+from provider import perf_stats
+
+# The serial markers and their default patterns, the pattern of a marker can
+# be overridden by the param 'boot_marker_<name>'
+SERIAL_MARKERS = {
+    "firmware": r"SeaBIOS \(version|BdsDxe|SLOF",
+    "bootloader": r"GNU GRUB|Booting `|Loading Linux",
+    "kernel": r"Linux version",
+    "userspace": r"Startup finished in",
+    "login_prompt": r"login:\s*$",
+}
+
+_SYSTEMD_STARTUP = re.compile(r"Startup finished in (.*?)\.?$")
+_SYSTEMD_STAGE = re.compile(r"(.*?)\s*\((\w+(?: \w+)?)\)")
+_SYSTEMD_TIME = re.compile(r"(\d+(?:\.\d+)?)(min|ms|us|h|s)\b")
+_TIME_UNITS = {"h": 3600.0, "min": 60.0, "s": 1.0, "ms": 1e-3, "us": 1e-6}
+
+
+def parse_systemd_startup(line):
+    """
+    Parse the systemd "Startup finished" line, e.g.
+      Startup finished in 1.012s (kernel) + 2.345s (initrd) + 1min 3s (userspace)
+
+    :param line: a line of the serial console
+    :return: dict of the stage and its seconds, None if not matched
+    """
+    match = _SYSTEMD_STARTUP.search(line)
+    if not match:
+        return None
+    stages = {}
+    for part in match.group(1).split("+"):
+        stage = _SYSTEMD_STAGE.search(part)
+        if not stage:
+            continue
+        seconds = sum(
+            float(value) * _TIME_UNITS[unit]
+            for value, unit in _SYSTEMD_TIME.findall(stage.group(1))
+        )
+        stages[stage.group(2).replace(" ", "_")] = seconds
+    return stages
+
+
+class BootTimeline(object):
+    """
+    Collect the markers of one boot of a VM:
+
+    qmp_ready: the QMP monitor is connected
+    resume: the paused VM is resumed, i.e. the guest starts running
+    first_serial: the first output of the serial console
+    firmware/bootloader/kernel/userspace/login_prompt: the serial markers
+    login: the login via serial console succeeded
+    """
+
+    def __init__(self, vm, params):
+        """
+        :param vm: VM object
+        :param params: Params object or dict
+        """
+        self.vm = vm
+        self.patterns = dict(
+            (name, re.compile(params.get("boot_marker_%s" % name, pattern)))
+            for name, pattern in SERIAL_MARKERS.items()
+        )
+        self.markers = {}
+        self.systemd = {}
+        self._output = None
+
+    def mark(self, name):
+        """Timestamp a marker, only the first one of a name is kept"""
+        self.markers.setdefault(name, utils_misc.monotonic_time())
+
+    def create(self, timeout=60):
+        """
+        Create the VM paused, timestamp when its QMP monitor gets ready and
+        attach to its serial console
+
+        :param timeout: timeout to create the VM
+        """
+        params = self.vm.params.copy()
+        params["paused_after_start_vm"] = "yes"
+        stop = threading.Event()
+
+        def watch_monitor():
+            while not stop.wait(0.005):
+                if self.vm.monitors:
+                    self.mark("qmp_ready")
+                    return
+
+        watcher = threading.Thread(target=watch_monitor)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            self.vm.create(params=params, timeout=timeout)
+        finally:
+            stop.set()
+            watcher.join()
+        self._attach_serial()
+
+    def resume(self):
+        """Resume the VM, so the guest starts booting"""
+        self.mark("resume")
+        self.vm.resume()
+
+    def login(self, timeout):
+        """
+        Login via the serial console, the serial console is detached then
+
+        :param timeout: timeout to login
+        :return: the serial session
+        """
+        try:
+            session = self.vm.wait_for_serial_login(timeout=timeout)
+            self.mark("login")
+        finally:
+            self._detach_serial()
+        return session
+
+    def _attach_serial(self):
+        console = self.vm.serial_console
+        self._output = (console.output_func, console.output_params)
+        console.set_output_func(self._feed)
+        console.set_output_params(())
+
+    def _detach_serial(self):
+        if self._output is None:
+            return
+        console = self.vm.serial_console
+        console.set_output_func(self._output[0])
+        console.set_output_params(self._output[1])
+        self._output = None
+
+    def _feed(self, *args):
+        line = args[-1]
+        self.mark("first_serial")
+        for name, pattern in self.patterns.items():
+            if name not in self.markers and pattern.search(line):
+                self.mark(name)
+        if not self.systemd:
+            self.systemd = parse_systemd_startup(line) or {}
+        if self._output and self._output[0]:
+            output_func, output_params = self._output
+            output_func(*(tuple(output_params or ()) + (line,)))
+
+    def timeline(self):
+        """
+        Get the markers in the order of their time
+
+        :return: list of tuples of the marker and its seconds since the
+                 start of the QEMU process
+        """
+        start = self.vm.start_monotonic_time
+        return sorted(
+            ((name, stamp - start) for name, stamp in self.markers.items()),
+            key=lambda marker: marker[1],
+        )
+
+    def phases(self):
+        """
+        Get the phases between the consecutive markers, e.g. the phase
+        'kernel-userspace' is from the kernel banner to systemd startup, the
+        total is from the start of the QEMU process to the login, the stages
+        reported by systemd are prefixed by 'systemd_', the guest phase is
+        from the resume to the login, i.e. not including the QEMU startup
+
+        :return: dict of the phase and its seconds
+        """
+        timeline = [("start", 0.0)] + self.timeline()
+        phases = dict(
+            ("%s-%s" % (prev[0], curr[0]), curr[1] - prev[1])
+            for prev, curr in zip(timeline, timeline[1:])
+        )
+        phases["total"] = timeline[-1][1]
+        if "resume" in self.markers and "login" in self.markers:
+            phases["guest"] = self.markers["login"] - self.markers["resume"]
+        for stage, seconds in self.systemd.items():
+            phases["systemd_%s" % stage] = seconds
+        return phases
+
+
+def summarize_phases(boots):
+    """
+    Get the statistics of the phases of several boots
+
+    :param boots: list of the phases of each boot, see BootTimeline.phases
+    :return: dict of the phase and perf_stats.summarize of its seconds
+    """
+    samples = {}
+    for phases in boots:
+        for phase, seconds in phases.items():
+            samples.setdefault(phase, []).append(seconds)
+    return dict(
+        (phase, perf_stats.summarize(values)) for phase, values in samples.items()
+    )
@@ -0,0 +1,315 @@
+"""
+Module for estimating the offset of the guest clock to the host clock.
+
+A responder in the guest answers the probes sent over a virtio serial port
+with its wall clock time, each probe gets the offset and the round trip time
+(RTT) NTP-style. Thousands of probes are exchanged per second without any
+shell in the path, only the probes with the minimum RTTs are kept, so the
+offset is accurate to tens of microseconds, and the drift rate is estimated
+from the offsets over time by linear regression.
+
+Available classes:
+- ClockProbe: Probe the guest clock over a virtio serial port.
+
+Available methods:
+- estimate_offset: Estimate the clock offset from the probe samples.
+- estimate_drift: Estimate the drift rate of the clock offset.
+- check_drift_rate: Check the drift rate of the guest clock.
+
+"""
+
+import logging
+import os
+import socket
+import struct
+import time
+
+from virttest import data_dir, qemu_virtio_port, utils_misc
+
+from provider import perf_stats
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+DEP_DIR = data_dir.get_deps_dir("clock_offset")
+
+PROBE = struct.Struct("!Q")
+REPLY = struct.Struct("!Qdd")
+
+# The responder script, the device of the port, the commands to start and
+# stop the responder in the guest
+RESPONDER = {
+    "linux": {
+        "script": "/tmp/clock_responder.py",
+        "device": "/dev/virtio-ports/%s",
+        "start": "nohup `command -v python3 python | head -1` %s %s"
+        " > /dev/null 2>&1 &",
+        "stop": "pkill -f clock_responder.py",
+    },
+    "windows": {
+        "script": r"C:\clock_responder.py",
+        "device": r"\\.\Global\%s",
+        "start": "start /b python %s %s",
+        "stop": "wmic process where \"name='python.exe' and "
+        "commandline like '%clock_responder.py%'\" delete",
+    },
+}
+
+
+def estimate_offset(samples, keep=0.1):
+    """
+    Estimate the clock offset from the probe samples, only the fraction of
+    the samples with the minimum RTTs is used, the offset of a sample is
+    within +/- RTT/2 of the real one
+
+    :param samples: list of tuples of (host time, offset, rtt) in seconds
+    :param keep: fraction of the samples to keep
+    :return: dict of time, offset, error, rtt_min, rtt_p50, samples and kept
+    """
+    if not samples:
+        raise ValueError("No clock probe samples")
+    ordered = sorted(samples, key=lambda sample: sample[2])
+    kept = ordered[: max(int(len(ordered) * keep), 1)]
+    rtts = [sample[2] for sample in ordered]
+    return {
+        "time": sum(sample[0] for sample in kept) / len(kept),
+        "offset": perf_stats.percentile([sample[1] for sample in kept], 50),
+        "error": rtts[0] / 2.0,
+        "rtt_min": rtts[0],
+        "rtt_p50": perf_stats.percentile(rtts, 50),
+        "samples": len(samples),
+        "kept": len(kept),
+    }
+
+
+def estimate_drift(points, confidence=0.95):
+    """
+    Estimate the drift rate of the clock offset by the least squares fit of
+    the offsets over time
+
+    :param points: list of tuples of (host time, offset) in seconds
+    :param confidence: confidence level of the bounds
+    :return: dict of ppm, low, high (the bounds of ppm), offset (the fitted
+             offset at the first point) and points
+    """
+    start = points[0][0]
+    fit = perf_stats.linear_fit(
+        [point[0] - start for point in points],
+        [point[1] for point in points],
+        confidence,
+    )
+    return {
+        "ppm": fit["slope"] * 1e6,
+        "low": fit["ci"][0] * 1e6,
+        "high": fit["ci"][1] * 1e6,
+        "offset": fit["intercept"],
+        "points": len(points),
+    }
+
+
+class ClockProbe(object):
+    """
+    Probe the guest clock over a virtio serial port, e.g.
+
+        probe = ClockProbe(vm, "vs1", session)
+        probe.start()
+        (ht, gt) = probe.get_time()
+        ...
+        probe.stop()
+
+    The offset is the guest wall clock time minus the host one.
+    """
+
+    def __init__(self, vm, port_name, session, params=None):
+        """
+        :param vm: VM object
+        :param port_name: name of the virtserialport
+        :param session: guest session to start and stop the responder
+        :param params: Params object or dict, the keys are
+                       clock_probe_count: probes per measurement
+                       clock_probe_keep: fraction of the probes to keep
+                       clock_probe_timeout: timeout of a probe
+        """
+        params = params or {}
+        self.vm = vm
+        self.port_name = port_name
+        self.session = session
+        self.count = int(params.get("clock_probe_count", 2000))
+        self.keep = float(params.get("clock_probe_keep", 0.1))
+        self.timeout = float(params.get("clock_probe_timeout", 1))
+        os_type = vm.params.get("os_type", "linux")
+        self.responder = RESPONDER["windows" if os_type == "windows" else "linux"]
+        self._port = None
+        self._seq = 0
+
+    def _get_port(self):
+        for port in self.vm.virtio_ports:
+            if (
+                isinstance(port, qemu_virtio_port.VirtioSerial)
+                and port.name == self.port_name
+            ):
+                return port
+        raise ValueError("No virtserialport %s in %s" % (self.port_name, self.vm.name))
+
+    def start(self, timeout=60):
+        """
+        Start the responder in the guest and connect to the port
+
+        :param timeout: timeout to wait for the responder
+        """
+        script = self.responder["script"]
+        self.vm.copy_files_to(os.path.join(DEP_DIR, "clock_responder.py"), script)
+        device = self.responder["device"] % self.port_name
+        self.session.cmd(self.responder["start"] % (script, device))
+        self.connect()
+        if not utils_misc.wait_for(self._ping, timeout, step=0.5):
+            self.stop()
+            raise RuntimeError("The clock responder in the guest is not ready")
+        LOG_JOB.info("Clock responder is ready on port %s", self.port_name)
+
+    def connect(self):
+        """Connect to the port, e.g. again after the VM is migrated"""
+        self.disconnect()
+        self._port = self._get_port()
+        self._port.open()
+        sock = self._port.sock
+        sock.settimeout(self.timeout)
+        if sock.family == socket.AF_INET and sock.type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def disconnect(self):
+        """Disconnect from the port"""
+        if self._port:
+            self._port.close()
+            self._port = None
+
+    def stop(self):
+        """Disconnect from the port and stop the responder in the guest"""
+        self.disconnect()
+        try:
+            self.session.cmd_status(self.responder["stop"])
+        except Exception as e:
+            LOG_JOB.warning("Failed to stop the clock responder: %s", e)
+
+    def _ping(self):
+        try:
+            self.probe()
+        except (socket.timeout, IOError, OSError) as e:
+            LOG_JOB.debug("Clock probe failed: %s", e)
+            return False
+        return True
+
+    def _recv_reply(self):
+        sock = self._port.sock
+        buf = b""
+        while len(buf) < REPLY.size:
+            data = sock.recv(REPLY.size - len(buf))
+            if not data:
+                raise IOError("The port %s is closed" % self.port_name)
+            buf += data
+        return REPLY.unpack(buf)
+
+    def probe(self):
+        """
+        Send one probe and wait for its reply, the stale replies of the
+        timed out probes are skipped
+
+        :return: tuple of (host time, offset, rtt) in seconds
+        """
+        self._seq += 1
+        sent = time.time()
+        self._port.sock.sendall(PROBE.pack(self._seq))
+        while True:
+            seq, received, replied = self._recv_reply()
+            if seq == self._seq:
+                break
+        now = time.time()
+        offset = ((received - sent) + (replied - now)) / 2.0
+        rtt = (now - sent) - (replied - received)
+        return (sent + now) / 2.0, offset, rtt
+
+    def measure(self, count=None):
+        """
+        Measure the clock offset by a burst of probes
+
+        :param count: number of probes, clock_probe_count by default
+        :return: dict of estimate_offset, with the rate of the probes
+        """
+        count = count or self.count
+        start = time.time()
+        samples = [self.probe() for _ in range(count)]
+        result = estimate_offset(samples, self.keep)
+        result["rate"] = count / max(time.time() - start, 1e-9)
+        LOG_JOB.debug(
+            "Clock offset %.6fs +/- %.6fs, rtt min/p50 %.6f/%.6fs, %.0f probes/s",
+            result["offset"],
+            result["error"],
+            result["rtt_min"],
+            result["rtt_p50"],
+            result["rate"],
+        )
+        return result
+
+    def get_time(self):
+        """
+        Get the host time and the guest time, the same as utils_test.get_time
+        but at the resolution of the clock probes
+
+        :return: tuple of (host time, guest time)
+        """
+        result = self.measure()
+        return result["time"], result["time"] + result["offset"]
+
+    def track(self, duration, interval=1.0, confidence=0.95):
+        """
+        Measure the clock offset periodically and estimate its drift rate
+
+        :param duration: seconds to track
+        :param interval: seconds between the measurements
+        :param confidence: confidence level of the drift bounds
+        :return: dict of estimate_drift, with the measurements
+        """
+        measurements = []
+        end = time.time() + duration
+        while True:
+            measurements.append(self.measure())
+            if time.time() + interval > end:
+                break
+            time.sleep(interval)
+        points = [(m["time"], m["offset"]) for m in measurements]
+        result = estimate_drift(points, confidence)
+        result["measurements"] = measurements
+        return result
+
+
+def check_drift_rate(test, params, probe):
+    """
+    Track the clock offset for 'clock_drift_duration' seconds, fail the test
+    if the drift rate is beyond +/- 'clock_drift_threshold_ppm' with the
+    confidence of 'clock_drift_confidence'
+
+    :param test: QEMU test object
+    :param params: Dictionary with the test parameters
+    :param probe: ClockProbe object which is started
+    :return: dict of estimate_drift
+    """
+    duration = float(params.get("clock_drift_duration", 10))
+    interval = float(params.get("clock_drift_interval", 0.5))
+    confidence = float(params.get("clock_drift_confidence", 0.95))
+    threshold = float(params.get("clock_drift_threshold_ppm", 100))
+    result = probe.track(duration, interval, confidence)
+    test.log.info(
+        "Clock drift rate: %.3f ppm (%g%% confidence: %.3f .. %.3f ppm), "
+        "offset %.6fs, %d measurements",
+        result["ppm"],
+        confidence * 100,
+        result["low"],
+        result["high"],
+        result["offset"],
+        result["points"],
+    )
+    if result["low"] > threshold or result["high"] < -threshold:
+        test.fail(
+            "Clock drift rate too large: %.3f ppm (threshold %g ppm)"
+            % (result["ppm"], threshold)
+        )
+    return result
@@ -0,0 +1,288 @@
+"""
+Module for managing the CPU affinity of host threads.
+
+Threads are enumerated from /proc/<pid>/task and pinned by
+os.sched_setaffinity() without forking ps/taskset, the affinity of all the
+threads is saved before any of them is changed, so they can be restored as
+a whole. The threads of QEMU are classified via the QMP monitor.
+
+Available classes:
+- AffinityManager: Change the CPU affinity of threads and restore it.
+
+Available methods:
+- list_threads: Get the threads of a process and its children.
+- mask_to_cpus: Convert a CPU mask to a set of CPUs.
+- cpus_to_mask: Convert a set of CPUs to a CPU mask.
+- classify_qemu_threads: Classify the threads of a QEMU process.
+- pin_vm_threads: Pin the vCPU and vhost threads of a VM to a NUMA node.
+
+"""
+
+import logging
+import os
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+
+def _read_proc(path):
+    try:
+        with open(path) as fd:
+            return fd.read()
+    except (IOError, OSError):
+        return ""
+
+
+def _get_tasks(pid):
+    try:
+        return sorted(int(tid) for tid in os.listdir("/proc/%s/task" % pid))
+    except (IOError, OSError):
+        return []
+
+
+def _get_children(pid):
+    """Get the child processes of a process"""
+    children = set()
+    for tid in _get_tasks(pid):
+        content = _read_proc("/proc/%s/task/%s/children" % (pid, tid))
+        children.update(int(child) for child in content.split())
+    if children or os.path.exists("/proc/%s/task/%s/children" % (pid, pid)):
+        return sorted(children)
+    # the kernel is built without CONFIG_PROC_CHILDREN
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            stat = _read_proc("/proc/%s/stat" % entry).rpartition(")")[2].split()
+            if stat and int(stat[1]) == int(pid):
+                children.add(int(entry))
+    return sorted(children)
+
+
+def list_threads(pid, children=False):
+    """
+    Get the threads of a process
+
+    :param pid: process ID
+    :param children: include the threads of the child processes recursively
+    :return: list of thread IDs
+    """
+    tids = _get_tasks(pid)
+    if children:
+        for child in _get_children(pid):
+            tids.extend(list_threads(child, children))
+    return tids
+
+
+def mask_to_cpus(mask):
+    """
+    Convert a CPU mask to a set of CPUs
+
+    :param mask: int or hex string, e.g. 0xff
+    :return: set of CPU IDs
+    """
+    if not isinstance(mask, int):
+        mask = int(mask, 16)
+    return set(cpu for cpu in range(mask.bit_length()) if mask >> cpu & 1)
+
+
+def cpus_to_mask(cpus):
+    """
+    Convert a set of CPUs to a CPU mask
+
+    :param cpus: iterable of CPU IDs
+    :return: int mask
+    """
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << int(cpu)
+    return mask
+
+
+class AffinityManager(object):
+    """
+    Change the CPU affinity of threads, the first affinity of each thread is
+    saved, restore() sets them back, e.g.
+
+        with AffinityManager() as manager:
+            manager.pin_process(pid, {0, 1}, children=True)
+            ...
+    """
+
+    def __init__(self):
+        self.saved = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.restore()
+
+    def snapshot(self, tids):
+        """
+        Save the affinity of the threads which are not saved yet
+
+        :param tids: thread IDs
+        :return: list of the thread IDs which are alive
+        """
+        alive = []
+        for tid in tids:
+            try:
+                if tid not in self.saved:
+                    self.saved[tid] = os.sched_getaffinity(tid)
+                alive.append(tid)
+            except ProcessLookupError:
+                pass
+        return alive
+
+    def set_affinity(self, tids, cpus):
+        """
+        Set the affinity of the threads, all of them are saved before any is
+        changed, the changed ones are restored if one fails
+
+        :param tids: thread IDs
+        :param cpus: set of CPU IDs or int CPU mask
+        """
+        if isinstance(cpus, int):
+            cpus = mask_to_cpus(cpus)
+        cpus = set(int(cpu) for cpu in cpus)
+        changed = []
+        try:
+            for tid in self.snapshot(tids):
+                try:
+                    os.sched_setaffinity(tid, cpus)
+                except ProcessLookupError:
+                    continue
+                changed.append(tid)
+        except OSError:
+            self.restore(changed)
+            raise
+        LOG_JOB.debug("Set the CPU affinity of %d threads to %s", len(changed), cpus)
+
+    def pin_process(self, pid, cpus, children=False):
+        """
+        Set the affinity of all threads of a process
+
+        :param pid: process ID
+        :param cpus: set of CPU IDs or int CPU mask
+        :param children: include the child processes recursively
+        """
+        self.set_affinity(list_threads(pid, children), cpus)
+
+    def restore(self, tids=None):
+        """
+        Restore the saved affinity of the threads, the exited ones are skipped
+
+        :param tids: thread IDs, all the saved threads by default
+        """
+        if tids is None:
+            tids = list(self.saved)
+        for tid in tids:
+            cpus = self.saved.pop(tid, None)
+            if cpus is None:
+                continue
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except ProcessLookupError:
+                pass
+            except OSError as e:
+                LOG_JOB.warning("Failed to restore the affinity of %s: %s", tid, e)
+
+
+def _query_thread_ids(vm, cmd):
+    try:
+        output = vm.monitor.cmd(cmd)
+    except Exception as e:
+        LOG_JOB.debug("Failed to %s: %s", cmd, e)
+        return None
+    if not isinstance(output, list):
+        return None
+    return [int(item["thread-id"]) for item in output if "thread-id" in item]
+
+
+def classify_qemu_threads(vm):
+    """
+    Classify the threads of a QEMU process
+
+    vcpu: reported by query-cpus-fast
+    iothread: reported by query-iothreads
+    vhost: the vhost workers, either kernel threads or threads of QEMU
+    main: the main thread
+    other: the others, e.g. the worker and RCU threads
+
+    :param vm: VM object
+    :return: dict of the class and the thread IDs
+    """
+    pid = vm.get_pid()
+    vcpus = _query_thread_ids(vm, "query-cpus-fast")
+    if vcpus is None:
+        vcpus = [int(tid) for tid in vm.vcpu_threads]
+    iothreads = _query_thread_ids(vm, "query-iothreads") or []
+    vhosts = [int(tid) for tid in getattr(vm, "vhost_threads", None) or []]
+    threads = {
+        "main": [pid],
+        "vcpu": vcpus,
+        "iothread": iothreads,
+        "vhost": vhosts,
+        "other": [],
+    }
+    known = set(vcpus + iothreads + vhosts + [pid])
+    for tid in _get_tasks(pid):
+        if tid in known:
+            continue
+        comm = _read_proc("/proc/%s/task/%s/comm" % (pid, tid)).strip()
+        if comm.startswith("vhost-"):
+            vhosts.append(tid)
+        else:
+            threads["other"].append(tid)
+    return threads
+
+
+def _flush_node(node):
+    """Remove the exited threads from the pin records of a NUMA node"""
+    for cpu, tids in node.dict.items():
+        node.dict[cpu] = [tid for tid in tids if os.path.exists("/proc/%s" % tid)]
+
+
+def _pin_to_free_cpu(manager, node, tid, extra=False):
+    cpus = node.extra_cpus if extra else node.cpus
+    for cpu in cpus:
+        if not node.dict[cpu]:
+            node.dict[cpu].append(tid)
+            manager.set_affinity([tid], {int(cpu)})
+            return cpu
+
+
+def pin_vm_threads(vm, node, manager=None):
+    """
+    Pin each vCPU and vhost thread of a VM to a free CPU of a NUMA node, the
+    vhost threads are pinned to the extra CPUs of the node if there are not
+    enough CPUs for all of them, the pinned CPUs are recorded in the node
+
+    :param vm: VM object
+    :param node: utils_misc.NumaNode object
+    :param manager: AffinityManager object to restore the affinity later
+    :return: dict of the thread ID and its pinned CPU
+    """
+    if manager is None:
+        manager = AffinityManager()
+    threads = classify_qemu_threads(vm)
+    vcpus, vhosts = threads["vcpu"], threads["vhost"]
+    _flush_node(node)
+    pinned = {}
+    if len(vcpus) + len(vhosts) < len(node.cpus):
+        extra = False
+    elif len(vcpus) <= len(node.cpus) and len(vhosts) <= len(node.cpus):
+        extra = True
+    else:
+        LOG_JOB.info("Skip pinning, no enough nodes")
+        return pinned
+    for tid in vcpus:
+        pinned[tid] = _pin_to_free_cpu(manager, node, tid)
+    for tid in vhosts:
+        pinned[tid] = _pin_to_free_cpu(manager, node, tid, extra)
+    LOG_JOB.info(
+        "Pinned vcpu threads %s and vhost threads %s of %s to cpus %s",
+        vcpus,
+        vhosts,
+        vm.name,
+        [pinned[tid] for tid in vcpus + vhosts],
+    )
+    return pinned
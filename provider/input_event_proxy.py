@@ -1,7 +1,9 @@
+import itertools
 import json
 import logging
 import os
-from queue import Queue
+import time
+from queue import Empty, Full, Queue
 
 from virttest import data_dir, utils_misc
 
@@ -10,6 +12,9 @@ LOG_JOB = logging.getLogger("avocado.test")
 
 DEP_DIR = data_dir.get_deps_dir("input_event")
 
+# The maximum events kept in the queue of a listener
+MAX_QUEUED_EVENTS = 65536
+
 
 class AgentMessageType:
     """Agent message types."""
@@ -31,6 +36,8 @@ class AgentState:
 
 EventTypeKey = "type"
 DevNameKey = "device"
+SeqKey = "seq"
+TimestampKey = "timestamp"
 
 
 class EventType:
@@ -79,8 +86,14 @@ class _EventListener(object):
 
         :param vm: VM object.
         """
-        self.events = Queue()
+        self.events = Queue(MAX_QUEUED_EVENTS)
         self.targets = {}
+        self._seqs = {}
+        self._stats = {}
+        self._probe_tokens = itertools.count(1)
+        self._probe_replies = Queue()
+        self.clock_offset = None
+        self.clock_error = None
         self._vm = vm
         self._ctrl_sh = vm.wait_for_login()
         self._agent_sh = None
@@ -140,8 +153,110 @@ class _EventListener(object):
         while not self.events.empty():
             self.events.get()
 
+    def _put_event(self, event):
+        """Queue an event, the event is dropped if the queue is full."""
+        try:
+            self.events.put_nowait(event)
+        except Full:
+            stats = self._get_stats(event[DevNameKey])
+            if not stats["overflowed"]:
+                LOG_JOB.warning("Input event queue is full, dropping events")
+            stats["overflowed"] += 1
+
+    def _get_stats(self, dev):
+        return self._stats.setdefault(
+            dev, {"frames": 0, "lost": 0, "reordered": 0, "dropped": 0, "overflowed": 0}
+        )
+
+    def _check_seq(self, dev, seq):
+        """
+        Check the per-device sequence number of a frame from the agent.
+
+        :return: `False` if the frame is out of order.
+        """
+        stats = self._get_stats(dev)
+        last = self._seqs.get(dev, 0)
+        if seq <= last:
+            stats["reordered"] += 1
+            return False
+        stats["lost"] += seq - last - 1
+        self._seqs[dev] = seq
+        return True
+
+    def stats(self):
+        """
+        Get the statistics of the received frames per device.
+
+        frames: frames received
+        lost: frames missing in the sequence
+        reordered: frames received out of order
+        dropped: frames dropped by the guest kernel (SYN_DROPPED)
+        overflowed: events dropped since the queue is full
+
+        :return: dict of device name and its statistics.
+        """
+        return dict((dev, dict(stats)) for dev, stats in self._stats.items())
+
+    def sync_clock(self, probes=16, timeout=2.0):
+        """
+        Estimate the offset of the guest clock of the event timestamps from
+        the host clock, by probing the agent.
+
+        The offset of each probe is taken against the midpoint of its round
+        trip, the probe with the shortest round trip is kept since it has the
+        least queueing delay, half of its round trip bounds the error.
+
+        :param probes: number of probes.
+        :param timeout: seconds to wait for the reply of a probe.
+        :return: tuple of offset (guest - host) and error in seconds.
+        """
+        best = None
+        for _ in range(probes):
+            token = next(self._probe_tokens)
+            sent = time.time()
+            self._agent_sh.sendline("T %d" % token)
+            while True:
+                try:
+                    reply = self._probe_replies.get(timeout=timeout)
+                except Empty:
+                    raise AssertionError("agent did not answer the clock probe")
+                if reply[0] == token:
+                    break
+            guest, received = reply[1:]
+            rtt = received - sent
+            if best is None or rtt < best[1]:
+                best = (guest - (sent + received) / 2.0, rtt)
+        self.clock_offset, self.clock_error = best[0], best[1] / 2.0
+        LOG_JOB.debug(
+            "Guest clock offset of %s: %.6fs (+/- %.6fs)",
+            self._vm.name,
+            self.clock_offset,
+            self.clock_error,
+        )
+        return self.clock_offset, self.clock_error
+
+    def to_host_time(self, event):
+        """
+        Convert the guest timestamp of an event to the host clock.
+
+        :param event: event with the timestamp, see `sync_clock`.
+        :return: seconds since the epoch of the host clock.
+        """
+        return event[TimestampKey] / 1000000.0 - self.clock_offset
+
     def _parse_output(self, line):
         """Parse output of the agent."""
+        if line[:2] in ("F ", "D "):
+            self._parse_frame(line.split(" ", 4))
+            return
+        if line[:2] == "C ":
+            received = time.time()
+            try:
+                _, token, guest = line.split()
+                self._probe_replies.put((int(token), int(guest) / 1000000.0, received))
+            except ValueError:
+                pass
+            return
         try:
             message = json.loads(line)
         except:
@@ -176,6 +291,30 @@ class _EventListener(object):
         """Parse events of the certian platform."""
         raise NotImplementedError()
 
+    def _parse_frame(self, fields):
+        """Parse a frame line of the agent."""
+        try:
+            dev, seq = fields[1], int(fields[2])
+        except (IndexError, ValueError):
+            return
+        if not self._check_seq(dev, seq):
+            return
+        stats = self._get_stats(dev)
+        if fields[0] == "D":
+            stats["dropped"] += 1
+            return
+        stats["frames"] += 1
+        try:
+            timestamp = int(fields[3])
+            events = [e.split(",") for e in fields[4].split(";")]
+        except (IndexError, ValueError):
+            return
+        self._parse_platform_frame(dev, seq, timestamp, events)
+
+    def _parse_platform_frame(self, dev, seq, timestamp, events):
+        """Parse the events of a frame of the certain platform."""
+        raise NotImplementedError()
+
 
 class EventListenerLinux(_EventListener):
     """Linux implementation for the event listener class."""
@@ -190,91 +329,80 @@ class EventListenerLinux(_EventListener):
     WHEELFORWARD = 0x00000001
     WHEELBACKWARD = 0xFFFFFFFF
 
-    def __init__(self, vm):
-        super(EventListenerLinux, self).__init__(vm)
-        self._buffers = {}
+    EV_KEY = 0x01
+    EV_REL = 0x02
+    EV_ABS = 0x03
+    EV_MSC = 0x04
+    EV_LED = 0x11
+    EV_REP = 0x14
+
+    REL_X = 0x00
+    REL_Y = 0x01
+    REL_HWHEEL = 0x06
+    REL_WHEEL = 0x08
+    ABS_X = 0x00
+    ABS_Y = 0x01
+    ABS_WHEEL = 0x08
+    MSC_SCAN = 0x04
 
     def _uninstall(self):
         cmd = " ".join(("rm", "-f", self.agent_target))
         self._ctrl_sh.cmd(cmd, ignore_all_errors=True)
 
-    def _report_info(self, content):
-        super(EventListenerLinux, self)._report_info(content)
-        dev = content["device"]
-        self._buffers[dev] = {}
-
-    def _parse_platform_event(self, content):
-        dev = content["device"]
-        nevent = content["event"]
-        etype = nevent["typeName"]
-        value = nevent["value"]
-        ebuf = self._buffers[dev]
-        if etype == "EV_SYN":
-            subtype = nevent["codeName"]
-            if subtype == "SYN_REPORT":
-                # end of event, report it
-                ebuf[DevNameKey] = dev
-                self.events.put(ebuf)
-                ebuf = {EventTypeKey: EventType.UNKNOWN}
-        elif etype == "EV_KEY":
-            keycode = nevent["codeName"]
-            if value == self.KEYDOWN:
-                mtype = EventType.KEYDOWN
-            elif value == self.KEYUP:
-                mtype = EventType.KEYUP
-            else:
-                mtype = value
-            if mtype:
-                ebuf[EventTypeKey] = mtype
-            ebuf[KeyEventData.KEYCODE] = keycode
-        elif etype == "EV_REL":
-            subtype = nevent["codeName"]
-            if subtype in ("REL_X", "REL_Y"):
-                ebuf[EventTypeKey] = EventType.POINTERMOVE
-                if subtype.endswith("X"):
-                    ebuf[PointerEventData.XPOS] = value
-                else:  # 'Y'
-                    ebuf[PointerEventData.YPOS] = value
-                ebuf[PointerEventData.ABS] = 0
-            elif subtype in ("REL_HWHEEL", "REL_WHEEL"):
-                if value == self.WHEELFORWARD:
-                    ebuf[EventTypeKey] = EventType.WHEELFORWARD
-                elif value == self.WHEELBACKWARD:
-                    ebuf[EventTypeKey] = EventType.WHEELBACKWARD
-                if subtype.endswith("HWHEEL"):
-                    ebuf[WheelEventData.HSCROLL] = 1
-                else:
+    def _parse_wheel(self, ebuf, value):
+        if value == self.WHEELFORWARD:
+            ebuf[EventTypeKey] = EventType.WHEELFORWARD
+        elif value == self.WHEELBACKWARD:
+            ebuf[EventTypeKey] = EventType.WHEELBACKWARD
+
+    def _parse_platform_frame(self, dev, seq, timestamp, events):
+        ebuf = {EventTypeKey: EventType.UNKNOWN}
+        for etype, code, value in events:
+            etype, value = int(etype), int(value)
+            if etype == self.EV_KEY:
+                if value == self.KEYDOWN:
+                    ebuf[EventTypeKey] = EventType.KEYDOWN
+                elif value == self.KEYUP:
+                    ebuf[EventTypeKey] = EventType.KEYUP
+                elif value:
+                    ebuf[EventTypeKey] = value
+                ebuf[KeyEventData.KEYCODE] = code
+                continue
+            code = int(code)
+            if etype == self.EV_REL:
+                if code in (self.REL_X, self.REL_Y):
+                    ebuf[EventTypeKey] = EventType.POINTERMOVE
+                    if code == self.REL_X:
+                        ebuf[PointerEventData.XPOS] = value
+                    else:
+                        ebuf[PointerEventData.YPOS] = value
+                    ebuf[PointerEventData.ABS] = 0
+                elif code in (self.REL_HWHEEL, self.REL_WHEEL):
+                    self._parse_wheel(ebuf, value)
+                    ebuf[WheelEventData.HSCROLL] = int(code == self.REL_HWHEEL)
+                    ebuf[WheelEventData.ABS] = 0
+            elif etype == self.EV_ABS:
+                if code in (self.ABS_X, self.ABS_Y):
+                    ebuf[EventTypeKey] = EventType.POINTERMOVE
+                    if code == self.ABS_X:
+                        ebuf[PointerEventData.XPOS] = value
+                    else:
+                        ebuf[PointerEventData.YPOS] = value
+                    ebuf[PointerEventData.ABS] = 1
+                elif code == self.ABS_WHEEL:
+                    self._parse_wheel(ebuf, value)
                     ebuf[WheelEventData.HSCROLL] = 0
-                ebuf[WheelEventData.ABS] = 0
-        elif etype == "EV_ABS":
-            subtype = nevent["codeName"]
-            if subtype in ("ABS_X", "ABS_Y"):
-                ebuf[EventTypeKey] = EventType.POINTERMOVE
-                if subtype.endswith("X"):
-                    ebuf[PointerEventData.XPOS] = value
-                else:  # 'Y'
-                    ebuf[PointerEventData.YPOS] = value
-                ebuf[PointerEventData.ABS] = 1
-            elif subtype == "ABS_WHEEL":
-                if value == self.WHEELFORWARD:
-                    ebuf[EventTypeKey] = EventType.WHEELFORWARD
-                elif value == self.WHEELBACKWARD:
-                    ebuf[EventTypeKey] = EventType.WHEELBACKWARD
-                ebuf[WheelEventData.HSCROLL] = 0
-                ebuf[WheelEventData.ABS] = 1
-        elif etype == "EV_MSC":
-            subtype = nevent["codeName"]
-            if subtype == "MSC_SCAN":
-                ebuf[KeyEventData.SCANCODE] = value
-        elif etype == "EV_LED":
-            # TODO: handle this kind of events when necessary
-            pass
-        elif etype == "EV_REP":
-            # FIXME: handle this kind of events
-            pass
-        else:
-            ebuf[EventTypeKey] = EventType.UNKNOWN
-        self._buffers[dev] = ebuf
+                    ebuf[WheelEventData.ABS] = 1
+            elif etype == self.EV_MSC:
+                if code == self.MSC_SCAN:
+                    ebuf[KeyEventData.SCANCODE] = value
+            elif etype not in (self.EV_LED, self.EV_REP):
+                # TODO: handle EV_LED and EV_REP events when necessary
+                ebuf[EventTypeKey] = EventType.UNKNOWN
+        ebuf[DevNameKey] = dev
+        ebuf[SeqKey] = seq
+        ebuf[TimestampKey] = timestamp
+        self._put_event(ebuf)
 
 
 # XXX: we may need different map tables for different keyboard layouts,
@@ -548,7 +676,7 @@ class EventListenerWin(_EventListener):
             event[PointerEventData.YPOS] = ypos
         event[EventTypeKey] = mtype
         event[DevNameKey] = dev
-        self.events.put(event)
+        self._put_event(event)
 
 
 def EventListener(vm):
@@ -5,10 +5,11 @@ import logging
 import os
 import time
 from collections import Counter
+from queue import Empty
 
 from virttest import data_dir, error_context, graphical_console
 
-from provider import input_event_proxy
+from provider import input_event_proxy, perf_stats
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -323,3 +324,125 @@ def mouse_test(test, params, vm, wait_time, count=1):
         mouse_move_test(test, params, console, listener, wait_time, end_pos, absolute)
     listener.clear_events()
     listener.cleanup()
+
+
+def _latency_injection(params, kind, index):
+    """
+    Get the QMP events of an injection of the latency test, the injections
+    alternate so that each of them changes the input state.
+
+    :param params: Dictionary with the test parameters
+    :param kind: 'key', 'btn', 'rel' or 'abs'
+    :param index: index of the injection
+    :return: tuple of the QMP events and the expected guest event type
+    """
+    down = index % 2 == 0
+    if kind == "key":
+        key = {"type": "qcode", "data": params.get("latency_key", "a")}
+        events = [{"type": "key", "data": {"down": down, "key": key}}]
+        return events, "KEYDOWN" if down else "KEYUP"
+    if kind == "btn":
+        button = params.get("latency_button", "left")
+        events = [{"type": "btn", "data": {"down": down, "button": button}}]
+        return events, "KEYDOWN" if down else "KEYUP"
+    if kind == "rel":
+        value = 1 if down else -1
+    elif kind == "abs":
+        value = 8192 if down else 24576
+    else:
+        raise ValueError("Unsupported latency input: %s" % kind)
+    events = [{"type": kind, "data": {"axis": "x", "value": value}}]
+    return events, "POINTERMOVE"
+
+
+def _wait_input_event(listener, etypes, timeout):
+    """
+    Wait for the next event of the types, the others are skipped.
+
+    :param listener: listening the input events in guest.
+    :param etypes: expected event types.
+    :param timeout: seconds to wait.
+    :return: the event or None if timed out.
+    """
+    end_time = time.time() + timeout
+    while True:
+        try:
+            event = listener.events.get(timeout=max(end_time - time.time(), 0))
+        except Empty:
+            return None
+        if event["type"] in etypes:
+            return event
+
+
+@error_context.context_aware
+def input_latency_test(test, params, vm, listener, kind):
+    """
+    Input latency test, inject events via QMP input-send-event one by one
+    and correlate the host injection time with the guest timestamp of the
+    received events, then inject a burst of events to get the throughput.
+
+    :param test: kvm test object
+    :param params: Dictionary with the test parameters
+    :param vm: VM object
+    :param listener: listening the input events in guest.
+    :param kind: injected input, 'key', 'btn', 'rel' or 'abs'
+    :return: dict with latency/send (perf_stats.summarize of the milliseconds
+             from the injection to the guest event, and of the QMP command),
+             throughput (events/s), lost events and the guest devices
+    """
+    iterations = int(params.get("latency_iterations", 100))
+    interval = float(params.get("latency_interval", 0.02))
+    burst = int(params.get("latency_burst", 200))
+    timeout = float(params.get("latency_timeout", 1))
+    monitor = vm.qmp_monitors[0]
+
+    error_context.context("Sync the guest clock with host", LOG_JOB.info)
+    offset, error = listener.sync_clock(int(params.get("clock_probes", 16)))
+    LOG_JOB.info("Guest clock offset: %.3fms (+/- %.3fms)", offset * 1e3, error * 1e3)
+
+    error_context.context("Measure the latency of %s events" % kind, LOG_JOB.info)
+    listener.clear_events()
+    latencies, sends, devices = [], [], set()
+    lost = 0
+    for index in range(iterations):
+        events, etype = _latency_injection(params, kind, index)
+        sent = time.time()
+        monitor.input_send_event(events)
+        sends.append((time.time() - sent) * 1e3)
+        event = _wait_input_event(listener, (etype,), timeout)
+        if event is None:
+            lost += 1
+            continue
+        latencies.append((listener.to_host_time(event) - sent) * 1e3)
+        devices.add(event[input_event_proxy.DevNameKey])
+        time.sleep(interval)
+    if not latencies:
+        test.fail("No %s event is received in guest" % kind)
+
+    error_context.context("Measure the throughput of %s events" % kind, LOG_JOB.info)
+    listener.clear_events()
+    injections = [_latency_injection(params, kind, index) for index in range(burst)]
+    start_time = time.time()
+    for events, _ in injections:
+        monitor.input_send_event(events)
+    etypes = set(etype for _, etype in injections)
+    received = []
+    while len(received) < burst:
+        event = _wait_input_event(listener, etypes, timeout)
+        if event is None:
+            break
+        received.append(event)
+    lost += burst - len(received)
+    throughput = 0.0
+    if received:
+        elapsed = listener.to_host_time(received[-1]) - start_time
+        throughput = len(received) / elapsed if elapsed > 0 else 0.0
+
+    return {
+        "latency": perf_stats.summarize(latencies),
+        "send": perf_stats.summarize(sends),
+        "samples": latencies,
+        "throughput": throughput,
+        "lost": lost,
+        "devices": sorted(devices),
+    }
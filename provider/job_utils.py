@@ -1,8 +1,9 @@
 import logging
+import threading
 import time
+import weakref
 
 from avocado import fail_on
-from virttest import utils_misc
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -10,6 +11,171 @@ BLOCK_JOB_COMPLETED_EVENT = "BLOCK_JOB_COMPLETED"
 BLOCK_JOB_CANCELLED_EVENT = "BLOCK_JOB_CANCELLED"
 BLOCK_JOB_ERROR_EVENT = "BLOCK_JOB_ERROR"
 BLOCK_IO_ERROR_EVENT = "BLOCK_IO_ERROR"
+BLOCK_JOB_READY_EVENT = "BLOCK_JOB_READY"
+BLOCK_JOB_PENDING_EVENT = "BLOCK_JOB_PENDING"
+JOB_STATUS_CHANGE_EVENT = "JOB_STATUS_CHANGE"
+
+# Job status implied by the legacy BLOCK_JOB_* events, used when the
+# QEMU in use does not emit JOB_STATUS_CHANGE
+_BLOCK_JOB_EVENT_STATUS = {
+    BLOCK_JOB_READY_EVENT: "ready",
+    BLOCK_JOB_PENDING_EVENT: "pending",
+    BLOCK_JOB_COMPLETED_EVENT: "concluded",
+    BLOCK_JOB_CANCELLED_EVENT: "concluded",
+}
+
+_TRACKED_EVENTS = set(_BLOCK_JOB_EVENT_STATUS) | {JOB_STATUS_CHANGE_EVENT}
+
+_TRACKERS = weakref.WeakKeyDictionary()
+_TRACKERS_LOCK = threading.Lock()
+
+
+class JobTracker(object):
+    """
+    Track the status of every job of a VM from QMP events.
+
+    The tracker consumes JOB_STATUS_CHANGE and BLOCK_JOB_* events from the
+    monitor event buffer, which is a local read without any QMP command, and
+    keeps a status table for each job-id.  Callers block on a condition of
+    the table, 'query-jobs' is only issued as a fallback every
+    `resync_interval` seconds in case the events were cleared by others.
+    """
+
+    def __init__(self, vm, step=0.05, resync_interval=5):
+        """
+        :param vm: VM object
+        :param step: interval of reading the monitor event buffer
+        :param resync_interval: interval of the 'query-jobs' fallback
+        """
+        self._vm = vm
+        self._step = step
+        self._resync_interval = resync_interval
+        self._lock = threading.RLock()
+        self._seen = set()
+        self._status = {}
+        self._status_changed = set()
+        self._completed = {}
+        self._last_resync = 0
+
+    @staticmethod
+    def _event_key(event):
+        timestamp = event.get("timestamp", {})
+        return (
+            event.get("event"),
+            timestamp.get("seconds"),
+            timestamp.get("microseconds"),
+            repr(sorted(event.get("data", {}).items())),
+        )
+
+    def _handle_event(self, event):
+        name = event.get("event")
+        data = event.get("data", {})
+        if name == JOB_STATUS_CHANGE_EVENT:
+            job_id = data["id"]
+            if data["status"] == "created":
+                # job ID is reused by a new job
+                self._completed.pop(job_id, None)
+            self._status_changed.add(job_id)
+            self._status[job_id] = data["status"]
+            return
+        job_id = data.get("id", data.get("device"))
+        if name in (BLOCK_JOB_COMPLETED_EVENT, BLOCK_JOB_CANCELLED_EVENT):
+            self._completed[job_id] = event
+        if job_id not in self._status_changed:
+            self._status[job_id] = _BLOCK_JOB_EVENT_STATUS[name]
+
+    def update(self):
+        """Consume the new job events from the monitor event buffer"""
+        with self._lock:
+            for event in self._vm.monitor.get_events():
+                if event.get("event") not in _TRACKED_EVENTS:
+                    continue
+                key = self._event_key(event)
+                if key not in self._seen:
+                    self._seen.add(key)
+                    self._handle_event(event)
+
+    def resync(self):
+        """Refresh the status table by 'query-jobs'"""
+        with self._lock:
+            self._last_resync = time.time()
+            jobs = dict((j["id"], j["status"]) for j in query_jobs(self._vm))
+            for job_id in self._status:
+                if job_id not in jobs:
+                    self._status[job_id] = "null"
+            self._status.update(jobs)
+
+    def get_status(self, job_id):
+        """
+        Get the tracked status of a job
+
+        :param job_id: job ID
+        :return: job status string, None if the job is never seen
+        """
+        with self._lock:
+            return self._status.get(job_id)
+
+    def get_completed_event(self, job_id):
+        """
+        Get BLOCK_JOB_COMPLETED or BLOCK_JOB_CANCELLED event of a job
+
+        :param job_id: job ID
+        :return: the event dict or None
+        """
+        with self._lock:
+            return self._completed.get(job_id)
+
+    def wait_for(self, condition, timeout):
+        """
+        Block until condition returns a true value
+
+        :param condition: callable taking the tracker as its only argument
+        :param timeout: blocked timeout
+        :return: the value returned by condition, None on timeout
+        """
+        end_time = time.time() + timeout
+        while True:
+            self.update()
+            result = condition(self)
+            if result:
+                return result
+            if time.time() > end_time:
+                return None
+            if time.time() - self._last_resync > self._resync_interval:
+                self.resync()
+                result = condition(self)
+                if result:
+                    return result
+            time.sleep(self._step)
+
+    def wait_for_status(self, job_ids, statuses, timeout):
+        """
+        Block until all jobs reach one of statuses
+
+        :param job_ids: list of job IDs
+        :param statuses: list of expected status strings
+        :param timeout: blocked timeout
+        :return: True if all matched, otherwise False
+        """
+        return bool(
+            self.wait_for(
+                lambda t: all(t.get_status(j) in statuses for j in job_ids),
+                timeout,
+            )
+        )
+
+
+def get_job_tracker(vm):
+    """
+    Get the job tracker of a VM, create one if not exists
+
+    :param vm: VM object
+    :return: JobTracker object
+    """
+    with _TRACKERS_LOCK:
+        if vm not in _TRACKERS:
+            _TRACKERS[vm] = JobTracker(vm)
+        return _TRACKERS[vm]
 
 
 def get_job_status(vm, device):
@@ -35,47 +201,43 @@ def wait_until_job_status_match(vm, status, device, timeout):
     :param device: device ID or node-name
     :param timeout: blocked timeout
     """
-    matched = utils_misc.wait_for(
-        lambda: get_job_status(vm, device) == status, timeout=timeout
-    )
+    matched = get_job_tracker(vm).wait_for_status([device], [status], timeout)
     assert matched, "wait job status to '%s' timeout in %s seconds" % (status, timeout)
 
 
 @fail_on
 def wait_until_block_job_completed(vm, job_id, timeout=900):
     """Block until block job completed"""
+    tracker = get_job_tracker(vm)
+    handled = []
+
+    def _wait_until_block_job_completed(tracker):
+        status = tracker.get_status(job_id)
+        if handled[-1:] != [status]:
+            handled.append(status)
+            if status == "pending":
+                block_job_finalize(vm, job_id)
+            elif status == "ready":
+                try:
+                    arguments = {"id": job_id}
+                    vm.monitor.cmd("job-complete", arguments)
+                except Exception as err:
+                    LOG_JOB.debug("'job-complete' hit error: %s", err.data["desc"])
+        event = tracker.get_completed_event(job_id)
+        if event is None or event.get("event") != BLOCK_JOB_COMPLETED_EVENT:
+            return False
+        return status in ("concluded", "null")
 
-    def _wait_until_block_job_completed():
-        finished = False
-        status = get_job_status(vm, job_id)
-        if status == "pending":
-            block_job_finalize(vm, job_id)
-        if status == "ready":
-            try:
-                arguments = {"id": job_id}
-                vm.monitor.cmd("job-complete", arguments)
-            except Exception as err:
-                LOG_JOB.debug("'job-complete' hit error: %s", err.data["desc"])
-        try:
-            for event in vm.monitor.get_events():
-                if event.get("event") != BLOCK_JOB_COMPLETED_EVENT:
-                    continue
-                data = event.get("data", dict())
-                if job_id in [data.get("id"), data.get("device")]:
-                    error = data.get("error")
-                    assert not error, "block backup job finished with error: %s" % error
-                    finished = True
-                    break
-        finally:
-            status = get_job_status(vm, job_id)
-            if status == "concluded":
-                block_job_dismiss(vm, job_id)
-        return finished
-
-    finished = utils_misc.wait_for(
-        _wait_until_block_job_completed, first=0.1, timeout=timeout
-    )
-    assert finished, "wait for block job complete event timeout in %s seconds" % timeout
+    finished = tracker.wait_for(_wait_until_block_job_completed, timeout)
+    try:
+        assert finished, (
+            "wait for block job complete event timeout in %s seconds" % timeout
+        )
+        error = tracker.get_completed_event(job_id)["data"].get("error")
+        assert not error, "block backup job finished with error: %s" % error
+    finally:
+        if tracker.get_status(job_id) == "concluded":
+            block_job_dismiss(vm, job_id)
 
 
 @fail_on
@@ -98,7 +260,7 @@ def block_job_dismiss(vm, job_id, timeout=120):
     job = get_block_job_by_id(vm, job_id)
     if job.get("auto-dismiss", True) is False:
         _job_dismiss(vm, job_id, timeout)
-        time.sleep(0.1)
+        get_job_tracker(vm).wait_for_status([job_id], ["null"], timeout)
         job = get_block_job_by_id(vm, job_id)
         assert not job, "Block job '%s' exists" % job_id
 
@@ -107,7 +269,7 @@ def block_job_dismiss(vm, job_id, timeout=120):
 def job_dismiss(vm, job_id, timeout=120):
     """dismiss job when job status is concluded"""
     _job_dismiss(vm, job_id, timeout)
-    time.sleep(0.1)
+    get_job_tracker(vm).wait_for_status([job_id], ["null"], timeout)
     job = get_job_by_id(vm, job_id)
     assert not job, "Job '%s' exists" % job_id
 
@@ -196,7 +358,8 @@ def get_event_by_condition(vm, event_name, tmo=30, **condition):
     :return: The event dict or None
     """
     event = None
-    for i in range(tmo):
+    end_time = time.time() + tmo
+    while time.time() < end_time:
         all_events = vm.monitor.get_events()
         events = [e for e in all_events if e.get("event") == event_name]
         if condition:
@@ -209,7 +372,7 @@ def get_event_by_condition(vm, event_name, tmo=30, **condition):
         if events:
             event = events[0]
             break
-        time.sleep(1)
+        time.sleep(0.1)
     return event
 
 
@@ -235,10 +398,62 @@ def check_block_jobs_started(vm, jobid_list, tmo=10):
     """
     Test failed if any block job failed to start
     """
-    started = all(list(map(lambda j: is_block_job_started(vm, j, tmo), jobid_list)))
+    started = _check_block_jobs(vm, jobid_list, tmo, _is_block_job_started)
     assert started, "Not all block jobs start successfully"
 
 
+def _is_block_job_started(jobid, job, first_job):
+    if not job:
+        LOG_JOB.debug("job %s was not found", jobid)
+        return False
+    elif job["offset"] > 0:
+        return True
+
+
+def _is_block_job_running(jobid, job, first_job):
+    if not job:
+        LOG_JOB.debug("job %s cancelled unexpectedly", jobid)
+        return False
+    elif job["status"] not in ["running", "pending", "ready"]:
+        LOG_JOB.debug("job %s is not in running status", jobid)
+        return False
+    elif first_job["status"] in ["pending", "ready"]:
+        return True
+    elif job["offset"] > first_job["offset"]:
+        return True
+
+
+def _check_block_jobs(vm, jobid_list, tmo, check):
+    """
+    Check block jobs with one 'query-block-jobs' per second for all of them
+
+    :param vm: VM object
+    :param jobid_list: list of block job IDs
+    :param tmo: checking timeout for each job
+    :param check: callable taking job ID, current job info and the job info
+                  of the first query, returns True or False if the result is
+                  decided, otherwise None
+    :return: True if all jobs passed the check, otherwise False
+    """
+    first_jobs = {}
+    undecided = list(jobid_list)
+    for i in range(tmo):
+        jobs = dict((j["device"], j) for j in query_block_jobs(vm))
+        for jobid in undecided[:]:
+            job = jobs.get(jobid, dict())
+            first_job = first_jobs.setdefault(jobid, job)
+            result = check(jobid, job, first_job)
+            if result is False:
+                return False
+            elif result:
+                undecided.remove(jobid)
+        if not undecided:
+            return True
+        time.sleep(1)
+    LOG_JOB.debug("block jobs %s never passed the check in %s", undecided, tmo)
+    return False
+
+
 def is_block_job_running(vm, jobid, tmo=200):
     """
     offset should keep increasing when block job keeps running,
@@ -270,7 +485,7 @@ def check_block_jobs_running(vm, jobid_list, tmo=200):
     """
     Test failed if any block job's offset never increased
     """
-    running = all(list(map(lambda j: is_block_job_running(vm, j, tmo), jobid_list)))
+    running = _check_block_jobs(vm, jobid_list, tmo, _is_block_job_running)
     assert running, "Not all block jobs are running"
 
 
@@ -0,0 +1,231 @@
+"""
+Module for detecting the memory leak of a host process, e.g. QEMU.
+
+The memory of the process is read from /proc/<pid>/smaps_rollup at the end
+of each iteration of a repeated workload, and at a fixed cadence by a thread
+of the test process in between to get the peak. A line is fitted to the
+memory at the end of the iterations versus the iteration, the process is
+leaking if the slope is above the threshold with confidence, so neither the
+noise of two single readings nor the one-off growth at the start of a
+workload is taken as a leak. The readings in between are not fitted, they
+are autocorrelated and would narrow the confidence interval artificially.
+
+Available classes:
+- LeakDetector: Sample the memory of a process and check the growth.
+
+Available methods:
+- read_memory: Read the memory usage of a process.
+- check_leak: Check the result of LeakDetector and fail the test on leak.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from provider import perf_stats
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+# The fields of smaps_rollup, and the ones of status as a fallback for the
+# kernels without smaps_rollup (< 4.14), all of them are in kB
+SMAPS_FIELDS = {"Rss": "rss", "Pss": "pss", "Anonymous": "anon", "Swap": "swap"}
+STATUS_FIELDS = {"VmRSS": "rss", "RssAnon": "anon", "VmSwap": "swap"}
+
+
+def _read_fields(path, fields):
+    memory = {}
+    with open(path) as fd:
+        for line in fd:
+            key, _, value = line.partition(":")
+            if key in fields:
+                memory[fields[key]] = int(value.split()[0])
+    return memory
+
+
+def read_memory(pid):
+    """
+    Read the memory usage of a process
+
+    :param pid: process ID
+    :return: dict of rss, pss, anon and swap in KiB, pss is missing if
+             smaps_rollup is not supported
+    """
+    path = "/proc/%s/smaps_rollup" % pid
+    if os.path.exists(path):
+        return _read_fields(path, SMAPS_FIELDS)
+    return _read_fields("/proc/%s/status" % pid, STATUS_FIELDS)
+
+
+class LeakDetector(object):
+    """
+    Sample the memory of a process while a workload is repeated, e.g.
+
+        detector = LeakDetector(vm.get_pid(), params)
+        result = detector.run(workload, iterations)
+        check_leak(test, result)
+
+    or call start(), mark_iteration() after each iteration and stop() for
+    the workload which can not be a function.
+    """
+
+    def __init__(self, pid, params=None):
+        """
+        :param pid: process ID
+        :param params: Params object or dict, the keys are
+                       leak_sample_interval: seconds between the samples
+                                             for the peak
+                       leak_metric: rss, pss, anon or swap to check
+                       leak_warmup_iterations: the first iterations to skip
+                       leak_slope_threshold: KiB per iteration
+                       leak_confidence: confidence level of the slope
+        """
+        params = params or {}
+        self.pid = pid
+        self.interval = float(params.get("leak_sample_interval", 1))
+        self.metric = params.get("leak_metric", "anon")
+        self.warmup = int(params.get("leak_warmup_iterations", 1))
+        self.threshold = float(params.get("leak_slope_threshold", 256))
+        self.confidence = float(params.get("leak_confidence", 0.95))
+        self.samples = []
+        self.marks = []
+        self.iteration = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def sample(self):
+        """
+        Take a sample of the memory at the current iteration
+
+        :return: dict of read_memory
+        """
+        memory = read_memory(self.pid)
+        with self._lock:
+            self.samples.append((time.time(), self.iteration, memory))
+        return memory
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except (IOError, OSError) as e:
+                LOG_JOB.warning("Stop sampling the memory of %s: %s", self.pid, e)
+                return
+
+    def start(self):
+        """Start sampling at the cadence of leak_sample_interval"""
+        self.samples = []
+        self.iteration = 0
+        self._stop.clear()
+        self.marks = [(0, self.sample())]
+        self._sampler = threading.Thread(target=self._sample_loop)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def mark_iteration(self):
+        """Mark the end of an iteration of the workload"""
+        self.iteration += 1
+        self.marks.append((self.iteration, self.sample()))
+
+    def stop(self):
+        """Stop sampling"""
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+            self._sampler = None
+
+    def run(self, workload, iterations):
+        """
+        Repeat a workload and sample the memory meanwhile
+
+        :param workload: function called with the index of each iteration
+        :param iterations: number of iterations
+        :return: dict of analyze()
+        """
+        self.start()
+        try:
+            for index in range(iterations):
+                workload(index)
+                self.mark_iteration()
+        finally:
+            self.stop()
+        return self.analyze()
+
+    def analyze(self):
+        """
+        Fit the memory at the end of each iteration to the iteration by
+        least squares, one point per iteration, the warm-up iterations are
+        skipped
+
+        :return: dict of metric, threshold, iterations, samples, first,
+                 last and peak (the memory in KiB), leak, and <metric> of
+                 each metric with slope, intercept, r2 and ci of
+                 perf_stats.linear_fit
+        """
+        marks = [m for m in self.marks if m[0] >= self.warmup]
+        if len(marks) < 3:
+            raise ValueError(
+                "No enough iterations to analyze, got %d with %d warm-up"
+                % (self.iteration, self.warmup)
+            )
+        with self._lock:
+            samples = [s[2] for s in self.samples if s[1] >= self.warmup]
+        peak = {}
+        for memory in samples:
+            for metric, value in memory.items():
+                peak[metric] = max(peak.get(metric, value), value)
+        result = {
+            "metric": self.metric,
+            "threshold": self.threshold,
+            "iterations": self.iteration,
+            "samples": len(samples),
+            "first": marks[0][1],
+            "last": marks[-1][1],
+            "peak": peak,
+        }
+        for metric in marks[-1][1]:
+            points = [(m[0], m[1][metric]) for m in marks if metric in m[1]]
+            result[metric] = perf_stats.linear_fit(
+                [point[0] for point in points],
+                [point[1] for point in points],
+                self.confidence,
+            )
+        result["leak"] = result[self.metric]["ci"][0] > self.threshold
+        return result
+
+
+def check_leak(test, result):
+    """
+    Log the result of LeakDetector and fail the test on leak
+
+    :param test: QEMU test object
+    :param result: dict of LeakDetector.analyze
+    """
+    for metric in sorted(SMAPS_FIELDS.values()):
+        if metric in result:
+            fit = result[metric]
+            test.log.info(
+                "Memory %s: %d -> %d KiB (peak %d KiB), slope %.2f "
+                "KiB/iteration (%.2f .. %.2f), r2 %.3f",
+                metric,
+                result["first"].get(metric, 0),
+                result["last"].get(metric, 0),
+                result["peak"].get(metric, 0),
+                fit["slope"],
+                fit["ci"][0],
+                fit["ci"][1],
+                fit["r2"],
+            )
+    if result["leak"]:
+        test.fail(
+            "Memory leak: %s grows %.2f KiB per iteration in %d iterations, "
+            "threshold %g KiB"
+            % (
+                result["metric"],
+                result[result["metric"]]["slope"],
+                result["iterations"],
+                result["threshold"],
+            )
+        )
@@ -0,0 +1,492 @@
+"""
+Module for sampling the progress of migration.
+
+The sampler waits for migration to become active, preferably by the
+MIGRATION QMP event, then samples 'query-migrate' at a fixed interval on
+its own thread, and keeps the full time series of the progress.
+
+Available classes:
+- MigrationSampler: Sample the progress of migration in background.
+- AutoConvergeAnalyzer: Sample the host CPU and the vCPU threads together
+                        with the progress to analyze auto-converge.
+
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+import six
+from virttest.qemu_monitor import MonitorLockError
+
+from provider import perf_stats
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+# Statuses which mean the migration is over
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+_HMP_FIELDS = {
+    "status": re.compile(r"^Migration status: (\S+)", re.M),
+    "transferred": re.compile(r"^transferred ram: (\d+) kbytes", re.M),
+    "remaining": re.compile(r"^remaining ram: (\d+) kbytes", re.M),
+    "total": re.compile(r"^total ram: (\d+) kbytes", re.M),
+    "dirty_pages_rate": re.compile(r"^dirty pages rate: (\d+) pages", re.M),
+    "throughput": re.compile(r"^throughput: ([\d.]+) mbps", re.M),
+    "downtime": re.compile(r"^downtime: (\d+) milliseconds", re.M),
+    "expected_downtime": re.compile(r"^expected downtime: (\d+) milliseconds", re.M),
+    "cpu_throttle": re.compile(r"^cpu throttle percentage: (\d+)", re.M),
+}
+
+
+def parse_migrate_info(info):
+    """
+    Get a flat sample from the output of 'info migrate'/'query-migrate'
+
+    :param info: dict of QMP or string of HMP
+    :return: dict with status, transferred/remaining/total (bytes),
+             dirty_pages_rate (pages/s), throughput (mbps),
+             downtime/expected_downtime (ms), cpu_throttle (%), missing
+             ones are None
+    """
+    if isinstance(info, six.string_types):
+        sample = {}
+        for name, pattern in _HMP_FIELDS.items():
+            match = pattern.search(info)
+            value = match.group(1) if match else None
+            if value is not None and name != "status":
+                value = float(value)
+                if name in ("transferred", "remaining", "total"):
+                    value *= 1024
+            sample[name] = value
+        return sample
+
+    ram = info.get("ram", {})
+    return {
+        "status": info.get("status"),
+        "transferred": ram.get("transferred"),
+        "remaining": ram.get("remaining"),
+        "total": ram.get("total"),
+        "dirty_pages_rate": ram.get("dirty-pages-rate"),
+        "throughput": ram.get("mbps"),
+        "downtime": info.get("downtime"),
+        "expected_downtime": info.get("expected-downtime"),
+        "cpu_throttle": info.get("cpu-throttle-percentage"),
+    }
+
+
+def _pop_events(monitor, name):
+    """
+    Remove the buffered events of a name from the monitor and return them,
+    the events of other names are kept for the other consumers
+
+    :param monitor: QMP monitor object
+    :param name: event name, e.g. 'MIGRATION'
+    :return: list of the events in the order they are received
+    """
+    if not monitor._acquire_lock():
+        raise MonitorLockError("Could not acquire exclusive lock to read QMP events")
+    try:
+        events = [e for e in monitor.get_events() if e.get("event") == name]
+        consumed = set(id(e) for e in events)
+        monitor._events[:] = [e for e in monitor._events if id(e) not in consumed]
+        return events
+    finally:
+        monitor._lock.release()
+
+
+class MigrationSampler(object):
+    """
+    Sample the progress of migration of a VM in background
+
+    Usage:
+      sampler = MigrationSampler(vm, interval=1, max_samples=30)
+      sampler.start()
+      vm.migrate(..., not_wait_for_migration=True)
+      sampler.join(timeout)
+      speeds = sampler.speeds()
+    """
+
+    def __init__(self, vm, interval=1.0, max_samples=None, start_timeout=60):
+        """
+        :param vm: the source VM object
+        :param interval: seconds between the samples
+        :param max_samples: stop after this number of active samples, sample
+                            until migration is over if it's None
+        :param start_timeout: seconds to wait for migration to be active
+        """
+        self.vm = vm
+        self.interval = float(interval)
+        self.max_samples = max_samples
+        self.start_timeout = float(start_timeout)
+        self.samples = []
+        self.started = False
+        self.error = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._use_event = False
+
+    def _enable_event(self):
+        """Enable the MIGRATION event if the monitor supports it"""
+        monitor = self.vm.monitor
+        if not hasattr(monitor, "get_event"):
+            return False
+        try:
+            monitor.set_migrate_capability(True, "events")
+        except Exception as e:
+            LOG_JOB.debug("Can not enable migration events: %s", e)
+            return False
+        monitor.clear_event("MIGRATION")
+        return True
+
+    def start(self):
+        """Start sampling, call it before migration is started"""
+        self._use_event = self._enable_event()
+        self._thread = threading.Thread(
+            target=self._run, name="migration-sampler-%s" % self.vm.name
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread"""
+        self._stop_event.set()
+        self.join()
+
+    def join(self, timeout=None):
+        """
+        Wait for sampling to finish
+
+        :param timeout: seconds to wait
+        :return: True if the sampler thread is finished
+        """
+        if self._thread:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def _wait_active(self):
+        """
+        Wait for migration to be active or over, reading the buffered MIGRATION
+        events doesn't send any command to the monitor, 'query-migrate' is
+        sent every interval in case the event is not available or missed
+        """
+        end_time = time.time() + self.start_timeout
+        # It's active already if the sampler is started after migration
+        status = parse_migrate_info(self.vm.monitor.info("migrate"))["status"]
+        next_poll = time.time() + self.interval
+        while status not in ("active",) + FINAL_STATUSES:
+            if time.time() > end_time or self._stop_event.is_set():
+                return False
+            if self._use_event:
+                events = _pop_events(self.vm.monitor, "MIGRATION")
+                if events:
+                    # "setup" and "active" are often received together
+                    status = events[-1]["data"]["status"]
+                    continue
+                self._stop_event.wait(0.05)
+                if time.time() < next_poll:
+                    continue
+            else:
+                self._stop_event.wait(self.interval)
+            next_poll = time.time() + self.interval
+            status = parse_migrate_info(self.vm.monitor.info("migrate"))["status"]
+        return True
+
+    def _run(self):
+        try:
+            if not self._wait_active():
+                LOG_JOB.warning("Migration of %s is not active", self.vm.name)
+                return
+            self.started = True
+            start_time = time.time()
+            next_time = start_time
+            while not self._stop_event.is_set():
+                info = self.vm.monitor.info("migrate")
+                sample = parse_migrate_info(info)
+                sample["time"] = time.time() - start_time
+                sample.update(self._sample_extra())
+                self.samples.append(sample)
+                if sample["status"] in FINAL_STATUSES:
+                    break
+                if self.max_samples and len(self.active_samples()) >= self.max_samples:
+                    break
+                next_time += self.interval
+                self._stop_event.wait(max(next_time - time.time(), 0))
+        except Exception as e:
+            LOG_JOB.error("Migration sampler of %s failed: %s", self.vm.name, e)
+            self.error = e
+
+    def _sample_extra(self):
+        """Get the extra fields of a sample, for the subclasses"""
+        return {}
+
+    def active_samples(self):
+        """Get the samples taken while migration is active"""
+        return [s for s in self.samples if s["status"] == "active"]
+
+    @property
+    def final_status(self):
+        return self.samples[-1]["status"] if self.samples else None
+
+    def ended_early(self):
+        """Check migration is over before max_samples are taken"""
+        if not self.max_samples:
+            return False
+        return len(self.active_samples()) < self.max_samples
+
+    def series(self, name, active_only=True):
+        """
+        Get the time series of a field
+
+        :param name: field name, e.g. 'remaining'
+        :param active_only: only get the values of active samples
+        :return: list of (time, value)
+        """
+        samples = self.active_samples() if active_only else self.samples
+        return [(s["time"], s[name]) for s in samples if s.get(name) is not None]
+
+    def speeds(self):
+        """
+        Get the migration speeds between the active samples by the
+        transferred bytes and the elapsed time
+
+        :return: list of speeds in MB/s
+        """
+        points = self.series("transferred")
+        speeds = []
+        for (t0, v0), (t1, v1) in zip(points, points[1:]):
+            if t1 > t0:
+                speeds.append((v1 - v0) / (t1 - t0) / (1024 * 1024))
+        return speeds
+
+    def summary(self, name=None):
+        """
+        Get the summary statistics of a field or of the speeds
+
+        :param name: field name, the speeds if it's None
+        :return: dict of perf_stats.summarize or None without samples
+        """
+        if name is None:
+            values = self.speeds()
+        else:
+            values = [v for _, v in self.series(name)]
+        if not values:
+            return None
+        return perf_stats.summarize(values)
+
+    def log_summary(self):
+        """Log the summary of the speeds and the progress"""
+        for name in (None, "remaining", "dirty_pages_rate", "throughput"):
+            summary = self.summary(name)
+            if summary:
+                LOG_JOB.info(
+                    "Migration %s: mean %.2f, min %.2f, max %.2f, p50 %.2f, "
+                    "p90 %.2f, p99 %.2f (%d samples)",
+                    name or "speed (MB/s)",
+                    summary["mean"],
+                    summary["min"],
+                    summary["max"],
+                    summary["p50"],
+                    summary["p90"],
+                    summary["p99"],
+                    summary["n"],
+                )
+        downtime = [v for _, v in self.series("downtime", active_only=False)]
+        if downtime:
+            LOG_JOB.info("Migration downtime: %s ms", downtime[-1])
+
+
+def _read_host_cpu_times():
+    """Get the (busy, total) jiffies of all host CPUs from /proc/stat"""
+    with open("/proc/stat") as fd:
+        fields = [int(f) for f in fd.readline().split()[1:]]
+    # idle and iowait are the 4th and 5th fields
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
+
+
+def _read_thread_cpu_time(pid, tid):
+    """Get the utime + stime jiffies of a thread, None if it's gone"""
+    try:
+        with open("/proc/%s/task/%s/stat" % (pid, tid)) as fd:
+            stat = fd.read()
+    except (IOError, OSError):
+        return None
+    # Fields after the command name, utime and stime are the 14th and 15th
+    fields = stat.rpartition(")")[2].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def _pearson(xs, ys):
+    """Pearson correlation coefficient, None if it's undefined"""
+    if len(xs) < 3:
+        return None
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+    if not var_x or not var_y:
+        return None
+    return cov / math.sqrt(var_x * var_y)
+
+
+class AutoConvergeAnalyzer(MigrationSampler):
+    """
+    Sample the host CPU utilization from /proc/stat and the vCPU threads
+    utilization from /proc/<qemu pid>/task on the same timeline as the
+    migration progress, then analyze how auto-converge throttles the guest
+
+    Each sample has extra fields:
+      host_cpu: host CPU utilization (%)
+      vcpu_util: the average utilization of the vCPU threads (%)
+    """
+
+    def __init__(self, vm, interval=1.0, max_samples=None, start_timeout=60):
+        super(AutoConvergeAnalyzer, self).__init__(
+            vm, interval, max_samples, start_timeout
+        )
+        self._pid = vm.get_pid()
+        self._vcpu_tids = list(getattr(vm, "vcpu_threads", None) or [])
+        if not self._vcpu_tids:
+            self._vcpu_tids = self._find_vcpu_threads()
+        self._hz = os.sysconf("SC_CLK_TCK")
+        self._last = None
+
+    def _find_vcpu_threads(self):
+        """Find the vCPU threads of QEMU by their names"""
+        tids = []
+        task_dir = "/proc/%s/task" % self._pid
+        for tid in os.listdir(task_dir):
+            try:
+                with open(os.path.join(task_dir, tid, "comm")) as fd:
+                    comm = fd.read()
+            except (IOError, OSError):
+                continue
+            if re.match(r"CPU \d+/KVM", comm):
+                tids.append(int(tid))
+        return sorted(tids)
+
+    def _read_times(self):
+        return (
+            time.time(),
+            _read_host_cpu_times(),
+            [_read_thread_cpu_time(self._pid, tid) for tid in self._vcpu_tids],
+        )
+
+    def start(self):
+        self._last = self._read_times()
+        super(AutoConvergeAnalyzer, self).start()
+
+    def _sample_extra(self):
+        now = self._read_times()
+        last, self._last = self._last, now
+        elapsed = now[0] - last[0]
+        busy, total = now[1][0] - last[1][0], now[1][1] - last[1][1]
+        utils = [
+            100.0 * (cur - prev) / (elapsed * self._hz)
+            for prev, cur in zip(last[2], now[2])
+            if prev is not None and cur is not None and elapsed > 0
+        ]
+        return {
+            "host_cpu": 100.0 * busy / total if total else None,
+            "vcpu_util": sum(utils) / len(utils) if utils else None,
+        }
+
+    def throttle_series(self):
+        """Get the series of the CPU throttle percentage"""
+        return self.series("cpu_throttle", active_only=False)
+
+    def report(self):
+        """
+        Analyze the samples
+
+        :return: dict with
+                 duration: seconds from the first to the last sample
+                 final_status: the final status of migration
+                 throttle_start: time when throttling starts
+                 throttle_max: the maximum throttle percentage
+                 time_to_max_throttle: seconds from throttling to its maximum
+                 convergence_time: seconds from throttling to completion
+                 dirty_rate_before/dirty_rate_after: the average dirty page
+                   rate before throttling and in the last quarter of it
+                 vcpu_util_before/vcpu_util_during: the average vCPU threads
+                   utilization before and during throttling
+                 host_cpu: the average host CPU utilization
+                 vcpu_util: the average vCPU threads utilization
+                 throttle_vcpu_corr: correlation between the throttle
+                   percentage and the vCPU threads utilization, it should be
+                   negative if throttling is effective
+        """
+
+        def _avg(samples, name):
+            values = [s[name] for s in samples if s.get(name) is not None]
+            return sum(values) / len(values) if values else None
+
+        samples = self.samples
+        report = {
+            "duration": samples[-1]["time"] if samples else 0,
+            "final_status": self.final_status,
+            "host_cpu": _avg(samples, "host_cpu"),
+            "vcpu_util": _avg(samples, "vcpu_util"),
+        }
+        throttled = [s for s in samples if s.get("cpu_throttle")]
+        before = [s for s in samples if not s.get("cpu_throttle")]
+        report["vcpu_util_before"] = _avg(before, "vcpu_util")
+        report["dirty_rate_before"] = _avg(before, "dirty_pages_rate")
+        if not throttled:
+            report.update(
+                {
+                    "throttle_start": None,
+                    "throttle_max": 0,
+                    "time_to_max_throttle": None,
+                    "convergence_time": None,
+                    "dirty_rate_after": None,
+                    "vcpu_util_during": None,
+                    "throttle_vcpu_corr": None,
+                }
+            )
+            return report
+
+        start = throttled[0]["time"]
+        peak = max(throttled, key=lambda s: s["cpu_throttle"])
+        report["throttle_start"] = start
+        report["throttle_max"] = peak["cpu_throttle"]
+        report["time_to_max_throttle"] = peak["time"] - start
+        report["convergence_time"] = (
+            samples[-1]["time"] - start if self.final_status == "completed" else None
+        )
+        report["dirty_rate_after"] = _avg(
+            throttled[-max(len(throttled) // 4, 1) :], "dirty_pages_rate"
+        )
+        report["vcpu_util_during"] = _avg(throttled, "vcpu_util")
+        pairs = [
+            (s.get("cpu_throttle") or 0, s["vcpu_util"])
+            for s in samples
+            if s.get("vcpu_util") is not None
+        ]
+        report["throttle_vcpu_corr"] = _pearson(
+            [p[0] for p in pairs], [p[1] for p in pairs]
+        )
+        return report
+
+    def log_report(self):
+        """Log the timeline and the analysis"""
+        for s in self.samples:
+            LOG_JOB.debug(
+                "t=%.1fs status=%s throttle=%s%% dirty_rate=%s host_cpu=%s "
+                "vcpu_util=%s",
+                s["time"],
+                s["status"],
+                s.get("cpu_throttle"),
+                s.get("dirty_pages_rate"),
+                s.get("host_cpu"),
+                s.get("vcpu_util"),
+            )
+        report = self.report()
+        LOG_JOB.info("Auto-converge analysis: %s", report)
+        return report
@@ -1,9 +1,15 @@
 import logging
 import os
+import re
+import threading
+import time
 
+import aexpect
 import six
 from avocado.utils import process
-from virttest import data_dir, error_context, remote, utils_misc, utils_test
+from virttest import data_dir, error_context, remote, utils_misc
+
+from provider import cpu_affinity
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -16,7 +22,7 @@ def pin_vm_threads(vm, node):
     if node:
         if not isinstance(node, utils_misc.NumaNode):
             node = utils_misc.NumaNode(int(node))
-        utils_test.qemu.pin_vm_threads(vm, node)
+        cpu_affinity.pin_vm_threads(vm, node)
 
     return node
 
@@ -26,19 +32,24 @@ def record_env_version(test, params, host, server_ctl, fd, test_duration):
     """
     Get host kernel/qemu/guest kernel version
 
+    :return: dict of the versions
     """
     ver_cmd = params.get("ver_cmd", "rpm -q qemu-kvm")
     guest_ver_cmd = params.get("guest_ver_cmd", "uname -r")
 
-    test.write_test_keyval({"kvm-userspace-ver": ssh_cmd(host, ver_cmd).strip()})
-    test.write_test_keyval(
-        {"guest-kernel-ver": ssh_cmd(server_ctl, guest_ver_cmd).strip()}
-    )
+    env = {
+        "kvm-userspace-ver": ssh_cmd(host, ver_cmd).strip(),
+        "guest-kernel-ver": ssh_cmd(server_ctl, guest_ver_cmd).strip(),
+        "kvm_version": os.uname()[2],
+    }
+    test.write_test_keyval({"kvm-userspace-ver": env["kvm-userspace-ver"]})
+    test.write_test_keyval({"guest-kernel-ver": env["guest-kernel-ver"]})
     test.write_test_keyval({"session-length": test_duration})
-    fd.write("### kvm-userspace-ver : %s\n" % ssh_cmd(host, ver_cmd).strip())
-    fd.write("### guest-kernel-ver : %s\n" % ssh_cmd(server_ctl, guest_ver_cmd).strip())
-    fd.write("### kvm_version : %s\n" % os.uname()[2])
+    fd.write("### kvm-userspace-ver : %s\n" % env["kvm-userspace-ver"])
+    fd.write("### guest-kernel-ver : %s\n" % env["guest-kernel-ver"])
+    fd.write("### kvm_version : %s\n" % env["kvm_version"])
     fd.write("### session-length : %s\n" % test_duration)
+    return env
 
 
 def env_setup(test, params, session, ip, username, shell_port, password):
@@ -157,3 +168,220 @@ def netperf_record(results, filter_list, header=False, base="17", fbase="2"):
         record += "%s|" % format_result(results[key], base=base, fbase=fbase)
     record = record.rstrip("|")
     return record, key_list
+
+
+class NetperfResultCollector(object):
+    """
+    Collect the output of netperf_agent.py by tailing its result file once
+    over a persistent channel, the output is parsed line by line while
+    netperf is running.
+    """
+
+    _INTERIM_RE = re.compile(r"Interim result:\s*(\S+)(?:.*ending at\s+(\S+))?")
+
+    def __init__(self, sessions):
+        """
+        :param sessions: the expected number of netperf sessions
+        """
+        self.sessions = int(sessions)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._started = 0
+        # lines after the last netperf header, None for non-result lines
+        self._results = []
+        # end timestamp of interim result -> summed result of all sessions
+        self._series = {}
+        self._channel = None
+        self._output_func = None
+
+    def feed(self, line):
+        """Parse one line of the netperf_agent.py output"""
+        with self._lock:
+            if "AF_INET" in line:
+                self._results = []
+            else:
+                match = self._INTERIM_RE.search(line)
+                value = float(match.group(1)) if match else None
+                self._results.append(value)
+                if match and match.group(2):
+                    second = int(float(match.group(2)))
+                    self._series[second] = self._series.get(second, 0.0) + value
+            if "MIGRATE" in line:
+                self._started += 1
+                if self._started >= self.sessions:
+                    self._ready.set()
+
+    def start(self, session, fname):
+        """
+        Start tailing the result file
+
+        :param session: a remote shell session or tag for localhost
+        :param fname: the result file of netperf_agent.py
+        """
+        cmd = "tail -n +1 -F %s 2>/dev/null" % fname
+        if session == "localhost":
+            self._channel = aexpect.Tail(cmd, output_func=self.feed)
+        else:
+            self._channel = session
+            self._output_func = session.output_func
+            session.set_output_func(self.feed)
+            session.sendline(cmd)
+
+    def stop(self):
+        """Stop tailing the result file"""
+        if self._channel is None:
+            return
+        if isinstance(self._channel, aexpect.ShellSession):
+            self._channel.sendcontrol("c")
+            self._channel.set_output_func(self._output_func)
+            try:
+                self._channel.read_up_to_prompt(timeout=10)
+            except aexpect.ExpectError as err:
+                LOG_JOB.warning("Failed to stop tailing netperf result: %s", err)
+        else:
+            self._channel.close()
+        self._channel = None
+
+    def wait_ready(self, timeout):
+        """Block until all netperf sessions start to work"""
+        return self._ready.wait(timeout)
+
+    def get_result(self):
+        """
+        Compute the result in the same way as the demo mode of netperf:
+        the interim results after the last netperf header are summed per
+        iteration and averaged over iterations.
+
+        :return: tuple of (averaged result, iterations, results number)
+        """
+        with self._lock:
+            results = list(self._results)
+        nresult = len(results)
+        niteration = nresult // self.sessions
+        if not niteration:
+            return 0.0, 0, nresult
+        values = results[-self.sessions * niteration :]
+        return sum(v for v in values if v) / niteration, niteration, nresult
+
+    def get_series(self):
+        """
+        Get the throughput curve
+
+        :return: list of (second, summed interim result of all sessions)
+        """
+        with self._lock:
+            return sorted(self._series.items())
+
+
+class NetState(object):
+    """
+    Snapshot of the network counters of a netperf endpoint, snapshots
+    can be subtracted to get the counter deltas of an interval.
+    """
+
+    def __init__(self, counters, timestamp=None):
+        """
+        :param counters: dict of counter name and value, the order of the
+                         counters is kept
+        :param timestamp: time when the snapshot is taken
+        """
+        self.counters = counters
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def __sub__(self, other):
+        if list(self.counters) != list(other.counters):
+            raise ValueError(
+                "Counters mismatch:\n  %s\n  %s" % (self.counters, other.counters)
+            )
+        counters = dict((k, v - other.counters[k]) for k, v in self.counters.items())
+        return NetState(counters, self.timestamp - other.timestamp)
+
+    def __getitem__(self, name):
+        return self.counters[name]
+
+    def items(self):
+        return self.counters.items()
+
+    def __repr__(self):
+        return "NetState(%s)" % self.counters
+
+
+class NetStateSampler(object):
+    """
+    Sample NIC statistics, per-queue interrupts and TCP retransmissions of
+    the netperf server with one command, and KVM exits with one command on
+    host. The sysfs path of the NIC is resolved only once.
+    """
+
+    _SEP = "@@@"
+
+    def __init__(self, server_ctl, host, server_ip):
+        """
+        :param server_ctl: shell session to control the netperf server
+        :param host: shell session or tag for localhost of the host
+        :param server_ip: ip of the netperf server
+        """
+        self._server_ctl = server_ctl
+        self._host = host
+        ifname = None
+        for i in ssh_cmd(server_ctl, "ifconfig").split("\n\n"):
+            if server_ip in i:
+                ifname = re.findall(r"(\w+\d+)[:\s]", i)[0]
+        if ifname is None:
+            raise RuntimeError(f"no available iface associated with {server_ip}")
+        stat_dir = "/sys/class/net/%s/statistics" % ifname
+        stats = " ".join(
+            "%s/%s" % (stat_dir, n)
+            for n in ("rx_packets", "tx_packets", "rx_bytes", "tx_bytes")
+        )
+        self._guest_cmd = (
+            "cat {stats}; echo {sep}; grep Tcp: /proc/net/snmp | tail -1; "
+            "echo {sep}; grep -E 'CPU0|virtio' /proc/interrupts".format(
+                stats=stats, sep=self._SEP
+            )
+        )
+
+    @staticmethod
+    def _count_interrupts(lines, ncpu, pattern):
+        """Sum the per-cpu counts of each interrupt line matching pattern"""
+        return [
+            sum(int(c) for c in line.split()[1 : ncpu + 1])
+            for line in lines
+            if re.search(pattern, line)
+        ]
+
+    def sample(self):
+        """
+        Take a snapshot of all counters
+
+        :return: NetState object
+        """
+        timestamp = time.time()
+        output = ssh_cmd(self._server_ctl, self._guest_cmd)
+        nic, snmp, interrupts = output.split(self._SEP)[-3:]
+        nrx, ntx, nrxb, ntxb = map(int, nic.split()[-4:])
+        counters = {
+            "rx_pkts": nrx,
+            "tx_pkts": ntx,
+            "rx_byts": nrxb,
+            "tx_byts": ntxb,
+            "re_pkts": int(snmp.split()[12]),
+        }
+
+        lines = interrupts.strip().splitlines()
+        ncpu = len(lines[0].split())
+        rx_intr = self._count_interrupts(lines[1:], ncpu, r"virtio.-input")
+        tx_intr = self._count_interrupts(lines[1:], ncpu, r"virtio.-output")
+        if rx_intr:
+            for direction, intr in (("rx", rx_intr), ("tx", tx_intr)):
+                for i, count in enumerate(intr):
+                    counters["%s_intr_%s" % (direction, i)] = count
+                counters["%s_intr_sum" % direction] = sum(intr)
+        else:
+            intr = self._count_interrupts(lines[1:], ncpu, r"virtio.")
+            for i, count in enumerate(intr):
+                counters["intr_%s" % i] = count
+            counters["intr_sum"] = sum(intr)
+
+        counters["exits"] = int(ssh_cmd(self._host, "cat /sys/kernel/debug/kvm/exits"))
+        return NetState(counters, timestamp)
@@ -0,0 +1,317 @@
+"""
+Module for storing the results of performance tests.
+
+Results are recorded as typed metric rows and appended to a file, one JSON
+document per run with its rows stored column by column, so the results of
+different runs can be queried and compared without scraping text reports.
+
+Available classes:
+- PerfResultStore: The append-only result store, provides interfaces about
+                   recording, querying and comparing runs.
+- PerfRun: The metric rows of one run, which are appended to the store
+           when it's committed.
+
+Available methods:
+- params_hash: Get the hash of the test params.
+- check_regressions: Compare a run with its baseline in the store.
+
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+DEFAULT_STORE_NAME = "perf_results.jsonl"
+
+# The params which affect the performance of all tests, the tests add their
+# own ones, e.g. the fio options
+DEFAULT_HASH_KEYS = (
+    "machine_type",
+    "smp",
+    "vcpu_maxcpus",
+    "mem",
+    "os_variant",
+    "image_format",
+    "drive_format",
+    "nic_model",
+)
+
+
+def params_hash(params, keys=None):
+    """
+    Get the hash of the test params, runs with the same hash are comparable
+
+    :param params: Params object or dict
+    :param keys: the keys to hash, DEFAULT_HASH_KEYS by default
+    :return: sha1 hex string
+    """
+    if keys is None:
+        keys = DEFAULT_HASH_KEYS
+    items = sorted((str(k), str(params.get(k))) for k in set(keys))
+    return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+
+class PerfRun(object):
+    """Metric rows of one run of a performance test"""
+
+    def __init__(self, store, test, phash, env=None):
+        """
+        :param store: PerfResultStore object
+        :param test: test name
+        :param phash: hash of the test params
+        :param env: dict of the environment info, e.g. host/guest versions
+        """
+        self.store = store
+        self.run_id = uuid.uuid4().hex
+        self.test = test
+        self.params_hash = phash
+        self.env = env or {}
+        self.timestamp = time.time()
+        self.columns = {"metric": [], "value": [], "samples": [], "keys": []}
+
+    def add(self, metric, value, samples=None, **keys):
+        """
+        Add a metric row
+
+        :param metric: metric name, e.g. 'iops'
+        :param value: metric value
+        :param samples: list of the sample values of the metric
+        :param keys: the scenario of the metric, e.g. bs='4k', iodepth=1
+        """
+        self.columns["metric"].append(str(metric))
+        self.columns["value"].append(float(value))
+        self.columns["samples"].append([float(s) for s in samples or []])
+        self.columns["keys"].append(keys)
+
+    def commit(self):
+        """Append the run to the store"""
+        self.store.append(self)
+
+    def as_dict(self):
+        return {
+            "run_id": self.run_id,
+            "test": self.test,
+            "params_hash": self.params_hash,
+            "env": self.env,
+            "timestamp": self.timestamp,
+            "columns": self.columns,
+        }
+
+
+class PerfResultStore(object):
+    """Append-only store of performance results"""
+
+    def __init__(self, path):
+        """
+        :param path: path of the store file
+        """
+        self.path = path
+
+    @classmethod
+    def from_params(cls, params, default_dir):
+        """
+        Get the store set by 'perf_result_store', which should be shared
+        across runs to compare them, or the one in default_dir
+
+        :param params: Params object or dict
+        :param default_dir: directory of the default store, e.g. resultsdir
+        """
+        path = params.get("perf_result_store")
+        if not path:
+            path = os.path.join(default_dir, DEFAULT_STORE_NAME)
+        return cls(path)
+
+    def new_run(self, test, params, env=None, hash_keys=None):
+        """
+        Start a new run
+
+        :param test: test name
+        :param params: Params object or dict
+        :param env: dict of the environment info
+        :param hash_keys: the params keys of the test which identify the
+                          comparable runs besides DEFAULT_HASH_KEYS, both are
+                          overridden by the param 'perf_hash_keys' if set
+        :return: PerfRun object
+        """
+        keys = params.get("perf_hash_keys", "").split()
+        if not keys:
+            keys = DEFAULT_HASH_KEYS + tuple(hash_keys or ())
+        return PerfRun(self, test, params_hash(params, keys), env)
+
+    def append(self, run):
+        """Append a run to the store file"""
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        line = json.dumps(run.as_dict(), sort_keys=True)
+        with open(self.path, "a") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                fd.write(line + "\n")
+                fd.flush()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        LOG_JOB.debug(
+            "Recorded %d perf results of run %s into %s",
+            len(run.columns["metric"]),
+            run.run_id,
+            self.path,
+        )
+
+    def runs(self, test=None, params_hash=None, run_id=None):
+        """
+        Get the runs matching the filters, in the order they are recorded
+
+        :return: generator of run dicts
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as fd:
+            for line in fd:
+                if not line.strip():
+                    continue
+                run = json.loads(line)
+                if test is not None and run["test"] != test:
+                    continue
+                if params_hash is not None and run["params_hash"] != params_hash:
+                    continue
+                if run_id is not None and run["run_id"] != run_id:
+                    continue
+                yield run
+
+    def query(self, test=None, metric=None, params_hash=None, run_id=None, **keys):
+        """
+        Get the metric rows matching the filters
+
+        :param keys: filter by the scenario keys of the rows
+        :return: generator of row dicts
+        """
+        for run in self.runs(test, params_hash, run_id):
+            columns = run["columns"]
+            for idx, name in enumerate(columns["metric"]):
+                if metric is not None and name != metric:
+                    continue
+                row_keys = columns["keys"][idx]
+                if any(row_keys.get(k) != v for k, v in keys.items()):
+                    continue
+                yield {
+                    "run_id": run["run_id"],
+                    "test": run["test"],
+                    "params_hash": run["params_hash"],
+                    "env": run["env"],
+                    "timestamp": run["timestamp"],
+                    "metric": name,
+                    "value": columns["value"][idx],
+                    "samples": columns["samples"][idx],
+                    "keys": row_keys,
+                }
+
+    def get_baseline(self, run):
+        """
+        Get the latest recorded run comparable with the given one
+
+        :param run: PerfRun object
+        :return: run dict or None
+        """
+        baseline = None
+        for recorded in self.runs(run.test, run.params_hash):
+            if recorded["run_id"] != run.run_id:
+                baseline = recorded
+        return baseline
+
+    def compare(self, baseline_id, candidate_id, thresholds=None, lower_is_better=()):
+        """
+        Compare the metrics of two runs
+
+        :param baseline_id: run ID of the baseline
+        :param candidate_id: run ID of the candidate
+        :param thresholds: dict of metric name and the allowed relative
+                           change, the key 'default' is used for the others
+        :param lower_is_better: names of the metrics which are better when
+                                they are lower, e.g. latency
+        :return: list of dicts with metric, keys, baseline, candidate,
+                 change and regression
+        """
+        thresholds = thresholds or {}
+        default_threshold = thresholds.get("default", 0.05)
+
+        def _rows(run_id):
+            return dict(
+                ((r["metric"], json.dumps(r["keys"], sort_keys=True)), r)
+                for r in self.query(run_id=run_id)
+            )
+
+        baseline_rows = _rows(baseline_id)
+        results = []
+        for key, row in _rows(candidate_id).items():
+            if key not in baseline_rows:
+                continue
+            metric = row["metric"]
+            base = baseline_rows[key]["value"]
+            change = (row["value"] - base) / base if base else 0.0
+            if metric in lower_is_better:
+                change = -change
+            results.append(
+                {
+                    "metric": metric,
+                    "keys": row["keys"],
+                    "baseline": base,
+                    "candidate": row["value"],
+                    "change": change,
+                    "regression": change < -thresholds.get(metric, default_threshold),
+                }
+            )
+        return results
+
+
+def check_regressions(test, params, store, run, lower_is_better=()):
+    """
+    Compare a committed run with its baseline in the store, regressions are
+    logged as warnings, and fail the test if 'perf_regression_fail' is yes
+
+    The thresholds are set by 'perf_regression_threshold' and
+    'perf_regression_threshold_<metric>', e.g.
+      perf_regression_threshold = 0.05
+      perf_regression_threshold_iops = 0.1
+
+    :param test: QEMU test object
+    :param params: Params object or dict
+    :param store: PerfResultStore object
+    :param run: PerfRun object
+    :param lower_is_better: names of the metrics which are better when
+                            they are lower
+    :return: list of the regressed results
+    """
+    baseline = store.get_baseline(run)
+    if baseline is None:
+        LOG_JOB.info("No baseline for %s in %s", run.test, store.path)
+        return []
+
+    thresholds = {"default": float(params.get("perf_regression_threshold", 0.05))}
+    for metric in set(run.columns["metric"]):
+        threshold = params.get("perf_regression_threshold_%s" % metric)
+        if threshold is not None:
+            thresholds[metric] = float(threshold)
+    results = store.compare(baseline["run_id"], run.run_id, thresholds, lower_is_better)
+    regressions = [r for r in results if r["regression"]]
+    for r in regressions:
+        LOG_JOB.warning(
+            "Perf regression of %s %s: %s -> %s (%.2f%%)",
+            r["metric"],
+            r["keys"],
+            r["baseline"],
+            r["candidate"],
+            r["change"] * 100,
+        )
+    if regressions and params.get("perf_regression_fail") == "yes":
+        test.fail(
+            "%d perf regressions against run %s"
+            % (len(regressions), baseline["run_id"])
+        )
+    return regressions
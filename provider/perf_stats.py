@@ -0,0 +1,318 @@
+"""
+Module for the statistics of performance results.
+
+The functions work on the samples of a metric, e.g. the iops of each fio
+iteration. NumPy is used when it's installed, otherwise they fall back to
+pure Python implementations with the same results.
+
+Available methods:
+- percentile: Get the percentile of samples.
+- reject_outliers: Split samples into kept ones and outliers (MAD/IQR).
+- confidence_interval: Get the confidence interval of the mean.
+- welch_t_test: Welch's t-test between two groups of samples.
+- compare_samples: Compare candidate samples with baseline samples.
+- linear_fit: Fit a line to samples by least squares.
+- summarize: Get the summary statistics of samples.
+
+"""
+
+import math
+import statistics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The constant to scale MAD to the standard deviation of normal distribution
+MAD_SCALE = 0.6745
+
+DEFAULT_THRESHOLDS = {"mad": 3.5, "iqr": 1.5}
+
+
+def _median(values):
+    if np is not None:
+        return float(np.median(values))
+    return statistics.median(values)
+
+
+def percentile(values, q):
+    """
+    Get the q-th percentile of samples, interpolated linearly like
+    numpy.percentile
+
+    :param values: list of samples
+    :param q: percentile in range [0, 100]
+    :return: percentile value
+    """
+    if not values:
+        raise ValueError("percentile of empty samples")
+    if np is not None:
+        return float(np.percentile(values, q))
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(math.floor(pos))
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def reject_outliers(values, method="mad", threshold=None, max_drop=None):
+    """
+    Split samples into the kept ones and the outliers in one pass
+
+    mad: samples whose modified z-score 0.6745*|x-median|/MAD is greater
+         than threshold (3.5 by default) are outliers
+    iqr: samples out of [Q1 - threshold*IQR, Q3 + threshold*IQR] are
+         outliers, threshold is 1.5 by default
+
+    :param values: list of samples
+    :param method: 'mad' or 'iqr'
+    :param threshold: the threshold of the method
+    :param max_drop: the maximum number of outliers, the farthest ones
+                     are dropped if there are more
+    :return: tuple of the kept samples and the outliers, in their
+             original order
+    """
+    if method not in DEFAULT_THRESHOLDS:
+        raise ValueError("Unsupported outlier method: %s" % method)
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS[method]
+    if len(values) < 3:
+        return list(values), []
+
+    if method == "mad":
+        center = _median(values)
+        if np is not None:
+            deviations = np.abs(np.asarray(values, dtype=float) - center)
+            mad = float(np.median(deviations))
+            deviations = deviations.tolist()
+        else:
+            deviations = [abs(v - center) for v in values]
+            mad = statistics.median(deviations)
+        if mad == 0:
+            return list(values), []
+        limit = threshold * mad / MAD_SCALE
+    else:
+        q1, q3 = percentile(values, 25), percentile(values, 75)
+        iqr = q3 - q1
+        center = (q1 + q3) / 2.0
+        deviations = [abs(v - center) for v in values]
+        limit = iqr / 2.0 + threshold * iqr
+
+    outliers = [i for i, d in enumerate(deviations) if d > limit]
+    if max_drop is not None and len(outliers) > max_drop:
+        outliers.sort(key=lambda i: deviations[i], reverse=True)
+        outliers = outliers[: max(max_drop, 0)]
+    outliers = set(outliers)
+    kept = [v for i, v in enumerate(values) if i not in outliers]
+    rejected = [v for i, v in enumerate(values) if i in outliers]
+    return kept, rejected
+
+
+def _betacf(a, b, x):
+    """Continued fraction of the incomplete beta function"""
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c, d = 1.0, 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-14:
+            break
+    return h
+
+
+def _betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)"""
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    ln_front = (
+        math.lgamma(a + b)
+        - math.lgamma(a)
+        - math.lgamma(b)
+        + a * math.log(x)
+        + b * math.log(1.0 - x)
+    )
+    front = math.exp(ln_front)
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def t_sf(t, df):
+    """
+    Get the two-sided tail probability of Student's t distribution
+
+    :param t: t statistic
+    :param df: degrees of freedom
+    :return: P(|T| >= |t|)
+    """
+    if math.isinf(t):
+        return 0.0
+    return _betainc(df / 2.0, 0.5, df / (df + t * t))
+
+
+def t_ppf(confidence, df):
+    """
+    Get the two-sided critical value of Student's t distribution
+
+    :param confidence: confidence level, e.g. 0.95
+    :param df: degrees of freedom
+    :return: t such that P(|T| <= t) == confidence
+    """
+    alpha = 1.0 - confidence
+    low, high = 0.0, 1.0
+    while t_sf(high, df) > alpha:
+        high *= 2
+    for _ in range(100):
+        mid = (low + high) / 2.0
+        if t_sf(mid, df) > alpha:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2.0
+
+
+def _mean_var(values):
+    if np is not None:
+        arr = np.asarray(values, dtype=float)
+        return float(arr.mean()), float(arr.var(ddof=1)) if len(arr) > 1 else 0.0
+    mean = sum(values) / float(len(values))
+    return mean, statistics.variance(values, mean) if len(values) > 1 else 0.0
+
+
+def confidence_interval(values, confidence=0.95):
+    """
+    Get the confidence interval of the mean of samples
+
+    :param values: list of samples
+    :param confidence: confidence level
+    :return: tuple of (mean, low, high)
+    """
+    mean, var = _mean_var(values)
+    if len(values) < 2:
+        return mean, mean, mean
+    margin = t_ppf(confidence, len(values) - 1) * math.sqrt(var / len(values))
+    return mean, mean - margin, mean + margin
+
+
+def welch_t_test(baseline, candidate):
+    """
+    Welch's t-test for the means of two groups of samples
+
+    :param baseline: list of samples
+    :param candidate: list of samples
+    :return: tuple of (t statistic, degrees of freedom, two-sided p-value)
+    """
+    if len(baseline) < 2 or len(candidate) < 2:
+        raise ValueError("t-test needs at least 2 samples in each group")
+    mean1, var1 = _mean_var(baseline)
+    mean2, var2 = _mean_var(candidate)
+    se1, se2 = var1 / len(baseline), var2 / len(candidate)
+    if se1 + se2 == 0:
+        if mean1 == mean2:
+            return 0.0, float(len(baseline) + len(candidate) - 2), 1.0
+        return math.copysign(math.inf, mean2 - mean1), 1.0, 0.0
+    t = (mean2 - mean1) / math.sqrt(se1 + se2)
+    df = (se1 + se2) ** 2 / (
+        se1**2 / (len(baseline) - 1) + se2**2 / (len(candidate) - 1)
+    )
+    return t, df, t_sf(t, df)
+
+
+def compare_samples(baseline, candidate, alpha=0.05):
+    """
+    Compare candidate samples with baseline samples
+
+    :param baseline: list of samples
+    :param candidate: list of samples
+    :param alpha: significance level
+    :return: dict with baseline/candidate mean, relative change of the mean,
+             p-value and whether the difference is significant, p-value is
+             None if there are not enough samples to test
+    """
+    base_mean = _mean_var(baseline)[0]
+    cand_mean = _mean_var(candidate)[0]
+    change = (cand_mean - base_mean) / base_mean if base_mean else 0.0
+    p_value = None
+    if len(baseline) > 1 and len(candidate) > 1:
+        p_value = welch_t_test(baseline, candidate)[2]
+    return {
+        "baseline": base_mean,
+        "candidate": cand_mean,
+        "change": change,
+        "p_value": p_value,
+        "significant": p_value is not None and p_value < alpha,
+    }
+
+
+def linear_fit(xs, ys, confidence=0.95):
+    """
+    Fit a line to samples by least squares
+
+    :param xs: list of the x of samples
+    :param ys: list of the y of samples
+    :param confidence: confidence level of the slope
+    :return: dict with slope, intercept, r2 and ci (low, high) of the slope
+    """
+    n = len(xs)
+    if n < 3:
+        raise ValueError("At least 3 samples are needed, got %d" % n)
+    mean_x = sum(xs) / float(n)
+    mean_y = sum(ys) / float(n)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if not sxx:
+        raise ValueError("linear fit of samples with the same x")
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    intercept = mean_y - slope * mean_x
+    sse = sum((y - intercept - slope * x) ** 2 for x, y in zip(xs, ys))
+    syy = sum((y - mean_y) ** 2 for y in ys)
+    margin = t_ppf(confidence, n - 2) * math.sqrt(sse / (n - 2) / sxx)
+    return {
+        "slope": slope,
+        "intercept": intercept,
+        "r2": 1.0 - sse / syy if syy else 1.0,
+        "ci": (slope - margin, slope + margin),
+    }
+
+
+def summarize(values, percentiles=(50, 90, 99), confidence=0.95):
+    """
+    Get the summary statistics of samples
+
+    :param values: list of samples
+    :param percentiles: the percentiles to get
+    :param confidence: confidence level of the mean
+    :return: dict with n, mean, stdev, cv (stdev/mean), min, max,
+             p<N> of each percentile and ci (low, high)
+    """
+    mean, var = _mean_var(values)
+    stdev = math.sqrt(var)
+    summary = {
+        "n": len(values),
+        "mean": mean,
+        "stdev": stdev,
+        "cv": stdev / mean if mean else 0.0,
+        "min": min(values),
+        "max": max(values),
+        "ci": confidence_interval(values, confidence)[1:],
+    }
+    for q in percentiles:
+        summary["p%s" % q] = percentile(values, q)
+    return summary
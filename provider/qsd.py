@@ -34,15 +34,39 @@ qsd.start_daemon()
 qsd.monitor.cmd("query-block-exports")
 # Stop the QSD
 qsd.stop_daemon()
+
+# Pool mode: reuse a warm QSD started with the same binary and
+# qsd_cmd_lines by previous tests, the images are attached and
+# exported via QMP, and detached when the QSD is stopped.
+qsd_pool_qsd1 = yes
+# The directory shared by the tests to keep the warm QSDs
+qsd_pool_dir = /var/tmp/qsd_pool
+# The maximum idle QSDs with the same options kept in the pool
+qsd_pool_size = 2
+# The QSDs idle for more than qsd_pool_max_idle seconds are killed when
+# a test starts a pooled QSD
+qsd_pool_max_idle = 600
+# Kill all the idle QSDs of the pool when the QSD is stopped, set it for
+# the last test of the job, so no QSD is left behind
+qsd_pool_reap = yes
 """
 
 import copy
+import fcntl
+import glob
+import hashlib
 import json
 import logging
 import os
 import re
+import shlex
+import shutil
 import signal
+import socket
 import subprocess
+import threading
+import time
+import uuid
 from enum import Enum, auto
 
 from avocado.utils import process
@@ -55,6 +79,101 @@ from virttest.utils_params import Params
 
 LOG_JOB = logging.getLogger("avocado.test")
 
+# Version and help text of QSD binaries, keyed by (realpath, mtime)
+_BINARY_INFO = {}
+_BINARY_INFO_LOCK = threading.Lock()
+
+
+def _get_binary_info(binary):
+    """
+    Get the version and help text of a QSD binary, they are probed once per
+    process and probed again only when the binary is replaced
+
+    :param binary: path of the QSD binary
+    :return: tuple of (version, help text)
+    """
+    path = os.path.realpath(binary)
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        key = (path, None)
+    with _BINARY_INFO_LOCK:
+        if key not in _BINARY_INFO:
+            version = process.run(
+                "%s -V" % binary, verbose=False, ignore_status=True
+            ).stdout_text.split()[2]
+            help_text = process.run(
+                "%s -h" % binary, verbose=False, ignore_status=True
+            ).stdout_text
+            _BINARY_INFO[key] = (version, help_text)
+        return _BINARY_INFO[key]
+
+
+def _find_qsd_pids(sock_path):
+    """
+    Find the QSD processes using the monitor socket by scanning /proc
+
+    :param sock_path: path of the QSD monitor socket
+    :return: list of pids
+    """
+    sock_path = sock_path.encode()
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % entry, "rb") as fd:
+                argv = fd.read().split(b"\0")
+        except (IOError, OSError):
+            continue
+        if b"qemu-storage-d" not in os.path.basename(argv[0]):
+            continue
+        if any(sock_path in arg for arg in argv[1:]):
+            pids.append(int(entry))
+    return pids
+
+
+def _is_pid_alive(pid):
+    """Check the process exists and is not a zombie via /proc"""
+    try:
+        with open("/proc/%s/stat" % pid) as fd:
+            stat = fd.read()
+    except (IOError, OSError):
+        return False
+    # The state follows the command name, which may contain spaces
+    return stat.rpartition(")")[2].split()[0] not in ("Z", "X")
+
+
+def _read_pidfile(pidfile):
+    """Get the pid in the pidfile, empty string if it's not written yet"""
+    try:
+        with open(pidfile) as fd:
+            return fd.read().strip()
+    except (IOError, OSError):
+        return ""
+
+
+def _to_legacy_address(addr):
+    """
+    Convert the flat SocketAddress of the command line to the
+    SocketAddressLegacy of QMP nbd-server-start, e.g.
+    {"type": "unix", "path": p} -> {"type": "unix", "data": {"path": p}}
+    """
+    data = dict((k, v) for k, v in addr.items() if k != "type")
+    return {"type": addr["type"], "data": data}
+
+
+def _socket_accepts(sock_path):
+    """Check the unix socket accepts connections"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
 
 class Flags(Enum):
     """Enumerate the flags of QSD capabilities."""
@@ -190,6 +309,198 @@ def unplug_vubp_devices(vm, img_name, params, bus=None):
                 LOG_JOB.info("Ignore device %s Can not be found", dev.get_qid())
 
 
+class _QsdPoolSlot(object):
+    """A warm QSD in the pool, it's locked while a test is using it"""
+
+    def __init__(self, path, lock_fd):
+        self.path = path
+        self.lock_fd = lock_fd
+        self.sock_path = os.path.join(path, "monitor.sock")
+        self.pidfile = os.path.join(path, "qsd.pid")
+        self.info_path = os.path.join(path, "info.json")
+        self.info = {}
+        if os.path.exists(self.info_path):
+            with open(self.info_path) as fd:
+                self.info = json.load(fd)
+
+    def save(self):
+        with open(self.info_path, "w") as fd:
+            json.dump(self.info, fd)
+
+    def unlock(self):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        os.close(self.lock_fd)
+
+
+class QsdPool(object):
+    """
+    Warm QSDs shared across tests, keyed by the binary and its options.
+
+    Each QSD lives in its own directory of the pool directory with a lock
+    file, which is locked by the test using the QSD. The lock is released
+    when the test process exits, so the QSD of a crashed test is handed
+    out again and checked for leaks before it's used.
+
+    The QSDs idle for more than max_idle seconds are killed by reap(), which
+    is called when a pooled QSD is started, and by the test which sets
+    qsd_pool_reap to kill all the idle QSDs at the end of the job.
+    """
+
+    def __init__(self, pool_dir, size=2, max_idle=600):
+        """
+        :param pool_dir: directory of the pool
+        :param size: the maximum idle QSDs with the same key
+        :param max_idle: seconds an idle QSD is kept, 0 to keep it forever
+        """
+        self.pool_dir = pool_dir
+        self.size = size
+        self.max_idle = max_idle
+        if not os.path.isdir(pool_dir):
+            os.makedirs(pool_dir)
+
+    @classmethod
+    def from_params(cls, params):
+        pool_dir = params.get(
+            "qsd_pool_dir", os.path.join(data_dir.get_data_dir(), "qsd", "pool")
+        )
+        return cls(
+            pool_dir,
+            int(params.get("qsd_pool_size", 2)),
+            float(params.get("qsd_pool_max_idle", 600)),
+        )
+
+    @staticmethod
+    def get_key(binary, cmd_lines):
+        """
+        Get the key of QSDs, QSDs are shared only if they are started from
+        the same binary with the same options
+
+        :param binary: path of the QSD binary
+        :param cmd_lines: the raw command lines, e.g. --object options
+        :return: key string
+        """
+        path = os.path.realpath(binary)
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        data = json.dumps([path, mtime, " ".join(cmd_lines.split())])
+        return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _lock(path):
+        fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+        return fd
+
+    def _slots(self, key):
+        return sorted(glob.glob(os.path.join(self.pool_dir, "%s_*" % key)))
+
+    def checkout(self, key):
+        """
+        Get an idle QSD of the key, the dead ones are removed
+
+        :param key: key of the QSDs
+        :return: _QsdPoolSlot object or None
+        """
+        for path in self._slots(key):
+            fd = self._lock(path)
+            if fd is None:
+                continue
+            slot = _QsdPoolSlot(path, fd)
+            pid = slot.info.get("pid")
+            if self._is_slot_qsd(slot) and _socket_accepts(slot.sock_path):
+                LOG_JOB.info("Reuse warm QSD %s (PID %s)", path, pid)
+                return slot
+            LOG_JOB.info("Remove dead QSD %s from pool", path)
+            self.discard(slot)
+        return None
+
+    def new_slot(self, key):
+        """
+        Allocate a locked slot for a new QSD of the key
+
+        :param key: key of the QSDs
+        :return: _QsdPoolSlot object
+        """
+        path = os.path.join(self.pool_dir, "%s_%s" % (key, uuid.uuid4().hex[:8]))
+        os.makedirs(path)
+        return _QsdPoolSlot(path, self._lock(path))
+
+    def checkin(self, key, slot):
+        """
+        Return a QSD to the pool, it's discarded if the pool is full
+
+        :param key: key of the QSDs
+        :param slot: _QsdPoolSlot object
+        """
+        idle = 0
+        for path in self._slots(key):
+            if path == slot.path:
+                continue
+            fd = self._lock(path)
+            if fd is not None:
+                idle += 1
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        if idle >= self.size:
+            LOG_JOB.info("QSD pool of %s is full, discard %s", key, slot.path)
+            self.discard(slot)
+            return
+        slot.info["idle_since"] = time.time()
+        slot.save()
+        slot.unlock()
+
+    def reap(self, max_idle=None):
+        """
+        Stop the idle QSDs of the pool and remove their slots
+
+        :param max_idle: only stop the QSDs idle for more than max_idle
+                         seconds, all the idle ones if it's None
+        """
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(self.pool_dir, "*_*"))):
+            fd = self._lock(path)
+            if fd is None:
+                continue
+            slot = _QsdPoolSlot(path, fd)
+            idle = now - slot.info.get("idle_since", 0)
+            if max_idle is None or idle > max_idle:
+                LOG_JOB.info("Reap QSD %s idle for %ds", path, idle)
+                self.discard(slot)
+            else:
+                slot.unlock()
+
+    @staticmethod
+    def _is_slot_qsd(slot):
+        """Check the pid of the slot is still the QSD on its socket"""
+        pid = slot.info.get("pid")
+        return bool(pid) and int(pid) in _find_qsd_pids(slot.sock_path)
+
+    def discard(self, slot, monitor=None):
+        """
+        Stop the QSD of the slot and remove the slot
+
+        :param slot: _QsdPoolSlot object
+        :param monitor: the QMP monitor connected to the QSD
+        """
+        pid = slot.info.get("pid")
+        # the pid may be reused by another process once the QSD exits
+        if self._is_slot_qsd(slot):
+            if monitor:
+                try:
+                    monitor.quit()
+                except Exception as e:
+                    LOG_JOB.warning(e)
+            if not utils_misc.wait_for(
+                lambda: not _is_pid_alive(pid), timeout=10, step=0.1
+            ):
+                utils_misc.kill_process_tree(int(pid), signal.SIGKILL, timeout=60)
+        shutil.rmtree(slot.path, ignore_errors=True)
+        slot.unlock()
+
+
 class QsdDaemonDev(QDaemonDev):
     # Default data struct of raw image data.
     raw_image_data = {
@@ -236,12 +547,7 @@ class QsdDaemonDev(QDaemonDev):
         self.binary = binary
         self.sock_path = sock_path
         self.qsd_monitor_id = qsd_monitor_id
-        self.qsd_version = process.run(
-            "%s -V" % binary, verbose=False, ignore_status=True, shell=True
-        ).stdout_text.split()[2]
-        self.__qsd_help = process.run(
-            "%s -h" % binary, verbose=False, ignore_status=True, shell=True
-        ).stdout_text
+        self.qsd_version, self.__qsd_help = _get_binary_info(binary)
 
         LOG_JOB.info(self.qsd_version)
         self.caps = Capabilities()
@@ -250,6 +556,10 @@ class QsdDaemonDev(QDaemonDev):
         self.daemonize = False
         self.pidfile = None
         self.pid = None
+        self._pool = None
+        self._pool_key = None
+        self._pool_slot = None
+        self._nbd_server_addr = None
 
     def _remove_images(self):
         for img in self.images.values():
@@ -360,21 +670,175 @@ class QsdDaemonDev(QDaemonDev):
         if self.daemon_process:
             return self.daemon_process.get_pid()
 
+    def _get_nodes_and_exports(self):
+        nodes = self.monitor.cmd("query-named-block-nodes", {"flat": True})
+        exports = self.monitor.cmd("query-block-exports")
+        return (
+            sorted(n["node-name"] for n in nodes),
+            sorted(e["id"] for e in exports),
+        )
+
+    def _connect_pooled(self, slot):
+        self.sock_path = slot.sock_path
+        self.qsd_params["monitor_filename"] = slot.sock_path
+        self.pidfile = slot.pidfile
+        self.daemonize = True
+        self.monitor = qemu_monitor.QMPMonitor(self, self.name, self.qsd_params)
+
+    def _launch_pooled(self, slot):
+        """Start a new QSD in daemonize mode for the pool slot"""
+        qsd_cmd = "%s --chardev socket,server=on,wait=off,path=%s,id=%s" % (
+            self.binary,
+            slot.sock_path,
+            self.qsd_monitor_id,
+        )
+        qsd_cmd += " --monitor chardev=%s,mode=control " % self.qsd_monitor_id
+        for cmd in self.qsd_params.get("qsd_cmd_lines", "").split(";"):
+            qsd_cmd += cmd
+        qsd_cmd += " --daemonize --pidfile %s" % slot.pidfile
+        LOG_JOB.info(qsd_cmd.replace(" --", " \\\n --"))
+        self.set_param("cmd", qsd_cmd)
+
+        qsd = subprocess.Popen(shlex.split(qsd_cmd))
+        qsd.wait()
+        if qsd.returncode:
+            raise QsdError("Failed run QSD daemonize: %d" % qsd.returncode)
+        self.daemonize = True
+        self.pidfile = slot.pidfile
+        self.sock_path = slot.sock_path
+        timeout = float(self.qsd_params.get("qsd_start_timeout", 60))
+        if not utils_misc.wait_for(self._is_ready, timeout, step=0.05):
+            raise QsdError("QSD %s is not ready in %ss" % (self.name, timeout))
+        slot.info = {"pid": _read_pidfile(slot.pidfile), "key": self._pool_key}
+        slot.save()
+        self._connect_pooled(slot)
+        slot.info["nodes"], slot.info["exports"] = self._get_nodes_and_exports()
+        slot.save()
+
+    def _attach_image(self, name):
+        """Add the nodes of the image and export it via QMP"""
+        img = self._fulfil_image_props(name, self.qsd_params.object_params(name))
+        addr = img["nbd-server"]["addr"]
+        # QSD runs only one NBD server, shared by all the NBD exports
+        if addr and self._nbd_server_addr not in (None, addr):
+            raise QsdError(
+                "Image %s can't be exported on %s, the NBD server of QSD %s "
+                "is listening on %s" % (name, addr, self.name, self._nbd_server_addr)
+            )
+        self.monitor.cmd("blockdev-add", img["protocol"])
+        self.monitor.cmd("blockdev-add", img["format"])
+        if img["filter"]["driver"]:
+            self.monitor.cmd("blockdev-add", img["filter"])
+        if addr and self._nbd_server_addr is None:
+            server = dict(img["nbd-server"], addr=_to_legacy_address(addr))
+            self.monitor.cmd("nbd-server-start", server)
+            self._nbd_server_addr = addr
+        self.monitor.cmd("block-export-add", img["export"])
+
+    def _detach_images(self):
+        """Delete the exports and nodes of the images added by the test"""
+        ids = [img["export"]["id"] for img in self.images.values()]
+        exports = self._get_nodes_and_exports()[1]
+        for export_id in ids:
+            if export_id in exports:
+                self.monitor.cmd("block-export-del", {"id": export_id})
+        if not utils_misc.wait_for(
+            lambda: not set(ids) & set(self._get_nodes_and_exports()[1]),
+            timeout=30,
+            step=0.1,
+        ):
+            for export_id in set(ids) & set(self._get_nodes_and_exports()[1]):
+                self.monitor.cmd("block-export-del", {"id": export_id, "mode": "hard"})
+        if self._nbd_server_addr is not None:
+            self.monitor.cmd("nbd-server-stop")
+            self._nbd_server_addr = None
+        nodes = self._get_nodes_and_exports()[0]
+        for img in self.images.values():
+            for part in ("filter", "format", "protocol"):
+                node = img[part]["node-name"]
+                if img[part]["driver"] and node in nodes:
+                    self.monitor.cmd("blockdev-del", {"node-name": node})
+
+    def _is_pool_clean(self, slot):
+        """Check no node or export is leaked by the tests"""
+        nodes, exports = self._get_nodes_and_exports()
+        leaked = sorted(
+            set(nodes) - set(slot.info.get("nodes", []))
+            | set(exports) - set(slot.info.get("exports", []))
+        )
+        if leaked:
+            LOG_JOB.warning("QSD %s leaked nodes/exports: %s", slot.path, leaked)
+        return not leaked
+
+    def _start_pooled(self):
+        """Get a warm QSD from the pool, and attach the images via QMP"""
+        self._pool = QsdPool.from_params(self.qsd_params)
+        if self._pool.max_idle > 0:
+            self._pool.reap(self._pool.max_idle)
+        self._pool_key = QsdPool.get_key(
+            self.binary, self.qsd_params.get("qsd_cmd_lines", "")
+        )
+        slot = self._pool.checkout(self._pool_key)
+        if slot:
+            self._connect_pooled(slot)
+            if not self._is_pool_clean(slot):
+                self._pool.discard(slot, self.monitor)
+                self.monitor = None
+                slot = None
+        if not slot:
+            slot = self._pool.new_slot(self._pool_key)
+            try:
+                self._launch_pooled(slot)
+            except Exception:
+                self._pool.discard(slot)
+                raise
+        self._pool_slot = slot
+        self.pid = slot.info["pid"]
+        for img in self.qsd_params.get("qsd_images", "").split():
+            self._attach_image(img)
+
+    def _stop_pooled(self):
+        """Detach the images and return the QSD to the pool"""
+        slot, self._pool_slot = self._pool_slot, None
+        if not slot:
+            return
+        try:
+            if self.is_daemon_alive():
+                self._detach_images()
+        except Exception as e:
+            LOG_JOB.warning("Failed to detach images from QSD: %s", e)
+        if self.is_daemon_alive() and self._is_pool_clean(slot):
+            self.monitor.close()
+            self._pool.checkin(self._pool_key, slot)
+        else:
+            self._pool.discard(slot, self.monitor)
+        self.monitor = None
+        if self.qsd_params.get("qsd_pool_reap", "no") == "yes":
+            self._pool.reap()
+
     def start_daemon(self):
         """Start the QSD daemon in background."""
         params = self.qsd_params.object_params(self.name)
+        if params.get("qsd_pool", "no") == "yes":
+            if self.check_capability(Flags.DAEMONIZE) and self.check_capability(
+                Flags.PIDFILE
+            ):
+                self._start_pooled()
+                return
+            LOG_JOB.info("Ignore QSD pool mode without --daemonize/--pidfile")
         # check exist QSD
-        get_pid_cmd = "ps -e ww|grep qemu-storage-d|grep %s|" % self.sock_path
-        get_pid_cmd += "grep -v grep|awk '{print $1}'"
-        pid = process.system_output(get_pid_cmd, shell=True).decode()
+        pids = _find_qsd_pids(self.sock_path)
 
-        if pid:
+        if pids:
             if params.get("qsd_force_create", "yes") == "yes":
                 # Kill exist QSD
-                LOG_JOB.info("Find running QSD:%s, force killing", pid)
-                utils_misc.kill_process_tree(int(pid), 9, timeout=60)
+                for pid in pids:
+                    LOG_JOB.info("Find running QSD:%s, force killing", pid)
+                    utils_misc.kill_process_tree(pid, 9, timeout=60)
             else:
-                raise QsdError("Find running QSD:%s" % pid)
+                raise QsdError("Find running QSD:%s" % pids)
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
 
         # QSD monitor
         qsd_cmd = "%s --chardev socket,server=on,wait=off,path=%s,id=%s" % (
@@ -427,7 +891,8 @@ class QsdDaemonDev(QDaemonDev):
         # run QSD
         if self.daemonize:
             LOG_JOB.info("Run QSD on daemonize mode ")
-            qsd = subprocess.Popen(qsd_cmd, shell=True)
+            # QSD returns after it's initialized in daemonize mode
+            qsd = subprocess.Popen(shlex.split(qsd_cmd))
             qsd.wait()
             if qsd.returncode:
                 raise QsdError("Failed run QSD daemonize: %d" % qsd.returncode)
@@ -442,15 +907,18 @@ class QsdDaemonDev(QDaemonDev):
                 self.daemon_process.get_pid(),
             )
 
-        pid = process.system_output(get_pid_cmd, shell=True).decode()
+        timeout = float(params.get("qsd_start_timeout", 60))
+        if not utils_misc.wait_for(self._is_ready, timeout, step=0.05):
+            raise QsdError("QSD %s is not ready in %ss" % (self.name, timeout))
+
+        pids = _find_qsd_pids(self.sock_path)
+        pid = str(pids[0]) if pids else ""
 
         if not pid:
             LOG_JOB.info("Can not Find running QSD %s ", self.name)
 
         if self.pidfile:
-            file_pid = process.system_output(
-                "cat %s" % self.pidfile, shell=True
-            ).decode()
+            file_pid = _read_pidfile(self.pidfile)
             if file_pid != pid:
                 raise QsdError("Find mismatch pid: %s %s" % (pid, file_pid))
 
@@ -460,14 +928,22 @@ class QsdDaemonDev(QDaemonDev):
         monitor.info_block()
         self.monitor = monitor
 
+    def _is_ready(self):
+        """
+        Check QSD is ready: the monitor socket accepts connections and the
+        pidfile is written
+        """
+        if not self.daemonize and not super(QsdDaemonDev, self).is_daemon_alive():
+            output = self.daemon_process.get_output()
+            self.close_daemon_process()
+            raise QsdError("QSD daemon exited during startup: %s" % output)
+        if self.pidfile and not _read_pidfile(self.pidfile):
+            return False
+        return _socket_accepts(self.sock_path)
+
     def is_daemon_alive(self):
         if self.daemonize:
-            check_pid_cmd = "ps -q %s" % self.pid
-            if self.pid:
-                return (
-                    process.system(check_pid_cmd, shell=True, ignore_status=True) == 0
-                )
-            return False
+            return bool(self.pid) and _is_pid_alive(self.pid)
 
         return super(QsdDaemonDev, self).is_daemon_alive()
 
@@ -494,7 +970,9 @@ class QsdDaemonDev(QDaemonDev):
                     return
             else:
                 # Wait for the QSD to be really dead
-                if utils_misc.wait_for(lambda: not self.is_daemon_alive(), timeout=10):
+                if utils_misc.wait_for(
+                    lambda: not self.is_daemon_alive(), timeout=10, step=0.1
+                ):
                     LOG_JOB.debug("QSD %s down (monitor)", self.name)
                     return
                 else:
@@ -514,6 +992,9 @@ class QsdDaemonDev(QDaemonDev):
 
     def stop_daemon(self):
         try:
+            if self._pool_slot:
+                self._stop_pooled()
+                return
             self._destroy()
             super(QsdDaemonDev, self).stop_daemon()
         finally:
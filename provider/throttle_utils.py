@@ -8,16 +8,18 @@ import logging
 import random
 import re
 import string
-import tempfile
+import time
 from math import ceil
 from multiprocessing.pool import ThreadPool
-from time import sleep
 
+import aexpect
 from virttest.qemu_devices.qdevices import QThrottleGroup
 from virttest.qemu_monitor import QMPCmdError
 from virttest.utils_misc import get_linux_drive_path
 from virttest.utils_version import VersionInterval
 
+from provider.backup_utils import close_session_pool, get_session_pool, guest_session
+
 LOG_JOB = logging.getLogger("avocado.test")
 
 
@@ -211,6 +213,67 @@ def _get_drive_path(session, params, image):
     return get_linux_drive_path(session, serial)
 
 
+class FioJsonStream(object):
+    """
+    Streaming decoder of fio output which contains several JSON documents,
+    e.g. the output with --status-interval. Each document starts with a
+    "{" line and ends with a "}" line, anything between documents is
+    ignored.
+    Example of usage:
+        stream = FioJsonStream()
+        for data in chunks:
+            for doc in stream.feed(data):
+                ...
+    """
+
+    _doc_begin = re.compile(r"^\{\r?$", re.M)
+    _doc_end = re.compile(r"^\}\r?$", re.M)
+
+    def __init__(self):
+        self._buf = ""
+        self._start = None
+        self._scan = 0
+
+    @property
+    def pending(self):
+        """True if there is an incomplete document."""
+        return self._start is not None
+
+    def feed(self, data):
+        """
+        Feed fio output and decode the completed documents.
+
+        :param data: new fio output.
+        :return: list of dict of the completed documents.
+        """
+
+        self._buf += data
+        docs = []
+        while True:
+            if self._start is None:
+                match = self._doc_begin.search(self._buf, self._scan)
+                if not match:
+                    # Keep the last partial line only
+                    self._buf = self._buf[self._buf.rfind("\n") + 1 :]
+                    self._scan = 0
+                    break
+                self._start = match.start()
+                self._scan = match.end()
+            match = self._doc_end.search(self._buf, self._scan)
+            if not match:
+                # The end line may be not completed yet
+                self._scan = max(self._start + 1, len(self._buf) - 2)
+                break
+            try:
+                docs.append(json.loads(self._buf[self._start : match.end()]))
+            except ValueError as e:
+                LOG_JOB.error("Wrong data format: %s", str(e))
+            self._buf = self._buf[match.end() :]
+            self._start = None
+            self._scan = 0
+        return docs
+
+
 class ThrottleTester(object):
     """
     FIO test for in throttle group disks, It contains building general fio
@@ -224,6 +287,14 @@ class ThrottleTester(object):
         tt.build_images_fio_option()
         tt.start()
 
+    fio runs with --status-interval=throttle_status_interval, the samples
+    are checked while fio is running. The test fails early once the sum of
+    the IOPS of the running images in the last interval is out of the
+    margin for throttle_check_patience samples in a row, samples within
+    the first throttle_check_warmup seconds of each fio run are not checked.
+    The jobs on all images run in one fio command, the guest session is
+    from the session pool of the VM if its owner created one, e.g.
+    ThrottleGroupsTester, otherwise it's a new login closed after fio.
     """
 
     # Default data struct of expected result.
@@ -268,6 +339,14 @@ class ThrottleTester(object):
             "expected": copy.deepcopy(ThrottleTester.raw_expected),
         }
         self._margin = 0.3
+        self._status_interval = int(params.get("throttle_status_interval", 5))
+        self._check_warmup = int(params.get("throttle_check_warmup", 10))
+        self._check_patience = int(params.get("throttle_check_patience", 3))
+        self._fio_timeout = int(params.get("throttle_fio_timeout", 1800))
+        self._strikes = 0
+        self._violation = None
+        # jobname: (total ios, runtime in ms) of its previous sample
+        self._last_ios = {}
 
     @staticmethod
     def _generate_output_by_json(output):
@@ -278,39 +357,106 @@ class ThrottleTester(object):
         :return: dict of fio command output.
         """
 
-        with tempfile.TemporaryFile(mode="w+") as tmp:
-            tmp.write(output)
-            tmp.seek(0)
-            line = tmp.readline()
-            begin_flag = False
-            block_index = 1
-            block = {}
-            data = ""
-            while line:
-                if line == "{\n":
-                    if not begin_flag:
-                        begin_flag = True
-                    else:
-                        # error
-                        break
-                if begin_flag:
-                    data += line
-                if line == "}\n":
-                    if begin_flag:
-                        begin_flag = False
-                    else:
-                        # error
-                        break
-                    block[block_index] = json.loads(data)
-                    data = ""
-                    block_index += 1
-
-                line = tmp.readline()
-
-            if begin_flag:
-                LOG_JOB.error("Wrong data format")
-                return {}
-            return block
+        stream = FioJsonStream()
+        block = dict(enumerate(stream.feed(output), 1))
+        if stream.pending:
+            LOG_JOB.error("Wrong data format")
+            return {}
+        return block
+
+    def _interval_iops(self, job):
+        """
+        Get the IOPS of a job since its previous sample, the iops in the
+        fio JSON documents is the mean since the job started, so it's
+        computed from the delta of total_ios.
+
+        :param job: dict of a job in one fio JSON document.
+        :return: IOPS, None if no time passed since the previous sample.
+        """
+
+        ios = job["read"]["total_ios"] + job["write"]["total_ios"]
+        runtime = job.get("job_runtime") or job.get("elapsed", 0) * 1000
+        last_ios, last_runtime = self._last_ios.get(job["jobname"], (0, 0))
+        self._last_ios[job["jobname"]] = (ios, runtime)
+        if runtime <= last_runtime:
+            return None
+        return (ios - last_ios) * 1000.0 / (runtime - last_runtime)
+
+    def _check_sample(self, images, phase, doc):
+        """
+        Check the sum of the interval IOPS of images in one fio JSON
+        document.
+
+        :param images: list of participating images.
+        :param phase: 'burst' or 'normal'.
+        :param doc: dict of one fio JSON document.
+        """
+
+        expected = self._throttle["expected"][phase]
+        expected = expected["read"] + expected["write"] + expected["total"]
+        jobs = [job for job in doc["jobs"] if job["jobname"] in images]
+        if not expected or not jobs:
+            return
+        iops = [self._interval_iops(job) for job in jobs]
+        elapsed = max(job.get("elapsed", 0) for job in jobs)
+        if elapsed < self._check_warmup or None in iops:
+            return
+        total = sum(iops)
+        if abs(expected - total) <= expected * self._margin:
+            self._strikes = 0
+            return
+        self._strikes += 1
+        LOG_JOB.debug(
+            "Unexpected %s IOPS %d %d at %ss", phase, expected, total, elapsed
+        )
+        if self._strikes < self._check_patience:
+            return
+        reason = "Failed %s" % phase
+        burst = self._throttle["expected"]["burst"]
+        if phase == "normal" and total > expected and burst["burst_time"]:
+            reason = "Burst is not emptied"
+        self._violation = "%s %d %d at %ss" % (reason, expected, total, elapsed)
+
+    def _stream_fio(self, session, cmd, images, phase):
+        """
+        Run fio command in guest and check its samples while it's running.
+
+        :param session: Session object connect to guest.
+        :param cmd: fio command.
+        :param images: list of participating images.
+        :param phase: 'burst' or 'normal'.
+        :return: dict of the last fio JSON document, None if aborted.
+        """
+
+        stream = FioJsonStream()
+        last_doc = None
+        self._strikes = 0
+        self._last_ios = {}
+        end_time = time.time() + self._fio_timeout
+        session.sendline(cmd)
+        while True:
+            try:
+                data = session.read_until_last_line_matches([session.prompt], 1)[1]
+                done = True
+            except aexpect.ExpectTimeoutError as e:
+                data = e.output
+                done = False
+            for doc in stream.feed(data):
+                last_doc = doc
+                self._check_sample(images, phase, doc)
+            if done:
+                break
+            if self._violation or time.time() > end_time:
+                session.sendcontrol("c")
+                session.read_up_to_prompt(timeout=60)
+                if not self._violation:
+                    self._test.error("Timeout to run fio on %s" % images)
+                return None
+
+        status = session.cmd_output(session.status_test_command, 60).split()
+        if not status or status[-1] != "0":
+            self._test.error("Failed to run fio on %s: %s" % (images, status))
+        return last_doc
 
     def set_fio(self, fio):
         """
@@ -321,6 +467,53 @@ class ThrottleTester(object):
 
         self._fio = fio
 
+    def build_images_fio_cmd(self, images):
+        """
+        Build one fio command which runs a job on each image, the job is
+        named by the image.
+
+        :param images: list of participating images.
+        :return: fio command.
+        """
+
+        cmd = self._fio.cfg.fio_path
+        for image in images:
+            fio_option = self._throttle["images"][image]["fio_option"]
+            cmd += " --name=%s %s" % (image, re.sub(r"--name=\S+", "", fio_option))
+        return cmd
+
+    def run_images_fio(self, images):
+        """
+        Start one fio command for all images in guest, so all the jobs
+        start at the same time and the samples of them cover the same
+        time window. The output is demultiplexed per image.
+
+        :param images: list of participating images.
+        :return: dict of image name and its fio output.
+        """
+
+        if not self._fio:
+            self._test.error("Please set fio first")
+        cmd = self.build_images_fio_cmd(images)
+        burst = self._throttle["expected"]["burst"]
+        expected_burst = burst["read"] + burst["write"] + burst["total"]
+        phases = ("burst", "normal") if expected_burst else ("normal",)
+        for image in images:
+            self._throttle["images"][image]["output"] = {}
+        self._violation = None
+        with guest_session(self._vm) as session:
+            # The normal run starts once the burst run finished
+            for index, phase in enumerate(phases, 1):
+                LOG_JOB.info("run_fio:%s", cmd)
+                doc = self._stream_fio(session, cmd, images, phase)
+                if doc is None:
+                    break
+                for job in doc["jobs"]:
+                    if job["jobname"] in images:
+                        output = self._throttle["images"][job["jobname"]]["output"]
+                        output[index] = dict(doc, jobs=[job])
+        return dict((img, self._throttle["images"][img]["output"]) for img in images)
+
     def run_fio(self, *args):
         """
         Start to fio command in guest.
@@ -329,20 +522,11 @@ class ThrottleTester(object):
         :return: fio command output.
         """
 
-        if not self._fio:
-            self._test.error("Please set fio first")
         image_info = args[0]
-        fio_option = image_info["fio_option"]
-        session = self._vm.wait_for_login()
-        cmd = " ".join((self._fio.cfg.fio_path, fio_option))
-        burst = self._throttle["expected"]["burst"]
-        expected_burst = burst["read"] + burst["write"] + burst["total"]
-        if expected_burst:
-            cmd += " && " + cmd
-        LOG_JOB.info("run_fio:%s", cmd)
-        out = session.cmd(cmd, 1800)
-        image_info["output"] = self._generate_output_by_json(out)
-        return image_info["output"]
+        for image, info in self._throttle["images"].items():
+            if info is image_info:
+                return self.run_images_fio([image])[image]
+        raise ThrottleError("Can not find the image of %s" % image_info["name"])
 
     def check_output(self, images):
         """
@@ -418,7 +602,9 @@ class ThrottleTester(object):
         """
 
         LOG_JOB.debug("Start one image run_fio :%s", image)
-        self.run_fio(self._throttle["images"][image])
+        self.run_images_fio([image])
+        if self._violation:
+            self._test.fail(self._violation)
         return self.check_output([image])
 
     def start_all_images_test(self):
@@ -428,14 +614,10 @@ class ThrottleTester(object):
         :return: True for succeed,False or test error raised if failed.
         """
 
-        num = len(self.images)
-        pool = ThreadPool(num)
-
-        for img in self.images:
-            LOG_JOB.debug("Start all images run_fio :%s", img)
-            pool.apply_async(self.run_fio, (self._throttle["images"][img],))
-        pool.close()
-        pool.join()
+        LOG_JOB.debug("Start all images run_fio :%s", self.images)
+        self.run_images_fio(self.images)
+        if self._violation:
+            self._test.fail(self._violation)
         return self.check_output(self.images)
 
     def start(self):
@@ -462,7 +644,7 @@ class ThrottleTester(object):
         burst = self._throttle["expected"]["burst"]
         if "burst_empty_time" in burst.keys():
             LOG_JOB.debug("Wait empty %d", burst["burst_empty_time"])
-            sleep(burst["burst_empty_time"])
+            time.sleep(burst["burst_empty_time"])
 
     def set_image_fio_option(self, image, option):
         """
@@ -630,6 +812,8 @@ class ThrottleTester(object):
             mode = "randrw"
 
         option += " --rw=%s --bs=%d --runtime=%s" % (mode, iops_size, runtime)
+        if self._status_interval:
+            option += " --status-interval=%d" % self._status_interval
 
         LOG_JOB.debug(self._throttle["expected"])
         LOG_JOB.debug("fio_option:%s", option)
@@ -733,14 +917,22 @@ class ThrottleGroupsTester(object):
         """
         num = len(self.testers)
         pool = ThreadPool(num)
+        # the testers share the session pools of the VMs owned here
+        vms = set(tester._vm for tester in self.testers)
+        for vm in vms:
+            get_session_pool(vm)
 
         results = {}
-        for tester in self.testers:
-            LOG_JOB.debug("Start tester :%s", tester.group)
-            result = pool.apply_async(self.proc_wrapper, (tester.start,))
-            results[tester.group] = result
-        pool.close()
-        pool.join()
+        try:
+            for tester in self.testers:
+                LOG_JOB.debug("Start tester :%s", tester.group)
+                result = pool.apply_async(self.proc_wrapper, (tester.start,))
+                results[tester.group] = result
+            pool.close()
+            pool.join()
+        finally:
+            for vm in vms:
+                close_session_pool(vm)
 
         success = True
         for group, result in results.items():
@@ -6,6 +6,8 @@ from provider.virt_storage import virt_source, virt_target
 
 class BaseStoragePool(object):
     TYPE = "none"
+    # volume attributes indexed for lookup
+    INDEXED_ATTRS = ("name", "path", "url", "key")
 
     def __init__(self, name):
         self.name = name
@@ -15,7 +17,12 @@ class BaseStoragePool(object):
         self._helper = None
         self._capacity = None
         self._available = None
-        self._volumes = set()
+        # id(volume) -> volume, volume's hash changes with its attributes
+        self._volumes = dict()
+        # attribute name -> {str(value): {id(volume): volume}}
+        self._indexes = dict((attr, dict()) for attr in self.INDEXED_ATTRS)
+        # id(volume) -> {attribute name: str(value)}
+        self._indexed_values = dict()
 
     @property
     def capacity(self):
@@ -60,6 +67,9 @@ class BaseStoragePool(object):
         """Destroy storage pools"""
         self.stop()
         self._volumes.clear()
+        for index in self._indexes.values():
+            index.clear()
+        self._indexed_values.clear()
 
     def find_sources(self):
         raise NotImplementedError
@@ -98,17 +108,47 @@ class BaseStoragePool(object):
         :return:  StorageVolume object or None
         :raise:
         """
-
-        matched_volumes = list(
-            filter(lambda x: str(getattr(x, attr)) == str(val), self.get_volumes())
-        )
-        return matched_volumes[0] if matched_volumes else None
+        matched_volumes = self._indexes[attr].get(str(val))
+        return next(iter(matched_volumes.values())) if matched_volumes else None
 
     def get_volumes(self):
-        return self._volumes
+        return list(self._volumes.values())
 
     def add_volume(self, volume):
-        self._volumes.add(volume)
+        self._volumes[id(volume)] = volume
+        self._indexed_values.setdefault(id(volume), dict())
+        self.index_volume(volume)
+
+    def index_volume(self, volume):
+        """
+        Update the lookup indexes of a volume in the pool, it's called
+        whenever an indexed attribute of the volume is changed
+
+        :param volume: StorageVolume object
+        """
+        old_values = self._indexed_values.get(id(volume))
+        if old_values is None:
+            return
+        new_values = dict((k, str(v)) for k, v in volume.get_index_values().items())
+        for attr, val in old_values.items():
+            if new_values.get(attr) != val:
+                self._unindex(attr, val, volume)
+        for attr, val in new_values.items():
+            if old_values.get(attr) != val:
+                self._indexes[attr].setdefault(val, dict())[id(volume)] = volume
+        self._indexed_values[id(volume)] = new_values
+
+    def _unindex(self, attr, val, volume):
+        matched_volumes = self._indexes[attr].get(val, dict())
+        matched_volumes.pop(id(volume), None)
+        if not matched_volumes:
+            self._indexes[attr].pop(val, None)
+
+    def release_volume(self, volume):
+        """Drop the volume from the pool without removing its data"""
+        for attr, val in self._indexed_values.pop(id(volume), dict()).items():
+            self._unindex(attr, val, volume)
+        self._volumes.pop(id(volume), None)
 
     def acquire_volume(self, volume):
         if volume.is_allocated:
@@ -126,7 +166,7 @@ class BaseStoragePool(object):
         out["capacity"] = str(self.capacity)
         out["available"] = str(self.available)
         out["helper"] = str(self.helper)
-        out["volumes"] = list(map(str, self._volumes))
+        out["volumes"] = list(map(str, self.get_volumes()))
         return out
 
     def __str__(self):
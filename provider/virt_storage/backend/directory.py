@@ -29,8 +29,11 @@ class DirectoryPool(base.BaseStoragePool):
         self.helper.remove()
 
     def refresh(self):
-        files = filter(lambda x: not self.find_volume_by_path, self.find_sources())
-        return map(self.create_volume_from_local, files)
+        return [
+            self.create_volume_from_local(f)
+            for f in self.find_sources()
+            if not self.get_volume_by_path(f)
+        ]
 
     def create_volume_from_local(self, path):
         """
@@ -48,12 +51,19 @@ class DirectoryPool(base.BaseStoragePool):
 
     def create_volume(self, volume):
         storage_util.create_volume(volume)
+        self.invalidate()
         volume.is_allocated = True
         return volume
 
     def remove_volume(self, volume):
         self.helper.remove_file(volume.path)
-        self._volumes.discard(volume)
+        self.invalidate()
+        self.release_volume(volume)
+
+    def invalidate(self):
+        """Drop the cached free space of the pool"""
+        self._available = None
+        self.helper.invalidate()
 
     def get_volume_path_by_param(self, params):
         image_name = params.get("image_name", self.name)
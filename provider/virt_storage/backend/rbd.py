@@ -29,8 +29,11 @@ class RBDPool(base.BaseStoragePool):
         pass
 
     def refresh(self):
-        files = filter(lambda x: not self.find_volume_by_path, self.find_sources())
-        return map(self.create_volume_on_rbd, files)
+        return [
+            self.create_volume_on_rbd(f)
+            for f in self.find_sources()
+            if not self.get_volume_by_path(f)
+        ]
 
     def create_volume_on_rbd(self, path):
         """
@@ -45,7 +48,7 @@ class RBDPool(base.BaseStoragePool):
 
     def remove_volume(self, volume):
         self.helper.remove_image(volume.path)
-        self._volumes.discard(volume)
+        self.release_volume(volume)
 
     def get_volume_path_by_param(self, params):
         image_name = params.get("image_name", self.name)
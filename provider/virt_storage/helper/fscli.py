@@ -1,14 +1,16 @@
 import os
 import shutil
 
-from avocado.utils import process
-
 
 class FsCli(object):
     def __init__(self, dir_path):
         self.dir_path = dir_path
         self._is_export = None
         self._protocol = r"file://"
+        self._capacity = None
+        self._available = None
+        # directory path -> (mtime_ns, files, sub directories)
+        self._dir_cache = {}
 
     def create(self):
         if not self.is_exists:
@@ -22,7 +24,10 @@ class FsCli(object):
 
     @staticmethod
     def remove_file(path):
-        return process.system("rm -f %s" % path, shell=True)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
     def get_path_by_name(self, name):
         path = os.path.join(self.dir_path, name)
@@ -32,20 +37,41 @@ class FsCli(object):
         path = self.get_path_by_name(name)
         return self.path_to_url(path)
 
+    def _scan_dir(self, _dir):
+        """
+        Get files and sub directories of a directory, the result is cached
+        until the mtime of the directory changes
+        """
+        try:
+            mtime = os.stat(_dir).st_mtime_ns
+        except OSError:
+            self._dir_cache.pop(_dir, None)
+            return [], []
+        cached = self._dir_cache.get(_dir)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        files, dirs = [], []
+        with os.scandir(_dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # same as os.walk, symlinks to directories are skipped
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                else:
+                    files.append(os.path.realpath(entry.path))
+        self._dir_cache[_dir] = (mtime, files, dirs)
+        return files, dirs
+
     def list_files(self, _root=None):
         """List all files in top directory"""
-
-        def _list_files(_dir):
-            for root, dirs, files in os.walk(_dir):
-                for f in files:
-                    path = os.path.join(root, f)
-                    yield os.path.realpath(path)
-                for d in dirs:
-                    _d = os.path.join(root, d)
-                    _list_files(_d)
-
-        root_dir = _root or self.dir_path
-        return _list_files(root_dir)
+        files = []
+        dirs = [_root or self.dir_path]
+        while dirs:
+            _files, _dirs = self._scan_dir(dirs.pop())
+            files.extend(_files)
+            dirs.extend(_dirs)
+        return files
 
     @staticmethod
     def get_size(path):
@@ -68,14 +94,20 @@ class FsCli(object):
             self._is_export = os.path.isdir(self.dir_path)
         return self._is_export
 
+    def invalidate(self):
+        """Drop the cached free space, e.g. after creating or removing files"""
+        self._available = None
+
     @property
     def capacity(self):
-        cmd = "df -k --output=size %s |tail -n1" % self.dir_path
-        output = process.system_output(cmd, shell=True)
-        return int(output) * 1024
+        if self._capacity is None:
+            stat = os.statvfs(self.dir_path)
+            self._capacity = stat.f_blocks * stat.f_frsize
+        return self._capacity
 
     @property
     def available(self):
-        cmd = "df -k --output=avail %s |tail -n1" % self.dir_path
-        output = process.system_output(cmd, shell=True)
-        return int(output) * 1024
+        if self._available is None:
+            stat = os.statvfs(self.dir_path)
+            self._available = stat.f_bavail * stat.f_frsize
+        return self._available
@@ -1,5 +1,4 @@
 import logging
-from functools import reduce
 
 from . import exception
 from .backend import directory, rbd
@@ -15,6 +14,7 @@ class StoragePoolAdmin(object):
     }
 
     __pools = set()
+    __pools_by_name = dict()
 
     @classmethod
     def _find_storage_driver(cls, backend_type):
@@ -42,6 +42,7 @@ class StoragePoolAdmin(object):
         pool.refresh()
         state.register_pool_state_machine(pool)
         cls.__pools.add(pool)
+        cls.__pools_by_name.setdefault(pool.name, pool)
         return pool
 
     @classmethod
@@ -53,10 +54,7 @@ class StoragePoolAdmin(object):
     @classmethod
     def list_volumes(cls):
         """List all volumes in host"""
-        out = reduce(
-            lambda x, y: x.union(y), [p.get_volumes() for p in sp_admin.list_pools()]
-        )
-        return list(out)
+        return [v for p in cls.list_pools() for v in p.get_volumes()]
 
     @classmethod
     def list_pools(cls):
@@ -64,10 +62,7 @@ class StoragePoolAdmin(object):
 
     @classmethod
     def find_pool_by_name(cls, name):
-        for pool in cls.__pools:
-            if pool.name == name:
-                return pool
-        return None
+        return cls.__pools_by_name.get(name)
 
     @staticmethod
     def find_pool_by_volume(volume):
@@ -151,20 +146,26 @@ class StoragePoolAdmin(object):
         pool = cls.find_pool_by_volume(volume)
         pool.remove_volume(volume)
 
+    @classmethod
+    def _get_volume_by_attr(cls, attr, val):
+        """Find the volume by the lookup indexes of all pools"""
+        for pool in cls.list_pools():
+            volume = getattr(pool, "get_volume_by_%s" % attr)(val)
+            if volume:
+                return volume
+        return None
+
     @classmethod
     def get_volume_by_name(cls, name):
-        volumes = list(filter(lambda x: x.name == name, cls.list_volumes()))
-        return volumes[0] if volumes else None
+        return cls._get_volume_by_attr("name", name)
 
     @classmethod
     def get_volume_by_path(cls, path):
-        volumes = list(filter(lambda x: x.path == path, cls.list_volumes()))
-        return volumes[0] if volumes else None
+        return cls._get_volume_by_attr("path", path)
 
     @classmethod
     def get_volume_by_url(cls, url):
-        volumes = list(filter(lambda x: x.url == url, cls.list_volumes()))
-        return volumes[0] if volumes else None
+        return cls._get_volume_by_attr("url", url)
 
 
 sp_admin = StoragePoolAdmin()
@@ -8,7 +8,7 @@ from . import virt_encryption
 
 class StorageVolume(object):
     def __init__(self, pool):
-        self.name = None
+        self._name = None
         self.pool = pool
         self._url = None
         self._path = None
@@ -29,41 +29,79 @@ class StorageVolume(object):
         self.pool.add_volume(self)
 
     @property
-    def url(self):
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.pool.index_volume(self)
+
+    def _lookup_url(self):
         if self._url is None:
             if self.name and hasattr(self.pool.helper, "get_url_by_name"):
-                url = self.pool.helper.get_url_by_name(self.name)
-                self._url = url
+                return self.pool.helper.get_url_by_name(self.name)
+        return self._url
+
+    def _lookup_path(self, url):
+        if self._path is None:
+            if url and hasattr(self.pool.helper, "url_to_path"):
+                return self.pool.helper.url_to_path(url)
+        return self._path
+
+    def _lookup_key(self, path, url):
+        if self._key is None:
+            if self.pool.TYPE in ("directory", "nfs"):
+                return path
+            return url
+        return self._key
+
+    def get_index_values(self):
+        """
+        Get the values of the attributes indexed by the pool, without
+        caching the derived ones as the properties do
+        """
+        url = self._lookup_url()
+        path = self._lookup_path(url)
+        return {
+            "name": self.name,
+            "url": url,
+            "path": path,
+            "key": self._lookup_key(path, url),
+        }
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = self._lookup_url()
         return self._url
 
     @url.setter
     def url(self, url):
         self._url = url
+        self.pool.index_volume(self)
 
     @property
     def path(self):
         if self._path is None:
-            if self.url and hasattr(self.pool.helper, "url_to_path"):
-                path = self.pool.helper.url_to_path(self.url)
-                self._path = path
+            self._path = self._lookup_path(self.url)
         return self._path
 
     @path.setter
     def path(self, path):
         self._path = path
+        self.pool.index_volume(self)
 
     @property
     def key(self):
         if self._key is None:
-            if self.pool.TYPE in ("directory", "nfs"):
-                self._key = self.path
-            else:
-                self._key = self.url
+            self._key = self._lookup_key(self.path, self.url)
         return self._key
 
     @key.setter
     def key(self, key):
         self._key = key
+        self.pool.index_volume(self)
 
     @property
     def format(self):
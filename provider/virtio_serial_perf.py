@@ -0,0 +1,195 @@
+"""
+Module for measuring the throughput of virtio-serial ports.
+
+The payload is allocated once and sent by reference in batches of
+scatter-gather buffers, the received data is read into a pre-allocated
+buffer, so the host side copies as little as possible. The transferred
+bytes are sampled with exact timestamps together with the CPU usage of
+the host and the given processes.
+
+Available classes:
+- PayloadSender: Send a payload in a loop to a port socket.
+- PayloadReceiver: Receive and throw away the data of a port socket.
+
+Available methods:
+- make_payload: Allocate a payload of random or patterned data.
+- measure_throughput: Measure the throughput of a sender/receiver.
+
+"""
+
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from provider import perf_stats
+
+LOG_JOB = logging.getLogger("avocado.test")
+
+# Bytes sent by a sendmsg call at most
+BATCH_BYTES = 1024 * 1024
+# The limit of the buffers of a sendmsg call (IOV_MAX)
+MAX_IOV = 1024
+
+
+def make_payload(size, pattern=None):
+    """
+    Allocate a payload once, so it can be sent without copying
+
+    :param size: payload size in bytes
+    :param pattern: bytes repeated to fill the payload, random if None
+    :return: memoryview of the payload
+    """
+    if pattern:
+        if not isinstance(pattern, bytes):
+            pattern = pattern.encode()
+        data = bytearray((pattern * (size // len(pattern) + 1))[:size])
+    else:
+        data = bytearray(os.urandom(size))
+    return memoryview(data)
+
+
+class PayloadSender(threading.Thread):
+    """
+    Send a payload in a loop, the payload is passed to sendmsg several times
+    by reference per call, the sent bytes are counted in nbytes
+    """
+
+    def __init__(self, sock, payload, exit_event, batch=None):
+        """
+        :param sock: socket of the port
+        :param payload: memoryview from make_payload()
+        :param exit_event: Exit event
+        :param batch: buffers per sendmsg call, fill BATCH_BYTES by default
+        """
+        super(PayloadSender, self).__init__()
+        self.sock = sock
+        self.payload = payload
+        self.exit_event = exit_event
+        if batch is None:
+            batch = min(max(BATCH_BYTES // len(payload), 1), MAX_IOV)
+        self.batch = batch
+        self.nbytes = 0
+        self.ret_code = 1  # sets to 0 when finish properly
+
+    def run(self):
+        iov = [self.payload] * self.batch
+        try:
+            while not self.exit_event.is_set():
+                if not select.select([], [self.sock], [], 0.1)[1]:
+                    continue
+                try:
+                    self.nbytes += self.sock.sendmsg(iov, [], socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    continue
+            self.ret_code = 0
+        except Exception as e:
+            LOG_JOB.error("PayloadSender %s failed: %s", self.name, e)
+
+
+class PayloadReceiver(threading.Thread):
+    """
+    Receive data into a pre-allocated buffer and throw it away, the received
+    bytes are counted in nbytes
+    """
+
+    def __init__(self, sock, exit_event, blocklen=1024):
+        """
+        :param sock: socket of the port
+        :param exit_event: Exit event
+        :param blocklen: Bytes read per call at most
+        """
+        super(PayloadReceiver, self).__init__()
+        self.sock = sock
+        self.exit_event = exit_event
+        self.buf = memoryview(bytearray(blocklen))
+        self.nbytes = 0
+        self.ret_code = 1  # sets to 0 when finish properly
+
+    def run(self):
+        try:
+            while not self.exit_event.is_set():
+                if not select.select([self.sock], [], [], 0.1)[0]:
+                    continue
+                try:
+                    received = self.sock.recv_into(self.buf, 0, socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                if not received:
+                    LOG_JOB.error("PayloadReceiver %s: port is closed", self.name)
+                    return
+                self.nbytes += received
+            self.ret_code = 0
+        except Exception as e:
+            LOG_JOB.error("PayloadReceiver %s failed: %s", self.name, e)
+
+
+def _cpu_snapshot(pids):
+    """Get the host (busy, total) jiffies and the jiffies of the pids"""
+    with open("/proc/stat") as fd:
+        fields = [int(f) for f in fd.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    procs = {}
+    for name, pid in pids.items():
+        try:
+            with open("/proc/%s/stat" % pid) as fd:
+                stat = fd.read().rpartition(")")[2].split()
+            procs[name] = int(stat[11]) + int(stat[12])
+        except (IOError, OSError):
+            procs[name] = None
+    return time.monotonic(), (total - idle, total), procs
+
+
+def _cpu_usage(start, end):
+    """Get the CPU usage (%) between two snapshots"""
+    elapsed = end[0] - start[0]
+    busy, total = end[1][0] - start[1][0], end[1][1] - start[1][1]
+    usage = {"host": 100.0 * busy / total if total else 0.0}
+    hz = os.sysconf("SC_CLK_TCK")
+    for name, ticks in end[2].items():
+        if ticks is not None and start[2].get(name) is not None and elapsed > 0:
+            usage[name] = 100.0 * (ticks - start[2][name]) / (elapsed * hz)
+    return usage
+
+
+def measure_throughput(counter, duration, pids=None, samples=100):
+    """
+    Sample the bytes counter of a running sender/receiver with timestamps
+
+    :param counter: PayloadSender or PayloadReceiver object
+    :param duration: seconds to measure
+    :param pids: dict of name and pid to get the CPU usage of
+    :param samples: number of samples
+    :return: dict with bytes, elapsed (seconds), mbps (the average MB/s),
+             rates (perf_stats.summarize of the MB/s of the samples) and
+             cpu (CPU usage (%) of 'host' and the pids)
+    """
+    interval = float(duration) / samples
+    start_cpu = _cpu_snapshot(pids or {})
+    points = [(time.monotonic(), counter.nbytes)]
+    next_time = points[0][0]
+    for _ in range(samples):
+        next_time += interval
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        points.append((time.monotonic(), counter.nbytes))
+    cpu = _cpu_usage(start_cpu, _cpu_snapshot(pids or {}))
+
+    rates = [
+        (b1 - b0) / (t1 - t0) / 1048576
+        for (t0, b0), (t1, b1) in zip(points, points[1:])
+        if t1 > t0
+    ]
+    elapsed = points[-1][0] - points[0][0]
+    nbytes = points[-1][1] - points[0][1]
+    return {
+        "bytes": nbytes,
+        "elapsed": elapsed,
+        "mbps": nbytes / elapsed / 1048576 if elapsed else 0.0,
+        "rates": perf_stats.summarize(rates),
+        "cpu": cpu,
+    }
@@ -31,6 +31,7 @@ def run(test, params, env):
         :param pcie: if itis pcie bus
         """
         disks = []
+        groups = []
         for slot in dev_slots:
             scsi_bus = 1
             parent_bus = "pcie_extra_root_port_%s" % slot if pcie else "pci.0"
@@ -54,8 +55,10 @@ def run(test, params, env):
                     scsi_bus += 1
             env_process.process_images(env_process.preprocess_image, test, params)
             parent_bus_obj = qdev.get_buses({"aobject": parent_bus})[0]
-            plug._hotplug_devs(images, vm.monitor, bus=parent_bus_obj)
-            disks.extend(plug)
+            groups.append((images, parent_bus_obj))
+        # The functions of a slot are plugged in order, the slots concurrently
+        plug.hotplug_devs_grouped(groups)
+        disks.extend(plug)
         return disks
 
     image_size = "500M"
@@ -1,8 +1,8 @@
 import copy
 import itertools
 import json
+import os
 import re
-import statistics as st
 import time
 
 from avocado.utils import process
@@ -10,6 +10,7 @@ from virttest import env_process, utils_disk
 from virttest.utils_misc import get_linux_drive_path
 from virttest.utils_windows.drive import get_disk_props_by_serial_number
 
+from provider import perf_result_store, perf_stats
 from provider.storage_benchmark import generate_instance
 
 
@@ -242,6 +243,7 @@ def run(test, params, env):
                         "iops_avg": 0,
                         "lat": [],
                         "lat_avg": 0,
+                        "lat_p99": [],
                         "job_runtime": 0,
                         "bw": [],
                     }
@@ -263,6 +265,13 @@ def run(test, params, env):
                 )
                 img_result["jobs"][jobname]["iops"].append(iops)
                 img_result["jobs"][jobname]["lat"].append(lat)
+                clat_p99 = [
+                    job[rw].get("clat_ns", {}).get("percentile", {}).get("99.000000")
+                    for rw in ("read", "write")
+                ]
+                clat_p99 = [p99 for p99 in clat_p99 if p99]
+                if clat_p99:
+                    img_result["jobs"][jobname]["lat_p99"].append(max(clat_p99))
                 img_result["jobs"][jobname]["bw"].append(bw)
                 img_result["jobs"][jobname]["job_runtime"] = job["job_runtime"]
 
@@ -272,17 +281,28 @@ def run(test, params, env):
             logger.error("Exception:%s %s", err, cmd_output)
             raise err
 
-    def remove_maximum_deviation(alist):
-        if not alist:
-            return -1
-        average = sum(alist) * 1.0 / len(alist)
-        max_deviation = 0
-        pos = 0
-        for i, a in enumerate(alist):
-            if abs(a - average) > max_deviation:
-                max_deviation = abs(a - average)
-                pos = i
-        return alist.pop(pos)
+    def record_fio_result(results):
+        """record the raw samples of each job into the perf result store"""
+        store = perf_result_store.PerfResultStore.from_params(params, test.resultsdir)
+        perf_run = store.new_run(
+            params.get("shortname", "block_performance_test"),
+            params,
+            {"kvm_version": os.uname()[2]},
+            hash_keys=("fio_cmd", "fio_rw", "fio_bs", "fio_iodepth", "compare_images"),
+        )
+        for img in results["images"]:
+            for jobname, job in results[img]["jobs"].items():
+                for metric in ("iops", "lat", "bw"):
+                    if not job[metric]:
+                        continue
+                    perf_run.add(
+                        metric,
+                        perf_stats.summarize(job[metric])["mean"],
+                        job[metric],
+                        image=img,
+                        job=jobname,
+                    )
+        perf_run.commit()
 
     def compare_fio_result(results):
         # preprocess data to smooth data
@@ -293,31 +313,43 @@ def run(test, params, env):
                 raw_iops = job["iops"]
                 raw_lat = job["lat"]
                 logger.debug("%s raw %s iops:%s", img, key, raw_iops)
-                job["sample_iops"] = raw_iops.copy()
-                job["sample_lat"] = raw_lat.copy()
-                iops = job["sample_iops"]
-                lat = job["sample_lat"]
+                iops = raw_iops.copy()
+                lat = raw_lat.copy()
 
-                # Discard maximum deviation
+                # Discard outliers, at most drop_num samples
                 if run_times > 3:
                     drop_num = round(run_times * (1 - sampling_rate))
-                    logger.debug("Drop %s sample data...", drop_num)
-                    for i in range(drop_num):
-                        remove_maximum_deviation(iops)
-                        remove_maximum_deviation(lat)
-                sample_num = len(iops)
-                iops_avg = int(sum(iops) / sample_num)
+                    iops, dropped = perf_stats.reject_outliers(
+                        raw_iops, outlier_method, max_drop=drop_num
+                    )
+                    lat = perf_stats.reject_outliers(
+                        raw_lat, outlier_method, max_drop=drop_num
+                    )[0]
+                    logger.debug("Drop %s iops sample data: %s", len(dropped), dropped)
+                job["sample_iops"] = iops
+                job["sample_lat"] = lat
+                iops_summary = perf_stats.summarize(iops)
+                iops_avg = int(iops_summary["mean"])
                 job["iops_avg"] = iops_avg
-                job["iops_std"] = 0 if sample_num == 1 else st.stdev(iops)
-                job["iops_dispersion"] = round(job["iops_std"] / iops_avg, 6)
-                job["lat_avg"] = int(sum(lat) / sample_num)
+                job["iops_std"] = iops_summary["stdev"]
+                job["iops_ci"] = iops_summary["ci"]
+                job["iops_dispersion"] = round(iops_summary["cv"], 6)
+                lat_summary = perf_stats.summarize(lat)
+                job["lat_avg"] = int(lat_summary["mean"])
+                if job["lat_p99"]:
+                    job["lat_p99_avg"] = int(
+                        perf_stats.summarize(job["lat_p99"])["mean"]
+                    )
                 logger.debug(
-                    "%s smooth %s iops:%s AVG:%s lat:%s V:%s%%",
+                    "%s smooth %s iops:%s AVG:%s CI:%s lat:%s P90:%s P99:%s V:%s%%",
                     img,
                     key,
                     iops,
                     iops_avg,
+                    job["iops_ci"],
                     job["lat_avg"],
+                    lat_summary["p90"],
+                    job.get("lat_p99_avg"),
                     job["iops_dispersion"] * 100,
                 )
         # compare data
@@ -348,8 +380,11 @@ def run(test, params, env):
                     )
                 gap = round(((obj2_avg - obj1_avg) / obj1_avg * 100), 1)
                 ratio = round((obj1_avg / obj2_avg * 100), 1)
+                significance = perf_stats.compare_samples(
+                    obj1_job["sample_iops"], obj2_job["sample_iops"], significance_level
+                )
                 logger.debug(
-                    "%s-%s: %-20s: %-10s %-10s (ratio: %-5s%%) (gap: %-5s%%)",
+                    "%s-%s: %-20s: %-10s %-10s (ratio: %-5s%%) (gap: %-5s%%) (p: %s)",
                     obj1_name,
                     obj2_name,
                     key,
@@ -357,13 +392,26 @@ def run(test, params, env):
                     obj2_avg,
                     ratio,
                     gap,
+                    significance["p_value"],
                 )
 
                 if obj1_avg > obj2_avg:
                     r = (obj1_name, obj2_name, obj1_avg, obj2_avg)
                     rs = None
-                    if obj1_avg > obj2_avg * (1 + error_threshold):
+                    # A gap which is not significant is treated as noise
+                    noisy = (
+                        significance["p_value"] is not None
+                        and not significance["significant"]
+                    )
+                    if obj1_avg > obj2_avg * (1 + error_threshold) and not noisy:
                         rs = unexpected_result
+                    elif obj1_avg > obj2_avg * (1 + error_threshold):
+                        logger.warning(
+                            "Gap of %s is not significant (p=%s)",
+                            key,
+                            significance["p_value"],
+                        )
+                        rs = warning_result
                     elif obj1_avg > obj2_avg * (1 + warn_threshold):
                         # warn threshold
                         rs = warning_result
@@ -562,6 +610,8 @@ def run(test, params, env):
     guest_deinit_operation = params.get("guest_deinit_operation")
     host_deinit_operation = params.get("host_deinit_operation")
     sampling_rate = params.get_numeric("sampling_rate", 0.8, float)
+    outlier_method = params.get("outlier_method", "mad")
+    significance_level = params.get_numeric("significance_level", 0.05, float)
     dispersion = params.get_numeric("dispersion", 0.1, float)
     error_threshold = params.get_numeric("error_threshold", 0.1, float)
     warn_threshold = params.get_numeric("warn_threshold", 0.05, float)
@@ -614,4 +664,5 @@ def run(test, params, env):
         logger.debug("Execute host deinit: %s", host_deinit_operation)
         execute_operation("host", host_deinit_operation)
 
+    record_fio_result(test_results)
     compare_fio_result(test_results)
@@ -7,7 +7,7 @@ from avocado.utils import process
 from virttest.qemu_devices.qdevices import QBlockdevFormatNode
 from virttest.utils_misc import wait_for
 
-from provider.backup_utils import copyif
+from provider.backup_utils import close_session_pool, copyif
 from provider.blockdev_live_backup_base import BlockdevLiveBackupBaseTest
 from provider.job_utils import query_jobs
 from provider.nbd_image_export import InternalNBDExportImage
@@ -109,6 +109,7 @@ class BlockdevIncBackupPullModePoweroffVMTest(BlockdevLiveBackupBaseTest):
             LOG_JOB.info("qemu quit after vm poweroff")
 
     def destroy_vms(self):
+        close_session_pool(self.main_vm)
         if self._is_qemu_hang:
             # kill qemu instead of send shell/qmp command,
             # which will wait for minutes
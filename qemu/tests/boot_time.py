@@ -1,6 +1,8 @@
-from virttest import env_process, error_context, utils_misc
+from virttest import env_process, error_context
 from virttest.staging import utils_memory
 
+from provider import boot_timeline, perf_result_store
+
 
 @error_context.context_aware
 def run(test, params, env):
@@ -9,7 +11,9 @@ def run(test, params, env):
     1) Set init run level to 1
     2) Send a shutdown command to the guest, or issue a system_powerdown
        monitor command (depending on the value of shutdown_method)
-    3) Boot up the guest and measure the boot time
+    3) Boot up the guest paused, resume it and measure the boot time, the
+       phases of the boot are split by the markers of the QMP monitor and
+       the serial console, repeat it for 'boot_time_repeats' times
     4) set init run level back to the old one
 
     :param test: QEMU test object
@@ -27,20 +31,56 @@ def run(test, params, env):
     session.cmd(single_user_cmd)
 
     try:
-        error_context.context("Shut down guest", test.log.info)
-        session.cmd("sync")
-        vm.destroy()
-
-        error_context.context("Boot up guest and measure the boot time", test.log.info)
-        utils_memory.drop_caches()
-        vm.create()
-        vm.verify_alive()
-        session = vm.wait_for_serial_login(timeout=timeout)
-        boot_time = utils_misc.monotonic_time() - vm.start_monotonic_time
+        boots = []
+        for i in range(int(params.get("boot_time_repeats", 1))):
+            error_context.context("Shut down guest", test.log.info)
+            session.cmd("sync")
+            session.close()
+            vm.destroy()
+
+            error_context.context(
+                "Boot up guest and measure the boot time (#%d)" % (i + 1),
+                test.log.info,
+            )
+            utils_memory.drop_caches()
+            timeline = boot_timeline.BootTimeline(vm, params)
+            timeline.create()
+            vm.verify_alive()
+            timeline.resume()
+            session = timeline.login(timeout)
+            test.log.info(
+                "Boot timeline: %s",
+                ", ".join("%s %.3fs" % marker for marker in timeline.timeline()),
+            )
+            boots.append(timeline.phases())
+
+        phases = boot_timeline.summarize_phases(boots)
+        for phase, summary in sorted(phases.items(), key=lambda p: p[1]["p50"]):
+            test.log.info(
+                "Boot phase %s [s] (p50/p90/p99/max) = %.3f/%.3f/%.3f/%.3f",
+                phase,
+                summary["p50"],
+                summary["p90"],
+                summary["p99"],
+                summary["max"],
+            )
+        boot_time = phases["total"]["p50"]
         test.write_test_keyval({"result": "%ss" % boot_time})
         expect_time = int(params.get("expect_bootup_time", "17"))
         test.log.info("Boot up time: %ss", boot_time)
 
+        store = perf_result_store.PerfResultStore.from_params(params, test.resultsdir)
+        perf_run = store.new_run(
+            params.get("shortname", "boot_time"), params, hash_keys=("single_user_cmd",)
+        )
+        for phase, summary in phases.items():
+            samples = [boot[phase] for boot in boots if phase in boot]
+            perf_run.add("boot_time", summary["p50"], samples, phase=phase)
+        perf_run.commit()
+        perf_result_store.check_regressions(
+            test, params, store, perf_run, lower_is_better=("boot_time",)
+        )
+
     finally:
         try:
             error_context.context("Restore guest run level", test.log.info)
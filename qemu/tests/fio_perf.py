@@ -12,9 +12,9 @@ from virttest import (
     utils_disk,
     utils_misc,
     utils_numeric,
-    utils_test,
 )
 
+from provider import cpu_affinity, perf_result_store
 from provider.storage_benchmark import generate_instance
 
 LOG_JOB = logging.getLogger("avocado.test")
@@ -81,6 +81,7 @@ def get_version(
     :param type: guest type
     :param driver_format: driver format
     :param timeout: Timeout in seconds
+    :return: dict of the versions
     """
 
     kvm_ver = process.system_output(kvm_ver_chk_cmd, shell=True).decode()
@@ -88,6 +89,7 @@ def get_version(
 
     result_file.write("### kvm-userspace-ver : %s\n" % kvm_ver)
     result_file.write("### kvm_version : %s\n" % host_ver)
+    env = {"kvm-userspace-ver": kvm_ver.strip(), "kvm_version": host_ver}
 
     if driver_format != "ide":
         result = session.cmd_output(guest_ver_cmd, timeout)
@@ -96,8 +98,10 @@ def get_version(
             result_file.write(
                 "### guest-kernel-ver :Microsoft Windows [Version %s]\n" % guest_ver[0]
             )
+            env["guest-kernel-ver"] = guest_ver[0]
         else:
             result_file.write("### guest-kernel-ver :%s" % result)
+            env["guest-kernel-ver"] = result.strip()
     else:
         result_file.write(
             "### guest-kernel-ver : Microsoft Windows " "[Version ide driver format]\n"
@@ -107,6 +111,8 @@ def get_version(
         LOG_JOB.info("Check virtiofsd version on host.")
         virtiofsd_ver = process.system_output(vfsd_ver_chk_cmd, shell=True).decode()
         result_file.write("### virtiofsd_version : %s\n" % virtiofsd_ver)
+        env["virtiofsd_version"] = virtiofsd_ver.strip()
+    return env
 
 
 @error_context.context_aware
@@ -159,7 +165,7 @@ def run(test, params, env):
         if node:
             if not isinstance(node, utils_misc.NumaNode):
                 node = utils_misc.NumaNode(int(node))
-            utils_test.qemu.pin_vm_threads(vm, node)
+            cpu_affinity.pin_vm_threads(vm, node)
 
     # login virtual machine
     vm = env.get_vm(params["main_vm"])
@@ -197,7 +203,7 @@ def run(test, params, env):
     result_file = open(result_path, "w")
 
     # scratch host and windows guest version info
-    get_version(
+    env_version = get_version(
         session,
         result_file,
         kvm_ver_chk_cmd,
@@ -207,6 +213,13 @@ def run(test, params, env):
         vfsd_ver_chk_cmd,
         cmd_timeout,
     )
+    store = perf_result_store.PerfResultStore.from_params(params, test.resultsdir)
+    perf_run = store.new_run(
+        params.get("shortname", "fio_perf"),
+        params,
+        env_version,
+        hash_keys=("fio_options", "rw", "block_size", "iodepth", "threads", "num_disk"),
+    )
 
     if os_type == "windows":
         # turn off driver verifier
@@ -357,6 +370,25 @@ def run(test, params, env):
                     io_exits = io_exits_a - io_exits_b
                     for result in bw, iops, lat, cpu, normal:
                         line += "%s|" % format_result(result)
+                    metrics = {
+                        "bw": bw,
+                        "iops": iops,
+                        "lat": lat,
+                        "cpu": cpu,
+                        "bw_per_cpu": normal,
+                        "io_exits": io_exits,
+                    }
+                    if os_type == "linux" and not params.objects("filesystems"):
+                        metrics["util"] = util
+                    for metric, value in metrics.items():
+                        perf_run.add(
+                            metric,
+                            value,
+                            rw=io_pattern,
+                            bs=bs,
+                            iodepth=int(io_depth),
+                            numjobs=int(numjobs),
+                        )
                     if os_type == "windows":
                         line += "%s" % format_result(io_exits)
                     if os_type == "linux":
@@ -371,6 +403,10 @@ def run(test, params, env):
     clean_tmp_files(session, os_type, guest_result_file, cmd_timeout)
 
     result_file.close()
+    perf_run.commit()
+    perf_result_store.check_regressions(
+        test, params, store, perf_run, lower_is_better=("lat", "cpu", "io_exits")
+    )
     for fs in params.objects("filesystems"):
         fs_params = params.object_params(fs)
         fs_target = fs_params.get("fs_target")
@@ -4,7 +4,9 @@ import threading
 import time
 
 from avocado.utils import process
-from virttest import error_context, utils_misc, utils_test
+from virttest import error_context, utils_misc
+
+from provider import cpu_affinity
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -43,7 +45,7 @@ def _pin_vm_threads(vm, node):
     param node: a numa node to pin to
     """
     node = utils_misc.NumaNode(node)
-    utils_test.qemu.pin_vm_threads(vm, node)
+    cpu_affinity.pin_vm_threads(vm, node)
 
 
 def _stop_service(test, params, session, service):
@@ -2,6 +2,8 @@ import time
 
 from virttest import env_process, error_context, utils_misc, utils_net
 
+from provider import memory_leak
+
 
 @error_context.context_aware
 def run(test, params, env):
@@ -12,6 +14,8 @@ def run(test, params, env):
     3) Hotplug nic 100 times(windows) or add 300 vlan(linux)
     4) Hotunplug nic 100 times(windows) or del 300 vlan(linux)
     5) Check free memory again
+    6) Check the memory of the qemu-kvm process does not grow with the
+       hotplug iterations (windows)
 
     :param test: kvm test object.
     :param params: Dictionary with test parameters.
@@ -40,8 +44,9 @@ def run(test, params, env):
         pci_model = params.get("pci_model")
         netdst = params.get("netdst", "virbr0")
         nettype = params.get("nettype", "bridge")
-        for i in range(1, 100):
-            nic_name = "hotadded%s" % i
+
+        def _hotplug_nic(index):
+            nic_name = "hotadded%s" % (index + 1)
             vm.hotplug_nic(
                 nic_model=pci_model,
                 nic_name=nic_name,
@@ -52,6 +57,9 @@ def run(test, params, env):
             time.sleep(3)
             vm.hotunplug_nic(nic_name)
             time.sleep(3)
+
+        detector = memory_leak.LeakDetector(vm.get_pid(), params)
+        qemu_leak = detector.run(_hotplug_nic, 99)
     else:
         session.cmd_output_safe("swapoff -a")
         mac = vm.get_mac_address()
@@ -77,5 +85,7 @@ def run(test, params, env):
             "Memory reduced %d" % mem_reduced
         )
     error_context.context("Memory reduced = %d" % mem_reduced, test.log.info)
+    if os_type == "windows":
+        memory_leak.check_leak(test, qemu_leak)
 
     session.close()
@@ -1,47 +1,10 @@
 import os
-import re
 import time
 
-import six
 from virttest import qemu_migration, utils_misc
 
 from provider import cpuflags
-
-
-class Statistic(object):
-    """
-    Class to display and collect average,
-    max and min values of a given data set.
-    """
-
-    def __init__(self):
-        self._sum = 0
-        self._count = 0
-        self._max = None
-        self._min = None
-
-    def get_average(self):
-        if self._count != 0:
-            return self._sum / self._count
-        else:
-            return None
-
-    def get_min(self):
-        return self._min
-
-    def get_max(self):
-        return self._max
-
-    def record(self, value):
-        """
-        Record new value to statistic.
-        """
-        self._count += 1
-        self._sum += value
-        if not self._max or self._max < value:
-            self._max = value
-        if not self._min or self._min > value:
-            self._min = value
+from provider.migration_telemetry import MigrationSampler
 
 
 def run(test, params, env):
@@ -74,53 +37,12 @@ def run(test, params, env):
 
     vm_mem = int(params.get("mem", "512"))
 
-    get_mig_speed = re.compile(r"^transferred ram: (\d+) kbytes$", re.MULTILINE)
-
     mig_speed = params.get("mig_speed", "1G")
     mig_speed_accuracy = float(params.get("mig_speed_accuracy", "0.2"))
     clonevm = None
 
-    def get_migration_statistic(vm):
-        last_transfer_mem = 0
-        transfered_mem = 0
-        mig_stat = Statistic()
-        while vm.monitor.get_migrate_progress() == 0:
-            pass
-        for _ in range(30):
-            o = vm.monitor.info("migrate")
-            warning_msg = (
-                "Migration already ended. Migration speed is"
-                " probably too high and will block vm while"
-                " filling its memory."
-            )
-            fail_msg = (
-                "Could not determine the transferred memory from"
-                " monitor data: %s" % o
-            )
-            if isinstance(o, six.string_types):
-                if "status: active" not in o:
-                    test.error(warning_msg)
-                try:
-                    transfered_mem = int(get_mig_speed.search(o).groups()[0])
-                except (IndexError, ValueError):
-                    test.fail(fail_msg)
-            else:
-                if o.get("status") != "active":
-                    test.error(warning_msg)
-                try:
-                    transfered_mem = o.get("ram").get("transferred") / (1024)
-                except (IndexError, ValueError):
-                    test.fail(fail_msg)
-
-            real_mig_speed = (transfered_mem - last_transfer_mem) / 1024
-
-            last_transfer_mem = transfered_mem
-
-            test.log.debug("Migration speed: %s MB/s", real_mig_speed)
-            mig_stat.record(real_mig_speed)
-            time.sleep(1)
-
-        return mig_stat
+    mig_samples = int(params.get("mig_speed_samples", 30))
+    mig_sample_interval = float(params.get("mig_sample_interval", 1))
 
     try:
         # Reboot the VM in the background
@@ -140,21 +62,38 @@ def run(test, params, env):
 
         time.sleep(2)
 
+        # One more sample to get the speeds of mig_samples intervals
+        sampler = MigrationSampler(
+            vm, mig_sample_interval, mig_samples + 1, start_timeout=mig_timeout
+        )
+        sampler.start()
         clonevm = vm.migrate(
             mig_timeout, mig_protocol, not_wait_for_migration=True, env=env
         )
 
         mig_speed = int(float(utils_misc.normalize_data_size(mig_speed, "M")))
 
-        mig_stat = get_migration_statistic(vm)
+        sampler.join(mig_sample_interval * (mig_samples + 1) + mig_timeout)
+        if sampler.error:
+            test.fail(
+                "Could not determine the transferred memory from monitor "
+                "data: %s" % sampler.error
+            )
+        if sampler.ended_early():
+            test.error(
+                "Migration already ended. Migration speed is probably too "
+                "high and will block vm while filling its memory."
+            )
+        sampler.log_summary()
+        mig_stat = sampler.summary()
 
-        real_speed = mig_stat.get_average()
+        real_speed = mig_stat["mean"]
         ack_speed = mig_speed * mig_speed_accuracy
 
         test.log.info("Target migration speed: %d MB/s.", mig_speed)
-        test.log.info("Average migration speed: %d MB/s", mig_stat.get_average())
-        test.log.info("Minimum migration speed: %d MB/s", mig_stat.get_min())
-        test.log.info("Maximum migration speed: %d MB/s", mig_stat.get_max())
+        test.log.info("Average migration speed: %d MB/s", mig_stat["mean"])
+        test.log.info("Minimum migration speed: %d MB/s", mig_stat["min"])
+        test.log.info("Maximum migration speed: %d MB/s", mig_stat["max"])
 
         test.log.info("Maximum tolerable divergence: %3.1f%%", mig_speed_accuracy * 100)
 
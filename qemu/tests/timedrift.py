@@ -2,9 +2,11 @@ import sys
 import time
 
 import aexpect
-from avocado.utils import cpu, process
+from avocado.utils import cpu
 from virttest import utils_test, utils_time
 
+from provider import cpu_affinity
+
 
 def run(test, params, env):
     """
@@ -26,44 +28,6 @@ def run(test, params, env):
     :param env: Dictionary with the test environment.
     """
 
-    # Helper functions
-    def set_cpu_affinity(pid, mask):
-        """
-        Set the CPU affinity of all threads of the process with PID pid.
-        Do this recursively for all child processes as well.
-
-        :param pid: The process ID.
-        :param mask: The CPU affinity mask.
-        :return: A dict containing the previous mask for each thread.
-        """
-        tids = process.run(
-            "ps -L --pid=%s -o lwp=" % pid, verbose=False, ignore_status=True
-        ).stdout_text.split()
-        prev_masks = {}
-        for tid in tids:
-            prev_mask = process.run(
-                "taskset -p %s" % tid, verbose=False
-            ).stdout_text.split()[-1]
-            prev_masks[tid] = prev_mask
-            process.system("taskset -p %s %s" % (mask, tid), verbose=False)
-        children = process.run(
-            "ps --ppid=%s -o pid=" % pid, verbose=False, ignore_status=True
-        ).stdout_text.split()
-        for child in children:
-            prev_masks.update(set_cpu_affinity(child, mask))
-        return prev_masks
-
-    def restore_cpu_affinity(prev_masks):
-        """
-        Restore the CPU affinity of several threads.
-
-        :param prev_masks: A dict containing TIDs as keys and masks as values.
-        """
-        for tid, mask in prev_masks.items():
-            process.system(
-                "taskset -p %s %s" % (mask, tid), verbose=False, ignore_status=True
-            )
-
     # Taking this as a workaround to avoid getting errors during
     # pickling with Python versions prior to 3.7.
     global _picklable_logger
@@ -118,10 +82,11 @@ def run(test, params, env):
     interval_gettime = float(params.get("interval_gettime", "20"))
     guest_load_sessions = []
     host_load_sessions = []
+    affinity = cpu_affinity.AffinityManager()
 
     try:
         # Set the VM's CPU affinity
-        prev_affinity = set_cpu_affinity(vm.get_shell_pid(), cpu_mask)
+        affinity.pin_process(vm.get_shell_pid(), cpu_mask, children=True)
 
         try:
             # Open shell sessions with the guest
@@ -163,7 +128,7 @@ def run(test, params, env):
                 host_load_sessions.append(load_cmd)
                 # Set the CPU affinity of the load process
                 pid = load_cmd.get_pid()
-                set_cpu_affinity(pid, cpu_mask << i)
+                affinity.pin_process(pid, cpu_mask << i, children=True)
 
             # Sleep for a while (during load)
             test.log.info("Sleeping for %s seconds...", load_duration)
@@ -188,7 +153,7 @@ def run(test, params, env):
         finally:
             test.log.info("Cleaning up...")
             # Restore the VM's CPU affinity
-            restore_cpu_affinity(prev_affinity)
+            affinity.restore()
             # Stop the guest load
             if guest_load_stop_command:
                 session.cmd_output(guest_load_stop_command)
@@ -1,5 +1,7 @@
 from virttest import utils_test, utils_time
 
+from provider import clock_offset
+
 
 def run(test, params, env):
     """
@@ -11,6 +13,10 @@ def run(test, params, env):
     4) Take a second time reading.
     5) If the drift (in seconds) is higher than a user specified value, fail.
 
+    If 'clock_probe_port' is set, the time readings are taken by the clock
+    probes over the virtserialport instead of the shell, and the drift rate
+    is checked at last.
+
     :param test: QEMU test object.
     :param params: Dictionary with test parameters.
     :param env: Dictionary with the test environment.
@@ -41,21 +47,30 @@ def run(test, params, env):
     drift_threshold = float(params.get("drift_threshold", "10"))
     drift_threshold_single = float(params.get("drift_threshold_single", "3"))
     migration_iterations = int(params.get("migration_iterations", 1))
+    clock_probe_port = params.get("clock_probe_port")
+    probe = None
+
+    def get_time():
+        if probe:
+            return probe.get_time()
+        return utils_test.get_time(session, time_command, time_filter_re, time_format)
 
     try:
+        if clock_probe_port:
+            probe = clock_offset.ClockProbe(vm, clock_probe_port, session, params)
+            probe.start()
+
         # Get initial time
         # (ht stands for host time, gt stands for guest time)
-        (ht0, gt0) = utils_test.get_time(
-            session, time_command, time_filter_re, time_format
-        )
+        (ht0, gt0) = get_time()
 
         # Migrate
         for i in range(migration_iterations):
             # Get time before current iteration
-            (ht0_, gt0_) = utils_test.get_time(
-                session, time_command, time_filter_re, time_format
-            )
+            (ht0_, gt0_) = get_time()
             session.close()
+            if probe:
+                probe.disconnect()
             # Run current iteration
             test.log.info(
                 "Migrating: iteration %d of %d...", (i + 1), migration_iterations
@@ -65,10 +80,11 @@ def run(test, params, env):
             test.log.info("Logging in after migration...")
             session = vm.wait_for_login(timeout=30)
             test.log.info("Logged in after migration")
+            if probe:
+                probe.session = session
+                probe.connect()
             # Get time after current iteration
-            (ht1_, gt1_) = utils_test.get_time(
-                session, time_command, time_filter_re, time_format
-            )
+            (ht1_, gt1_) = get_time()
             # Report iteration results
             host_delta = ht1_ - ht0_
             guest_delta = gt1_ - gt0_
@@ -84,11 +100,14 @@ def run(test, params, env):
                 )
 
         # Get final time
-        (ht1, gt1) = utils_test.get_time(
-            session, time_command, time_filter_re, time_format
-        )
+        (ht1, gt1) = get_time()
+
+        if probe:
+            clock_offset.check_drift_rate(test, params, probe)
 
     finally:
+        if probe:
+            probe.stop()
         if session:
             session.close()
         # remove flags add for this test.
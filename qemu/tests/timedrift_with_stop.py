@@ -4,6 +4,8 @@ import time
 
 from virttest import utils_test, utils_time
 
+from provider import clock_offset
+
 
 def run(test, params, env):
     """
@@ -17,6 +19,10 @@ def run(test, params, env):
     6) Take a second time reading.
     7) If the drift (in seconds) is higher than a user specified value, fail.
 
+    If 'clock_probe_port' is set, the time readings are taken by the clock
+    probes over the virtserialport instead of the shell, and the drift rate
+    is checked at last.
+
     :param test: QEMU test object.
     :param params: Dictionary with test parameters.
     :param env: Dictionary with the test environment.
@@ -51,23 +57,30 @@ def run(test, params, env):
     stop_iterations = int(params.get("stop_iterations", 1))
     stop_time = int(params.get("stop_time", 60))
     stop_with_signal = params.get("stop_with_signal") == "yes"
+    clock_probe_port = params.get("clock_probe_port")
+    probe = None
+
+    def get_time():
+        if probe:
+            return probe.get_time()
+        return utils_test.get_time(session, time_command, time_filter_re, time_format)
 
     # Get guest's pid.
     pid = vm.get_pid()
 
     try:
+        if clock_probe_port:
+            probe = clock_offset.ClockProbe(vm, clock_probe_port, session, params)
+            probe.start()
+
         # Get initial time
         # (ht stands for host time, gt stands for guest time)
-        (ht0, gt0) = utils_test.get_time(
-            session, time_command, time_filter_re, time_format
-        )
+        (ht0, gt0) = get_time()
 
         # Stop the guest
         for i in range(stop_iterations):
             # Get time before current iteration
-            (ht0_, gt0_) = utils_test.get_time(
-                session, time_command, time_filter_re, time_format
-            )
+            (ht0_, gt0_) = get_time()
             # Run current iteration
             test.log.info(
                 "Stop %s second: iteration %d of %d...",
@@ -91,9 +104,7 @@ def run(test, params, env):
             time.sleep(sleep_time)
 
             # Get time after current iteration
-            (ht1_, gt1_) = utils_test.get_time(
-                session, time_command, time_filter_re, time_format
-            )
+            (ht1_, gt1_) = get_time()
             # Report iteration results
             host_delta = ht1_ - ht0_
             guest_delta = gt1_ - gt0_
@@ -115,11 +126,14 @@ def run(test, params, env):
                 )
 
         # Get final time
-        (ht1, gt1) = utils_test.get_time(
-            session, time_command, time_filter_re, time_format
-        )
+        (ht1, gt1) = get_time()
+
+        if probe:
+            clock_offset.check_drift_rate(test, params, probe)
 
     finally:
+        if probe:
+            probe.stop()
         if session:
             session.close()
         # remove flags add for this test.
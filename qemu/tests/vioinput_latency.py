@@ -0,0 +1,81 @@
+from virttest import error_context, utils_misc
+
+from provider import input_event_proxy, input_tests, perf_result_store
+
+
+@error_context.context_aware
+def run(test, params, env):
+    """
+    Input latency benchmark.
+
+    1) Log into the guest and listen the input events in guest.
+    2) Estimate the offset of the guest clock over the agent channel.
+    3) Inject key/button/motion events via QMP one by one, get the latency
+       from the injection on host to the event timestamp of guest evdev.
+    4) Inject a burst of events to get the throughput.
+    5) Record the results and compare them with the baseline.
+
+    :param test: kvm test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    if params.get("os_type") == "windows":
+        test.cancel("The Windows input agent does not timestamp the events")
+    vm = env.get_vm(params["main_vm"])
+    vm.verify_alive()
+    if not getattr(vm, "qmp_monitors", None):
+        test.cancel("QMP monitor is required to inject input events")
+    backend = params.get("input_backend", "virtio")
+
+    store = perf_result_store.PerfResultStore.from_params(params, test.resultsdir)
+    env_info = {"qemu": utils_misc.get_qemu_version(params), "backend": backend}
+    test_name = params.get("shortname", "vioinput_latency")
+    perf_run = store.new_run(
+        test_name,
+        params,
+        env_info,
+        hash_keys=(
+            "input_backend",
+            "latency_inputs",
+            "latency_interval",
+            "latency_burst",
+        ),
+    )
+
+    error_context.context("Start event listener in guest", test.log.info)
+    listener = input_event_proxy.EventListener(vm)
+    try:
+        for kind in params.objects("latency_inputs"):
+            result = input_tests.input_latency_test(test, params, vm, listener, kind)
+            latency = result["latency"]
+            test.log.info(
+                "%s %s latency [ms] (p50/p99/max) = %.3f/%.3f/%.3f, "
+                "QMP send [ms] (p50/p99) = %.3f/%.3f, throughput = %.1f events/s, "
+                "lost = %d, devices = %s",
+                backend,
+                kind,
+                latency["p50"],
+                latency["p99"],
+                latency["max"],
+                result["send"]["p50"],
+                result["send"]["p99"],
+                result["throughput"],
+                result["lost"],
+                ", ".join(result["devices"]),
+            )
+            samples = result["samples"]
+            perf_run.add("latency_p50", latency["p50"], samples, input=kind)
+            perf_run.add("latency_p99", latency["p99"], samples, input=kind)
+            perf_run.add("throughput", result["throughput"], input=kind)
+            if result["lost"] > int(params.get("latency_max_lost", 0)):
+                test.fail("%d %s events are lost in guest" % (result["lost"], kind))
+        for dev, stats in listener.stats().items():
+            test.log.info("Input event statistics of %s: %s", dev, stats)
+    finally:
+        listener.clear_events()
+        listener.cleanup()
+
+    perf_run.commit()
+    perf_result_store.check_regressions(
+        test, params, store, perf_run, lower_is_better=("latency_p50", "latency_p99")
+    )
@@ -267,6 +267,12 @@ def run(test, params, env):
     for end_pos in target_pos:
         mouse_move_test(test, params, console, listener, wait_time, end_pos, absolute)
 
+    for dev, stats in listener.stats().items():
+        test.log.info("Input event statistics of %s: %s", dev, stats)
+        if params.get("check_event_loss") == "yes" and (
+            stats["lost"] or stats["dropped"] or stats["overflowed"]
+        ):
+            test.fail("Input events of %s are lost: %s" % (dev, stats))
     listener.clear_events()
     listener.cleanup()
     session.close()
@@ -4,7 +4,6 @@ Collection of virtio_console and virtio_serialport tests.
 :copyright: 2010-2012 Red Hat Inc.
 """
 
-import array
 import logging
 import os
 import random
@@ -28,6 +27,8 @@ from virttest.qemu_devices import qcontainer, qdevices
 from virttest.utils_test.qemu import migration
 from virttest.utils_virtio_port import VirtioPortTest
 
+from provider import virtio_serial_perf
+
 LOG_JOB = logging.getLogger("avocado.test")
 
 
@@ -1159,19 +1160,32 @@ def run(test, params, env):
         if err:
             test.fail("%s failed" % err[:-2])
 
-    def _process_stats(stats, scale=1.0):
+    def _log_perf_result(direction, buf_len, result):
         """
-        Process the stats to human readable form.
-        :param stats: List of measured data.
+        Log the throughput and the CPU usage measured by test_perf.
+        :param direction: Direction of the data, e.g. 'Host -> Guest'
+        :param buf_len: Buffer length
+        :param result: Result of virtio_serial_perf.measure_throughput()
         """
-        if not stats:
-            return None
-        for i in range((len(stats) - 1), 0, -1):
-            stats[i] = stats[i] - stats[i - 1]
-            stats[i] /= scale
-        stats[0] /= scale
-        stats = sorted(stats)
-        return stats
+        rates = result["rates"]
+        test.log.info(
+            "%s @%dB [MB/s] (avg/min/p50/p90/p99/max) = "
+            "%.3f/%.3f/%.3f/%.3f/%.3f/%.3f",
+            direction,
+            buf_len,
+            result["mbps"],
+            rates["min"],
+            rates["p50"],
+            rates["p90"],
+            rates["p99"],
+            rates["max"],
+        )
+        test.log.info(
+            "%s @%dB CPU usage [%%]: %s",
+            direction,
+            buf_len,
+            ", ".join("%s %.1f" % item for item in sorted(result["cpu"].items())),
+        )
 
     @error_context.context_aware
     def test_perf():
@@ -1181,14 +1195,16 @@ def run(test, params, env):
         computer utilization and statistic informations about the throughput.
 
         :param cfg: virtio_console_params - semicolon separated scenarios:
-                        '$console_type@$buffer_length:$test_duration;...'
+                '$console_type@$buffer_length[,$buffer_length...]:$test_duration;...'
+                        several buffer lengths are swept one by one
         :param cfg: virtio_console_test_time - default test_duration time
+        :param cfg: virtio_console_perf_pattern - send the pattern instead of
+                        random data
         :param cfg: virtio_port_spread - how many devices per virt pci (0=all)
         """
-        from autotest.client import utils
-
         test_params = params["virtio_console_params"]
         test_time = int(params.get("virtio_console_test_time", 60))
+        pattern = params.get("virtio_console_perf_pattern")
         no_serialports = 0
         no_consoles = 0
         if test_params.count("serialport"):
@@ -1199,12 +1215,12 @@ def run(test, params, env):
         (consoles, serialports) = virtio_test.get_virtio_ports(vm)
         consoles = [consoles, serialports]
         no_errors = 0
+        pids = {"autotest": os.getpid(), "VM": vm.get_pid()}
 
         for param in test_params.split(";"):
             if not param:
                 continue
             error_context.context("test_perf: params %s" % param, test.log.info)
-            EXIT_EVENT.clear()
             # Prepare
             param = param.split(":")
             duration = test_time
@@ -1214,144 +1230,104 @@ def run(test, params, env):
                 except ValueError:
                     pass
             param = param[0].split("@")
-            if len(param) > 1 and param[1].isdigit():
-                buf_len = int(param[1])
-            else:
-                buf_len = 1024
+            buf_lens = []
+            if len(param) > 1:
+                buf_lens = [int(_) for _ in param[1].split(",") if _.isdigit()]
+            buf_lens = buf_lens or [1024]
             param = param[0] == "serialport"
             port = consoles[param][0]
 
             port.open()
 
-            data = b""
-            for _ in range(buf_len):
-                data += b"%c" % random.randrange(255)
-
             funcatexit.register(env, params.get("type"), __set_exit_event)
 
-            time_slice = float(duration) / 100
+            for buf_len in buf_lens:
+                EXIT_EVENT.clear()
+                payload = virtio_serial_perf.make_payload(buf_len, pattern)
 
-            # HOST -> GUEST
-            guest_worker.cmd(
-                'virt.loopback(["%s"], [], %d, virt.LOOP_NONE)' % (port.name, buf_len),
-                10,
-            )
-            thread = qemu_virtio_port.ThSend(port.sock, data, EXIT_EVENT)
-            stats = array.array("f", [])
-            loads = utils.SystemLoad(
-                [(os.getpid(), "autotest"), (vm.get_pid(), "VM"), 0]
-            )
-            try:
-                loads.start()
-                _time = time.time()
-                thread.start()
-                for _ in range(100):
-                    stats.append(thread.idx)
-                    time.sleep(time_slice)
-                _time = time.time() - _time - duration
-                test.log.info(loads.get_cpu_status_string()[:-1])
-                test.log.info(loads.get_mem_status_string()[:-1])
-                EXIT_EVENT.set()
-                thread.join()
-                if thread.ret_code:
-                    no_errors += 1
-                    test.log.error(
-                        "test_perf: error occurred in thread %s " "(H2G)", thread
+                # HOST -> GUEST
+                guest_worker.cmd(
+                    'virt.loopback(["%s"], [], %d, virt.LOOP_NONE)'
+                    % (port.name, buf_len),
+                    10,
+                )
+                thread = virtio_serial_perf.PayloadSender(
+                    port.sock, payload, EXIT_EVENT
+                )
+                try:
+                    thread.start()
+                    result = virtio_serial_perf.measure_throughput(
+                        thread, duration, pids
                     )
-                elif thread.idx == 0:
-                    no_errors += 1
-                    test.log.error("test_perf: no data sent (H2G)")
-
-                # Let the guest read-out all the remaining data
-                for _ in range(60):
-                    if guest_worker._cmd(
-                        "virt.poll('%s', %s)" % (port.name, select.POLLIN), 10
-                    )[0]:
-                        break
-                    time.sleep(1)
-                else:
-                    test.fail("Unable to read-out all remaining " "data in 60s.")
-
-                guest_worker.safe_exit_loopback_threads([port], [])
+                    EXIT_EVENT.set()
+                    thread.join()
+                    if thread.ret_code:
+                        no_errors += 1
+                        test.log.error(
+                            "test_perf: error occurred in thread %s (H2G)", thread
+                        )
+                    elif thread.nbytes == 0:
+                        no_errors += 1
+                        test.log.error("test_perf: no data sent (H2G)")
+
+                    # Let the guest read-out all the remaining data
+                    for _ in range(60):
+                        if guest_worker._cmd(
+                            "virt.poll('%s', %s)" % (port.name, select.POLLIN), 10
+                        )[0]:
+                            break
+                        time.sleep(1)
+                    else:
+                        test.fail("Unable to read-out all remaining data in 60s.")
 
-                if _time > time_slice:
-                    test.log.error(
-                        "Test ran %fs longer which is more than one " "time slice",
-                        _time,
-                    )
-                else:
-                    test.log.debug("Test ran %fs longer", _time)
-                stats = _process_stats(stats[1:], time_slice * 1048576)
-                test.log.debug("Stats = %s", stats)
-                test.log.info(
-                    "Host -> Guest [MB/s] (min/med/max) = %.3f/%.3f/" "%.3f",
-                    stats[0],
-                    stats[len(stats) / 2],
-                    stats[-1],
-                )
+                    guest_worker.safe_exit_loopback_threads([port], [])
+                    _log_perf_result("Host -> Guest", buf_len, result)
 
-                del thread
+                    del thread
 
-                # GUEST -> HOST
-                EXIT_EVENT.clear()
-                stats = array.array("f", [])
-                guest_worker.cmd(
-                    "virt.send_loop_init('%s', %d)" % (port.name, buf_len), 30
-                )
-                thread = qemu_virtio_port.ThRecv(port.sock, EXIT_EVENT, buf_len)
-                thread.start()
-                loads.start()
-                guest_worker.cmd("virt.send_loop()", 10)
-                _time = time.time()
-                for _ in range(100):
-                    stats.append(thread.idx)
-                    time.sleep(time_slice)
-                _time = time.time() - _time - duration
-                test.log.info(loads.get_cpu_status_string()[:-1])
-                test.log.info(loads.get_mem_status_string()[:-1])
-                guest_worker.cmd("virt.exit_threads()", 10)
-                EXIT_EVENT.set()
-                thread.join()
-                if thread.ret_code:
-                    no_errors += 1
-                    test.log.error(
-                        "test_perf: error occurred in thread %s" "(G2H)", thread
+                    # GUEST -> HOST
+                    EXIT_EVENT.clear()
+                    guest_worker.cmd(
+                        "virt.send_loop_init('%s', %d)" % (port.name, buf_len), 30
                     )
-                elif thread.idx == 0:
-                    no_errors += 1
-                    test.log.error("test_perf: No data received (G2H)")
-                # Deviation is higher than single time_slice
-                if _time > time_slice:
-                    test.log.error(
-                        "Test ran %fs longer which is more than one " "time slice",
-                        _time,
+                    thread = virtio_serial_perf.PayloadReceiver(
+                        port.sock, EXIT_EVENT, max(buf_len, 65536)
+                    )
+                    thread.start()
+                    guest_worker.cmd("virt.send_loop()", 10)
+                    result = virtio_serial_perf.measure_throughput(
+                        thread, duration, pids
                     )
-                else:
-                    test.log.debug("Test ran %fs longer", _time)
-                stats = _process_stats(stats[1:], time_slice * 1048576)
-                test.log.debug("Stats = %s", stats)
-                test.log.info(
-                    "Guest -> Host [MB/s] (min/med/max) = %.3f/%.3f/" "%.3f",
-                    stats[0],
-                    stats[len(stats) / 2],
-                    stats[-1],
-                )
-            except Exception as inst:
-                test.log.error(
-                    "test_perf: Failed with %s, starting virtio_test.cleanup", inst
-                )
-                loads.stop()
-                try:
                     guest_worker.cmd("virt.exit_threads()", 10)
                     EXIT_EVENT.set()
                     thread.join()
-                    raise inst
+                    if thread.ret_code:
+                        no_errors += 1
+                        test.log.error(
+                            "test_perf: error occurred in thread %s (G2H)", thread
+                        )
+                    elif thread.nbytes == 0:
+                        no_errors += 1
+                        test.log.error("test_perf: No data received (G2H)")
+                    _log_perf_result("Guest -> Host", buf_len, result)
                 except Exception as inst:
-                    test.log.error("test_perf: Critical failure, killing VM %s", inst)
-                    EXIT_EVENT.set()
-                    vm.destroy()
-                    del thread
-                    raise inst
+                    test.log.error(
+                        "test_perf: Failed with %s, starting virtio_test.cleanup",
+                        inst,
+                    )
+                    try:
+                        guest_worker.cmd("virt.exit_threads()", 10)
+                        EXIT_EVENT.set()
+                        thread.join()
+                        raise inst
+                    except Exception as inst:
+                        test.log.error(
+                            "test_perf: Critical failure, killing VM %s", inst
+                        )
+                        EXIT_EVENT.set()
+                        vm.destroy()
+                        del thread
+                        raise inst
             funcatexit.unregister(env, params.get("type"), __set_exit_event)
         virtio_test.cleanup(vm, guest_worker)
         if no_errors:
@@ -5,7 +5,9 @@ import time
 
 import six
 from avocado.utils import process
-from virttest import data_dir, error_context, remote, utils_misc, utils_test, virt_vm
+from virttest import data_dir, error_context, remote, utils_misc, virt_vm
+
+from provider import cpu_affinity
 
 LOG_JOB = logging.getLogger("avocado.test")
 
@@ -54,7 +56,7 @@ def run(test, params, env):
         if node:
             if not isinstance(node, utils_misc.NumaNode):
                 node = utils_misc.NumaNode(int(node))
-            utils_test.qemu.pin_vm_threads(vm, node)
+            cpu_affinity.pin_vm_threads(vm, node)
 
     def install_dpdk():
         """Install dpdk realted packages"""